@@ -1,13 +1,44 @@
+import io
 import os
-from flask import Flask, render_template, redirect, request, session, url_for, jsonify
-from spotipy import Spotify
-from spotipy.oauth2 import SpotifyOAuth
+import gzip
+import atexit
+import bisect
+import itertools
+import json
+import time
+import hashlib
+import cProfile
+import pstats
+import secrets
+import sqlite3
+import sys
+import threading
+import unicodedata
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import urllib3
+from flask import Flask, render_template, redirect, request, session, url_for, jsonify, Response, stream_with_context, g
+from spotipy import Spotify, SpotifyException
+from spotipy.oauth2 import SpotifyOAuth, SpotifyClientCredentials
+from markupsafe import Markup
 from dotenv import load_dotenv
 
+try:
+    import redis
+except ImportError:
+    redis = None
+
 load_dotenv()
 
 app = Flask(__name__)
-app.secret_key = "super_secret_key"
+# La cookie de sesión (con el usuario_id que guarda /callback) es de fiar mientras nadie más tenga la clave
+app.secret_key = os.getenv("SECRET_KEY")
+if not app.secret_key:
+    print("SECRET_KEY no configurada: se usa una aleatoria y las sesiones no sobreviven a un reinicio")
+    app.secret_key = secrets.token_hex(32)
 app.config["SESSION_COOKIE_NAME"] = "spotify_session"
 
 CLIENT_ID = os.getenv("SPOTIPY_CLIENT_ID")
@@ -21,21 +52,1618 @@ sp_oauth = SpotifyOAuth(client_id=CLIENT_ID,
                         redirect_uri=REDIRECT_URI,
                         scope=scope)
 
+class PoolConContexto(ThreadPoolExecutor):
+    """ThreadPoolExecutor cuyas tareas heredan los contextvars de quien las envía (prioridad, medición)"""
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+# Pool compartido para las llamadas a Spotify que se pueden hacer en paralelo
+SPOTIFY_HILOS = int(os.getenv("SPOTIFY_HILOS", 8))
+pool_spotify = PoolConContexto(max_workers=SPOTIFY_HILOS)
+
+# ----------------- MÉTRICAS -----------------
+# Por ruta: duración, llamadas a Spotify y su latencia, aciertos de cache y errores.
+# /metrics las expone en el formato de texto de Prometheus; ?_profile=1 perfila
+# una petición con cProfile (solo para los usuarios de ADMIN_USUARIOS).
+
+ADMIN_USUARIOS = set(filter(None, os.getenv("ADMIN_USUARIOS", "").split(",")))
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BUCKETS_LLAMADAS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+PERFIL_LINEAS = 40
+
+metricas = []  # Contadores e histogramas, en el orden en que se exponen
+
+def etiquetas_prometheus(nombres, valores):
+    if not nombres:
+        return ""
+    pares = []
+    for nombre, valor in zip(nombres, valores):
+        valor = str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pares.append(f'{nombre}="{valor}"')
+    return "{" + ",".join(pares) + "}"
+
+class Contador:
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.valores = {}  # tupla de etiquetas -> total
+        self.lock = threading.Lock()
+        metricas.append(self)
+
+    def incrementar(self, *etiquetas, cantidad=1):
+        with self.lock:
+            self.valores[etiquetas] = self.valores.get(etiquetas, 0) + cantidad
+
+    def exponer(self):
+        with self.lock:
+            valores = list(self.valores.items())
+        yield f"# HELP {self.nombre} {self.ayuda}"
+        yield f"# TYPE {self.nombre} counter"
+        for etiquetas, total in valores:
+            yield f"{self.nombre}{etiquetas_prometheus(self.etiquetas, etiquetas)} {total}"
+
+class Histograma:
+    def __init__(self, nombre, ayuda, etiquetas, buckets):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.buckets = buckets
+        self.series = {}  # tupla de etiquetas -> [conteos por bucket..., +Inf, suma]
+        self.lock = threading.Lock()
+        metricas.append(self)
+
+    def observar(self, valor, *etiquetas):
+        with self.lock:
+            serie = self.series.get(etiquetas)
+            if serie is None:
+                serie = self.series[etiquetas] = [0] * (len(self.buckets) + 2)
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    serie[i] += 1
+            serie[-2] += 1
+            serie[-1] += valor
+
+    def exponer(self):
+        with self.lock:
+            series = [(etiquetas, list(serie)) for etiquetas, serie in self.series.items()]
+        yield f"# HELP {self.nombre} {self.ayuda}"
+        yield f"# TYPE {self.nombre} histogram"
+        nombres = self.etiquetas + ("le",)
+        for etiquetas, serie in series:
+            for limite, conteo in zip(self.buckets, serie):
+                yield f"{self.nombre}_bucket{etiquetas_prometheus(nombres, etiquetas + (limite,))} {conteo}"
+            yield f"{self.nombre}_bucket{etiquetas_prometheus(nombres, etiquetas + ('+Inf',))} {serie[-2]}"
+            yield f"{self.nombre}_sum{etiquetas_prometheus(self.etiquetas, etiquetas)} {serie[-1]:.6f}"
+            yield f"{self.nombre}_count{etiquetas_prometheus(self.etiquetas, etiquetas)} {serie[-2]}"
+
+http_duracion = Histograma("http_peticion_segundos", "Duración de las peticiones por ruta",
+                           ("ruta", "metodo", "estado"), BUCKETS_SEGUNDOS)
+http_llamadas_spotify = Histograma("http_llamadas_spotify", "Llamadas a Spotify hechas por cada petición",
+                                   ("ruta",), BUCKETS_LLAMADAS)
+http_espera_spotify = Histograma("http_spotify_segundos", "Tiempo acumulado esperando a Spotify por petición",
+                                 ("ruta",), BUCKETS_SEGUNDOS)
+# Se cuenta al hacer la llamada: incluye las precargas que terminan después de responder
+http_spotify_total = Contador("http_spotify_llamadas_total", "Llamadas a Spotify por ruta que las originó", ("ruta",))
+http_cache = Contador("http_cache_total", "Consultas a las caches por ruta", ("ruta", "cache", "resultado"))
+http_errores = Contador("http_errores_total", "Errores por ruta y clase", ("ruta", "clase"))
+spotify_duracion = Histograma("spotify_llamada_segundos", "Latencia de cada llamada a la API de Spotify",
+                              ("metodo", "endpoint", "estado"), BUCKETS_SEGUNDOS)
+
+# Colecciones de la API de Spotify cuyo siguiente segmento es un ID
+COLECCIONES_SPOTIFY = {"albums", "artists", "audio-features", "episodes", "playlists", "shows", "tracks", "users"}
+
+def endpoint_spotify(url):
+    """'https://api.spotify.com/v1/playlists/37i9.../tracks?offset=100' -> '/playlists/{id}/tracks'"""
+    ruta = url.split("?", 1)[0].split("/v1/", 1)[-1]
+    segmentos = ruta.strip("/").split("/")
+    for i in range(1, len(segmentos)):
+        if segmentos[i - 1] in COLECCIONES_SPOTIFY:
+            segmentos[i] = "{id}"
+    return "/" + "/".join(segmentos)
+
+class MedicionPeticion:
+    """Lo que hizo una petición; también la suman las tareas que lanza en pool_spotify"""
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.inicio = time.perf_counter()
+        self.llamadas_spotify = 0
+        self.segundos_spotify = 0.0
+        self.cache = {}  # (cache, resultado) -> consultas
+        self.error = None
+        self.lock = threading.Lock()
+
+medicion_actual = contextvars.ContextVar("medicion_peticion", default=None)
+
+def registrar_llamada_spotify(metodo, url, estado, segundos):
+    spotify_duracion.observar(segundos, metodo, endpoint_spotify(url), estado)
+    medicion = medicion_actual.get()
+    if medicion is not None:
+        http_spotify_total.incrementar(medicion.ruta)
+        with medicion.lock:
+            medicion.llamadas_spotify += 1
+            medicion.segundos_spotify += segundos
+
+def registrar_cache(nombre, aciertos, fallos):
+    medicion = medicion_actual.get()
+    if medicion is None:
+        return
+    with medicion.lock:
+        for resultado, cantidad in (("acierto", aciertos), ("fallo", fallos)):
+            if cantidad:
+                medicion.cache[nombre, resultado] = medicion.cache.get((nombre, resultado), 0) + cantidad
+
+def registrar_error(error):
+    medicion = medicion_actual.get()
+    if medicion is not None:
+        medicion.error = clase_de_error(error)
+
+def clase_de_error(error):
+    if isinstance(error, SpotifyException):
+        return f"{type(error).__name__}:{error.http_status}"
+    return type(error).__name__
+
+def es_admin():
+    return usuario_verificado() in ADMIN_USUARIOS
+
+@app.before_request
+def iniciar_medicion():
+    g.medicion = MedicionPeticion(request.url_rule.rule if request.url_rule else "sin_ruta")
+    g.token_medicion = medicion_actual.set(g.medicion)
+    if request.args.get("_profile") == "1" and es_admin():
+        g.perfil = cProfile.Profile()
+        g.perfil.enable()
+
+@app.after_request
+def terminar_medicion(respuesta):
+    medicion = g.get("medicion")
+    if medicion is None:
+        return respuesta
+    duracion = time.perf_counter() - medicion.inicio
+    ruta = medicion.ruta
+    # Con streaming (SSE, NDJSON) se mide hasta que empieza la respuesta, no el stream entero
+    http_duracion.observar(duracion, ruta, request.method, respuesta.status_code)
+    http_llamadas_spotify.observar(medicion.llamadas_spotify, ruta)
+    http_espera_spotify.observar(medicion.segundos_spotify, ruta)
+    with medicion.lock:
+        consultas = list(medicion.cache.items())
+    for (nombre, resultado), cantidad in consultas:
+        http_cache.incrementar(ruta, nombre, resultado, cantidad=cantidad)
+    # Un error de Spotify del que la ruta se recuperó (p. ej. sin dispositivo activo) no cuenta
+    if respuesta.status_code >= 500 or (respuesta.status_code >= 400 and medicion.error):
+        http_errores.incrementar(ruta, medicion.error or f"HTTP{respuesta.status_code}")
+    g.medicion_registrada = True
+
+    perfil = g.pop("perfil", None)
+    if perfil is None:
+        return respuesta
+    perfil.disable()
+    salida = io.StringIO()
+    salida.write(f"{request.method} {request.full_path} -> {respuesta.status_code}\n"
+                 f"{duracion * 1000:.1f} ms, {medicion.llamadas_spotify} llamadas a Spotify "
+                 f"({medicion.segundos_spotify * 1000:.1f} ms), cache {dict(consultas)}\n\n")
+    pstats.Stats(perfil, stream=salida).sort_stats("cumulative").print_stats(PERFIL_LINEAS)
+    return Response(salida.getvalue(), mimetype="text/plain")
+
+@app.teardown_request
+def cerrar_medicion(error):
+    if error is not None and not g.get("medicion_registrada"):
+        ruta = request.url_rule.rule if request.url_rule else "sin_ruta"
+        http_errores.incrementar(ruta, clase_de_error(error))
+    perfil = g.pop("perfil", None)
+    if perfil is not None:
+        perfil.disable()
+    token = g.pop("token_medicion", None)
+    if token is not None:
+        medicion_actual.reset(token)
+
+def estadisticas_prometheus(componente, estadisticas):
+    """Valores numéricos de un .estadisticas() como gauges"""
+    for medida, valor in estadisticas.items():
+        if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+            yield f"app_estado{etiquetas_prometheus(('componente', 'medida'), (componente, medida))} {valor}"
+
+@app.route("/metrics")
+def metrics():
+    lineas = []
+    for metrica in metricas:
+        lineas.extend(metrica.exponer())
+    lineas.append("# HELP app_estado Estado interno de caches, tokens y límite de peticiones")
+    lineas.append("# TYPE app_estado gauge")
+    edades = []
+    for nombre, cache in caches.items():
+        estadisticas = cache.estadisticas()
+        lineas.extend(estadisticas_prometheus(f"cache_{nombre}", estadisticas))
+        # Las caches renovables (novedades) guardan pocas claves: su edad va por clave
+        for clave, edad in estadisticas.get("edad_seg", {}).items():
+            edades.append(f"app_cache_edad_segundos{etiquetas_prometheus(('cache', 'clave'), (nombre, clave))} {edad}")
+    lineas.extend(estadisticas_prometheus("tokens", gestor_tokens.estadisticas()))
+    lineas.extend(estadisticas_prometheus("limite_spotify", limitador_spotify.estadisticas()))
+    lineas.extend(estadisticas_prometheus("indice_busqueda", indice_tracks.estadisticas()))
+    lineas.append("# HELP app_cache_edad_segundos Segundos desde que se guardó cada clave de las caches renovables")
+    lineas.append("# TYPE app_cache_edad_segundos gauge")
+    lineas.extend(edades)
+    return Response("\n".join(lineas) + "\n", mimetype="text/plain; version=0.0.4")
+
+# ----------------- CACHE HTTP -----------------
+# Las rutas que se consultan cada pocos segundos responden 304 sin cuerpo cuando el
+# cliente ya tiene la última versión (If-None-Match). Los archivos estáticos llevan
+# ?v=<hash del contenido> en la URL y se cachean un año como immutable.
+
+ESTATICOS_MAX_AGE = 365 * 24 * 3600
+
+def etag_de(*partes):
+    return hashlib.blake2b(repr(partes).encode(), digest_size=12).hexdigest()
+
+def revalidar_siempre(respuesta):
+    # El navegador guarda la respuesta pero pregunta antes de usarla; nadie más la guarda
+    respuesta.cache_control.private = True
+    respuesta.cache_control.no_cache = True
+    return respuesta
+
+def respuesta_condicional(etag, generar):
+    """304 si el cliente ya tiene `etag`; si no, generar() con ese ETag.
+
+    Con una versión (la revisión de la playlist) como ETag, el cuerpo ni se serializa.
+    """
+    if request.if_none_match.contains(etag):
+        respuesta = app.response_class(status=304)
+    else:
+        respuesta = generar()
+    respuesta.set_etag(etag)
+    return revalidar_siempre(respuesta)
+
+def con_etag_del_contenido(respuesta):
+    """ETag del cuerpo ya generado: ahorra la transferencia, no la serialización"""
+    respuesta.add_etag()
+    return revalidar_siempre(respuesta).make_conditional(request)
+
+huellas_estaticos = {}  # archivo -> (mtime, hash del contenido)
+
+def huella_estatico(archivo):
+    ruta = os.path.join(app.static_folder, archivo)
+    try:
+        mtime = os.stat(ruta).st_mtime_ns
+    except OSError:
+        return None
+    huella = huellas_estaticos.get(archivo)
+    if huella is None or huella[0] != mtime:
+        with open(ruta, "rb") as contenido:
+            huella = huellas_estaticos[archivo] = (mtime, hashlib.blake2b(contenido.read(), digest_size=6).hexdigest())
+    return huella[1]
+
+@app.url_defaults
+def version_estaticos(endpoint, valores):
+    """url_for('static', ...) agrega ?v=<hash>: la URL cambia cuando cambia el archivo"""
+    if endpoint == "static" and "v" not in valores:
+        huella = huella_estatico(valores["filename"])
+        if huella:
+            valores["v"] = huella
+
+@app.after_request
+def cache_estaticos(respuesta):
+    if request.endpoint != "static" or respuesta.status_code not in (200, 206, 304):
+        return respuesta
+    # Solo la versión actual es immutable; un ?v= viejo podría quedar apuntando a otro contenido
+    if request.args.get("v") and request.args["v"] == huella_estatico(request.view_args["filename"]):
+        respuesta.cache_control.no_cache = None
+        respuesta.cache_control.public = True
+        respuesta.cache_control.max_age = ESTATICOS_MAX_AGE
+        respuesta.cache_control.immutable = True
+    return respuesta
+
+# ----------------- CLIENTES SPOTIFY -----------------
+
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL")  # p. ej. un servidor local de pruebas
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", 4))
+HTTP_POOL_CONEXIONES = int(os.getenv("HTTP_POOL_CONEXIONES", 32))
+CLIENTE_INACTIVO_SEG = int(os.getenv("CLIENTE_INACTIVO_SEG", 900))
+
+def crear_sesion_http():
+    """Sesión HTTP con keep-alive compartida por todos los clientes de Spotify"""
+    sesion = requests.Session()
+    # Mismos reintentos que usa spotipy en Spotify._build_session
+    retry = urllib3.Retry(
+        total=Spotify.max_retries,
+        connect=None,
+        read=False,
+        allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+        status=Spotify.max_retries,
+        backoff_factor=0.3,
+        # Los 429 no se reintentan aquí (urllib3 dormiría el hilo el Retry-After entero): los maneja LimitadorSpotify
+        status_forcelist=[codigo for codigo in Spotify.default_retry_codes if codigo != 429],
+        respect_retry_after_header=False)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_HOSTS,
+                                            pool_maxsize=HTTP_POOL_CONEXIONES,
+                                            max_retries=retry)
+    sesion.mount("http://", adapter)
+    sesion.mount("https://", adapter)
+    return sesion
+
+# ---- límite de peticiones ----
+# Spotify limita por app en una ventana móvil y responde 429 con Retry-After.
+# Cada llamada pasa por una cubeta de la app y otra del usuario; las de prioridad
+# baja (polling, lanzamientos) se descartan primero para dejar sitio a las acciones.
+
+PRIORIDAD_ALTA, PRIORIDAD_NORMAL, PRIORIDAD_BAJA = 0, 1, 2
+SPOTIFY_PETICIONES_SEG = float(os.getenv("SPOTIFY_PETICIONES_SEG", 25))  # por worker
+SPOTIFY_PETICIONES_RAFAGA = float(os.getenv("SPOTIFY_PETICIONES_RAFAGA", 50))
+USUARIO_PETICIONES_SEG = float(os.getenv("USUARIO_PETICIONES_SEG", 5))
+USUARIO_PETICIONES_RAFAGA = float(os.getenv("USUARIO_PETICIONES_RAFAGA", 15))
+RESERVA_PRIORIDAD_BAJA = 0.5  # la prioridad baja no usa la mitad de la cubeta de la app
+ESPERA_MAX_SEG = {PRIORIDAD_ALTA: 5, PRIORIDAD_NORMAL: 2, PRIORIDAD_BAJA: 0}
+
+prioridad_actual = contextvars.ContextVar("prioridad_spotify", default=PRIORIDAD_NORMAL)
+
+@contextmanager
+def prioridad_spotify(prioridad):
+    """Prioridad de las llamadas a Spotify dentro del bloque (también sirve como decorador de rutas)"""
+    token = prioridad_actual.set(prioridad)
+    try:
+        yield
+    finally:
+        prioridad_actual.reset(token)
+
+class LimiteSpotify(SpotifyException):
+    """Llamada no hecha (o rechazada con 429) por el límite de peticiones; `espera` en segundos"""
+    def __init__(self, espera, mensaje="Límite de peticiones a Spotify"):
+        self.espera = espera
+        super().__init__(429, -1, mensaje, headers={"Retry-After": str(max(1, int(espera + 0.999)))})
+
+class CubetaTokens:
+    def __init__(self, tasa, capacidad):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self.tokens = capacidad
+        self.actualizado = time.monotonic()
+
+    def rellenar(self, ahora):
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.actualizado) * self.tasa)
+        self.actualizado = ahora
+
+    def espera(self):
+        """Segundos hasta tener un token disponible"""
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.tasa
+
+class LimitadorSpotify:
+    def __init__(self, tasa_app, rafaga_app, tasa_usuario, rafaga_usuario, usuarios_max=10000):
+        self.app = CubetaTokens(tasa_app, rafaga_app)
+        self.tasa_usuario = tasa_usuario
+        self.rafaga_usuario = rafaga_usuario
+        self.usuarios_max = usuarios_max
+        self.usuarios = OrderedDict()  # clave del cliente -> CubetaTokens
+        self.pausa_hasta = 0  # time.monotonic() hasta el que Spotify pidió no llamar
+        self.lock = threading.Lock()
+        self.llamadas = 0
+        self.esperas = 0
+        self.descartadas = 0
+        self.respuestas_429 = 0
+
+    def _cubeta_usuario(self, clave):
+        cubeta = self.usuarios.get(clave)
+        if cubeta is None:
+            cubeta = self.usuarios[clave] = CubetaTokens(self.tasa_usuario, self.rafaga_usuario)
+            while len(self.usuarios) > self.usuarios_max:
+                self.usuarios.popitem(last=False)
+        self.usuarios.move_to_end(clave)
+        return cubeta
+
+    def pausa_restante(self):
+        return max(0, self.pausa_hasta - time.monotonic())
+
+    def antes_de_llamar(self, clave):
+        """Reserva un token de la app y del usuario; espera si hace falta o lanza LimiteSpotify"""
+        prioridad = prioridad_actual.get()
+        with self.lock:
+            ahora = time.monotonic()
+            cubetas = [self.app, self._cubeta_usuario(clave)]
+            for cubeta in cubetas:
+                cubeta.rellenar(ahora)
+            espera = max([self.pausa_hasta - ahora] + [cubeta.espera() for cubeta in cubetas])
+            if prioridad == PRIORIDAD_BAJA and self.app.tokens < self.app.capacidad * RESERVA_PRIORIDAD_BAJA:
+                espera = max(espera, (self.app.capacidad * RESERVA_PRIORIDAD_BAJA - self.app.tokens) / self.app.tasa)
+            if espera > ESPERA_MAX_SEG[prioridad]:
+                self.descartadas += 1
+                raise LimiteSpotify(espera)
+            for cubeta in cubetas:
+                cubeta.tokens -= 1
+            self.llamadas += 1
+            if espera > 0:
+                self.esperas += 1
+        if espera > 0:
+            time.sleep(espera)
+
+    def tras_429(self, error):
+        """Respeta el Retry-After de Spotify para todas las llamadas del worker"""
+        try:
+            espera = float((error.headers or {}).get("Retry-After", 1))
+        except ValueError:
+            espera = 1
+        with self.lock:
+            self.respuestas_429 += 1
+            self.pausa_hasta = max(self.pausa_hasta, time.monotonic() + espera)
+        return espera
+
+    def estadisticas(self):
+        with self.lock:
+            return {
+                "llamadas": self.llamadas,
+                "esperas": self.esperas,
+                "descartadas": self.descartadas,
+                "respuestas_429": self.respuestas_429,
+                "pausa_restante_seg": round(max(0, self.pausa_hasta - time.monotonic()), 2),
+                "tokens_app": round(self.app.tokens, 1),
+                "usuarios": len(self.usuarios)
+            }
+
+limitador_spotify = LimitadorSpotify(SPOTIFY_PETICIONES_SEG, SPOTIFY_PETICIONES_RAFAGA,
+                                     USUARIO_PETICIONES_SEG, USUARIO_PETICIONES_RAFAGA)
+
+class ClienteSpotify(Spotify):
+    """Cliente de spotipy que no cierra la sesión HTTP compartida al destruirse y respeta el límite de peticiones"""
+    def __init__(self, auth, sesion, auth_manager=None):
+        super().__init__(auth=auth, auth_manager=auth_manager, requests_session=sesion)
+        if SPOTIFY_API_URL:
+            self.prefix = SPOTIFY_API_URL
+        self.clave_limite = auth or "app"
+
+    def __del__(self):
+        pass
+
+    def _internal_call(self, method, url, payload, params):
+        try:
+            limitador_spotify.antes_de_llamar(self.clave_limite)
+            try:
+                return self._llamar(method, url, payload, params)
+            except SpotifyException as e:
+                if e.http_status != 429:
+                    raise
+                espera = limitador_spotify.tras_429(e)
+                # Solo las acciones del usuario esperan el Retry-After y reintentan una vez
+                if prioridad_actual.get() != PRIORIDAD_ALTA or espera > ESPERA_MAX_SEG[PRIORIDAD_ALTA]:
+                    raise LimiteSpotify(espera, str(e)) from e
+            limitador_spotify.antes_de_llamar(self.clave_limite)
+            return self._llamar(method, url, payload, params)
+        except Exception as e:
+            registrar_error(e)
+            raise
+
+    def _llamar(self, method, url, payload, params):
+        inicio = time.perf_counter()
+        estado = 200
+        try:
+            return super()._internal_call(method, url, payload, params)
+        except SpotifyException as e:
+            estado = e.http_status
+            raise
+        except Exception as e:
+            estado = type(e).__name__
+            raise
+        finally:
+            registrar_llamada_spotify(method, url, estado, time.perf_counter() - inicio)
+
+@app.errorhandler(LimiteSpotify)
+def limite_spotify(e):
+    mensaje = "Spotify está limitando las peticiones, intenta en unos segundos"
+    cabeceras = {"Retry-After": e.headers["Retry-After"]}
+    # Las páginas (navegación del navegador) reciben HTML; fetch() y los clientes de la API, JSON
+    if request.accept_mimetypes.best_match(["application/json", "text/html"]) == "text/html":
+        return f"<p>{mensaje}</p>", 429, cabeceras
+    return jsonify({"success": False, "error": mensaje, "message": mensaje}), 429, cabeceras
+
+class RegistroClientes:
+    """Un cliente por access token, reutilizado entre peticiones hasta que el token rota o queda inactivo"""
+    def __init__(self, sesion, inactivo_seg):
+        self.sesion = sesion
+        self.inactivo_seg = inactivo_seg
+        self.clientes = {}  # access_token -> [cliente, ultimo_uso]
+        self.lock = threading.Lock()
+        self.ultima_limpieza = time.monotonic()
+
+    def obtener(self, access_token):
+        ahora = time.monotonic()
+        with self.lock:
+            entrada = self.clientes.get(access_token)
+            if entrada is None:
+                entrada = self.clientes[access_token] = [ClienteSpotify(access_token, self.sesion), ahora]
+            entrada[1] = ahora
+            if ahora - self.ultima_limpieza > 60:
+                self._limpiar(ahora)
+            return entrada[0]
+
+    def descartar(self, access_token):
+        with self.lock:
+            self.clientes.pop(access_token, None)
+
+    def _limpiar(self, ahora):
+        inactivos = [token for token, (_, ultimo_uso) in self.clientes.items()
+                     if ahora - ultimo_uso > self.inactivo_seg]
+        for token in inactivos:
+            del self.clientes[token]
+        self.ultima_limpieza = ahora
+
+sesion_http = crear_sesion_http()
+registro_clientes = RegistroClientes(sesion_http, CLIENTE_INACTIVO_SEG)
+
+cliente_app = None
+
+def cliente_de_la_app():
+    """Cliente con las credenciales de la app (client credentials), para datos que no dependen del usuario"""
+    global cliente_app
+    if cliente_app is None and CLIENT_ID and CLIENT_SECRET:
+        cliente_app = ClienteSpotify(None, sesion_http,
+                                     auth_manager=SpotifyClientCredentials(CLIENT_ID, CLIENT_SECRET))
+    return cliente_app
+
 # ----------------- TOKEN -----------------
+
+TOKEN_MARGEN_SEG = 60  # el mismo margen que usa sp_oauth.is_token_expired
+TOKEN_REFRESCO_ANTICIPADO_SEG = int(os.getenv("TOKEN_REFRESCO_ANTICIPADO_SEG", 300))
+TOKENS_MAX = int(os.getenv("TOKENS_MAX", 10000))
+
+class EntradaToken:
+    def __init__(self, token_info):
+        self.token_info = token_info
+        self.usuario_id = None  # dueño del token según Spotify, no según la cookie
+        self.lock = threading.Lock()  # uno por token: un solo refresco a la vez
+        self.refrescando = False
+
+class GestorTokens:
+    """Token vigente de cada login, compartido por sus peticiones y su poller.
+
+    Las entradas van por refresh token: solo quien lo tiene en su sesión recibe el
+    access token de la entrada (el usuario_id de la cookie no prueba nada). Si Spotify
+    entrega un refresh token nuevo, la entrada queda también bajo ese.
+
+    Se refresca una sola vez por vencimiento (las peticiones concurrentes esperan
+    ese mismo refresco) y, cuando falta poco para que venza, en segundo plano
+    mientras se sigue usando el actual.
+    """
+    def __init__(self, oauth, anticipacion, tamanio_max):
+        self.oauth = oauth
+        self.anticipacion = anticipacion
+        self.tamanio_max = tamanio_max
+        self.entradas = OrderedDict()  # refresh token -> EntradaToken
+        self.lock = threading.Lock()
+        self.refrescos = 0
+        self.errores = 0
+
+    def _entrada(self, clave, token_info):
+        with self.lock:
+            entrada = self.entradas.get(clave)
+            if entrada is None:
+                if token_info is None:
+                    return None
+                entrada = self.entradas[clave] = EntradaToken(token_info)
+                while len(self.entradas) > self.tamanio_max:
+                    self.entradas.popitem(last=False)
+            elif token_info and token_info["expires_at"] > entrada.token_info["expires_at"]:
+                entrada.token_info = token_info  # p. ej. el usuario volvió a hacer login
+            self.entradas.move_to_end(clave)
+            return entrada
+
+    def vigente(self, clave, token_info=None):
+        """token_info vigente para el refresh token `clave`; solo bloquea si el que hay ya venció"""
+        entrada = self._entrada(clave, token_info)
+        if entrada is None:
+            return None
+        restante = entrada.token_info["expires_at"] - time.time()
+        if restante < TOKEN_MARGEN_SEG:
+            self._refrescar(entrada, TOKEN_MARGEN_SEG)
+        elif restante < self.anticipacion:
+            self._refrescar_en_segundo_plano(entrada)
+        return entrada.token_info
+
+    def _refrescar(self, entrada, margen):
+        with entrada.lock:
+            anterior = entrada.token_info
+            if anterior["expires_at"] - time.time() >= margen:
+                return  # lo refrescó otro hilo mientras esperábamos
+            try:
+                entrada.token_info = self.oauth.refresh_access_token(anterior["refresh_token"])
+            except Exception:
+                with self.lock:
+                    self.errores += 1
+                raise
+            with self.lock:
+                self.refrescos += 1
+                self.entradas[entrada.token_info["refresh_token"]] = entrada
+        registro_clientes.descartar(anterior["access_token"])
+
+    def _refrescar_en_segundo_plano(self, entrada):
+        with self.lock:
+            if entrada.refrescando:
+                return
+            entrada.refrescando = True
+
+        def refrescar():
+            try:
+                self._refrescar(entrada, self.anticipacion)
+            except Exception as e:
+                print("Error refrescando el token en segundo plano:", e)
+            finally:
+                entrada.refrescando = False
+        pool_spotify.submit(refrescar)
+
+    def usuario(self, clave):
+        """Usuario de Spotify verificado para el refresh token, o None si todavía no se consultó"""
+        with self.lock:
+            entrada = self.entradas.get(clave)
+            return entrada.usuario_id if entrada else None
+
+    def vincular(self, token_info, usuario_id):
+        self._entrada(token_info["refresh_token"], token_info).usuario_id = usuario_id
+
+    def estadisticas(self):
+        with self.lock:
+            return {"tokens": len(self.entradas), "refrescos": self.refrescos, "errores": self.errores}
+
+gestor_tokens = GestorTokens(sp_oauth, TOKEN_REFRESCO_ANTICIPADO_SEG, TOKENS_MAX)
+
 def get_token():
     token_info = session.get("token_info", None)
     if not token_info:
         return None
-    if sp_oauth.is_token_expired(token_info):
-        token_info = sp_oauth.refresh_access_token(token_info["refresh_token"])
-        session["token_info"] = token_info
-    return token_info
+    vigente = gestor_tokens.vigente(token_info["refresh_token"], token_info)
+    if vigente["access_token"] != token_info["access_token"]:
+        session["token_info"] = vigente
+    return vigente
 
 def get_spotify():
     token_info = get_token()
     if not token_info:
         return None
-    return Spotify(auth=token_info["access_token"])
+    return registro_clientes.obtener(token_info["access_token"])
+
+def usuario_verificado():
+    """Usuario dueño del token de la sesión si ya se verificó; no llama a Spotify.
+
+    El de la sesión lo escribe el servidor (/callback o get_usuario_id) después de
+    preguntarle a Spotify, y la cookie va firmada con SECRET_KEY.
+    """
+    token_info = session.get("token_info")
+    if not token_info:
+        return None
+    return session.get("usuario_id") or gestor_tokens.usuario(token_info["refresh_token"])
+
+def get_usuario_id(sp):
+    """ID de Spotify del dueño del token de la sesión; solo se pregunta a Spotify (/me)
+    si la sesión no lo trae, una vez por token"""
+    usuario_id = usuario_verificado()
+    if usuario_id is None:
+        usuario_id = sp.current_user()["id"]
+        gestor_tokens.vincular(session["token_info"], usuario_id)
+    if session.get("usuario_id") != usuario_id:
+        session["usuario_id"] = usuario_id
+    return usuario_id
+
+# ----------------- CACHE DE METADATOS -----------------
+
+REDIS_URL = os.getenv("REDIS_URL")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "playlists.db")
+CACHE_METADATOS_TAMANIO = int(os.getenv("CACHE_METADATOS_TAMANIO", 5000))
+CACHE_METADATOS_TTL = int(os.getenv("CACHE_METADATOS_TTL", 3600))
+
+def conectar_redis():
+    """Devuelve un cliente de Redis si REDIS_URL está configurado y responde"""
+    if not REDIS_URL or redis is None:
+        return None
+    try:
+        cliente = redis.Redis.from_url(REDIS_URL)
+        cliente.ping()
+        return cliente
+    except Exception as e:
+        print("Redis no disponible, se usa solo memoria:", e)
+        return None
+
+redis_cliente = conectar_redis()
+
+def conectar_sqlite(ruta):
+    """Conexión a SQLite en modo WAL (lectores y un escritor a la vez, entre procesos)"""
+    # isolation_level=None: las transacciones se abren a mano con BEGIN
+    conexion = sqlite3.connect(ruta, timeout=10, isolation_level=None, check_same_thread=False)
+    conexion.execute("PRAGMA journal_mode=WAL")
+    conexion.execute("PRAGMA synchronous=NORMAL")
+    return conexion
+
+# Todas las caches creadas, para poder consultar sus estadísticas
+caches = {}
+
+class CacheLRU:
+    """Cache con expiración (TTL) y desalojo LRU, con un segundo nivel opcional en Redis"""
+    def __init__(self, nombre, tamanio_max, ttl, redis_cliente=None):
+        self.nombre = nombre
+        self.tamanio_max = tamanio_max
+        self.ttl = ttl
+        self.redis = redis_cliente
+        self.datos = OrderedDict()  # clave -> (expira, valor)
+        self.lock = threading.Lock()
+        self.aciertos = 0
+        self.aciertos_redis = 0
+        self.fallos = 0
+        self.desalojos = 0
+        caches[nombre] = self
+
+    def _clave_redis(self, clave):
+        return f"cache:{self.nombre}:{clave}"
+
+    def _guardar_local(self, clave, valor):
+        with self.lock:
+            self.datos[clave] = (time.monotonic() + self.ttl, valor)
+            self.datos.move_to_end(clave)
+            while len(self.datos) > self.tamanio_max:
+                self.datos.popitem(last=False)
+                self.desalojos += 1
+
+    def _obtener_local(self, clave):
+        entrada = self.datos.get(clave)
+        if entrada is None:
+            return None
+        if entrada[0] <= time.monotonic():
+            del self.datos[clave]
+            return None
+        self.datos.move_to_end(clave)
+        return entrada
+
+    def obtener_muchos(self, claves):
+        """Devuelve {clave: valor} solo con las claves que están en cache"""
+        claves = list(dict.fromkeys(claves))
+        encontrados = {}
+        pendientes = []
+        with self.lock:
+            for clave in claves:
+                entrada = self._obtener_local(clave)
+                if entrada is None:
+                    pendientes.append(clave)
+                else:
+                    encontrados[clave] = entrada[1]
+            self.aciertos += len(encontrados)
+
+        if pendientes and self.redis is not None:
+            try:
+                crudos = self.redis.mget([self._clave_redis(c) for c in pendientes])
+            except Exception as e:
+                print(f"Error leyendo la cache {self.nombre} de Redis:", e)
+                crudos = [None] * len(pendientes)
+            for clave, crudo in zip(pendientes, crudos):
+                if crudo is not None:
+                    valor = json.loads(crudo)
+                    self._guardar_local(clave, valor)
+                    encontrados[clave] = valor
+                    with self.lock:
+                        self.aciertos += 1
+                        self.aciertos_redis += 1
+
+        with self.lock:
+            self.fallos += len(claves) - len(encontrados)
+        registrar_cache(self.nombre, len(encontrados), len(claves) - len(encontrados))
+        return encontrados
+
+    def obtener(self, clave):
+        return self.obtener_muchos([clave]).get(clave)
+
+    def guardar_muchos(self, valores):
+        for clave, valor in valores.items():
+            self._guardar_local(clave, valor)
+        if valores and self.redis is not None:
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                for clave, valor in valores.items():
+                    pipe.setex(self._clave_redis(clave), self.ttl, json.dumps(valor))
+                pipe.execute()
+            except Exception as e:
+                print(f"Error escribiendo la cache {self.nombre} en Redis:", e)
+
+    def guardar(self, clave, valor):
+        self.guardar_muchos({clave: valor})
+
+    def obtener_o_cargar(self, clave, cargar):
+        """Lee de la cache y, si no está, llama a cargar() y guarda el resultado"""
+        valor = self.obtener(clave)
+        if valor is None:
+            valor = cargar()
+            if valor is not None:
+                self.guardar(clave, valor)
+        return valor
+
+    def version(self, clave):
+        """Cambia cada vez que se guarda la clave; None si no está (vigente) en la memoria local"""
+        with self.lock:
+            entrada = self.datos.get(clave)
+        return entrada[0] if entrada and entrada[0] > time.monotonic() else None
+
+    def invalidar(self, clave):
+        with self.lock:
+            self.datos.pop(clave, None)
+        if self.redis is not None:
+            try:
+                self.redis.delete(self._clave_redis(clave))
+            except Exception as e:
+                print(f"Error invalidando la cache {self.nombre} en Redis:", e)
+
+    def estadisticas(self):
+        with self.lock:
+            consultas = self.aciertos + self.fallos
+            return {
+                "entradas": len(self.datos),
+                "tamanio_max": self.tamanio_max,
+                "ttl": self.ttl,
+                "aciertos": self.aciertos,
+                "aciertos_redis": self.aciertos_redis,
+                "fallos": self.fallos,
+                "desalojos": self.desalojos,
+                "tasa_aciertos": round(self.aciertos / consultas, 3) if consultas else None,
+                "redis": self.redis is not None
+            }
+
+class Vuelo:
+    """Una consulta en curso a la que se pueden unir otras peticiones"""
+    def __init__(self):
+        self.evento = threading.Event()
+        self.valor = None
+        self.error = None
+
+class CacheCoalescente:
+    """Cache de vida muy corta: las llamadas concurrentes a la misma clave comparten una sola consulta"""
+    def __init__(self, nombre, ttl):
+        self.nombre = nombre
+        self.ttl = ttl
+        self.datos = {}  # clave -> (expira, valor)
+        self.en_curso = {}  # clave -> Vuelo
+        self.generaciones = {}  # clave -> contador, para descartar consultas anteriores a una invalidación
+        self.lock = threading.Lock()
+        self.aciertos = 0
+        self.coalescidas = 0
+        self.consultas = 0
+        caches[nombre] = self
+
+    def obtener(self, clave, cargar):
+        with self.lock:
+            entrada = self.datos.get(clave)
+            if entrada and entrada[0] > time.monotonic():
+                self.aciertos += 1
+                registrar_cache(self.nombre, 1, 0)
+                return entrada[1]
+            vuelo = self.en_curso.get(clave)
+            lider = vuelo is None
+            if lider:
+                vuelo = self.en_curso[clave] = Vuelo()
+                generacion = self.generaciones.get(clave, 0)
+                self.consultas += 1
+            else:
+                self.coalescidas += 1
+        # Unirse a una consulta en curso cuenta como acierto: no llama a Spotify
+        registrar_cache(self.nombre, 0 if lider else 1, 1 if lider else 0)
+
+        if not lider:
+            vuelo.evento.wait()
+            if vuelo.error is not None:
+                raise vuelo.error
+            return vuelo.valor
+
+        try:
+            vuelo.valor = cargar()
+        except Exception as e:
+            vuelo.error = e
+            raise
+        finally:
+            with self.lock:
+                if self.en_curso.get(clave) is vuelo:
+                    del self.en_curso[clave]
+                if vuelo.error is None and self.generaciones.get(clave, 0) == generacion:
+                    self.datos[clave] = (time.monotonic() + self.ttl, vuelo.valor)
+            vuelo.evento.set()
+        return vuelo.valor
+
+    def invalidar(self, clave):
+        """Las siguientes lecturas van a Spotify aunque haya una consulta en curso"""
+        with self.lock:
+            self.datos.pop(clave, None)
+            self.en_curso.pop(clave, None)
+            self.generaciones[clave] = self.generaciones.get(clave, 0) + 1
+
+    def estadisticas(self):
+        with self.lock:
+            return {
+                "entradas": len(self.datos),
+                "ttl": self.ttl,
+                "aciertos": self.aciertos,
+                "coalescidas": self.coalescidas,
+                "consultas": self.consultas
+            }
+
+RENOVACION_REINTENTO_SEG = 60  # espera tras una renovación fallida antes de intentar otra
+RENOVACION_CERROJO_SEG = 30
+
+class CacheRenovable:
+    """Cache stale-while-revalidate: pasado el TTL sigue sirviendo el valor mientras lo renueva en segundo plano.
+
+    Solo se bloquea en una clave que nunca se cargó o que lleva vencida más de `ttl_vencido`.
+    Con Redis, los workers comparten el valor y un cerrojo para que solo uno lo renueve.
+    """
+    def __init__(self, nombre, ttl, ttl_vencido, redis_cliente=None):
+        self.nombre = nombre
+        self.ttl = ttl
+        self.ttl_vencido = ttl_vencido
+        self.redis = redis_cliente
+        self.datos = {}  # clave -> (guardado, valor); `guardado` es time.time() para compararlo entre procesos
+        self.renovando = set()
+        self.reintentar_desde = {}  # clave -> time.monotonic()
+        self.lock = threading.Lock()
+        self.aciertos = 0
+        self.vencidos = 0
+        self.fallos = 0
+        self.renovaciones = 0
+        self.errores_renovacion = 0
+        self.ultimo_error = None
+        caches[nombre] = self
+
+    def _clave_redis(self, clave):
+        return f"cache:{self.nombre}:{clave}"
+
+    def _leer(self, clave):
+        with self.lock:
+            entrada = self.datos.get(clave)
+        if self.redis is None or (entrada and time.time() - entrada[0] <= self.ttl):
+            return entrada
+        # Otro worker pudo haberla renovado ya
+        try:
+            crudo = self.redis.get(self._clave_redis(clave))
+        except Exception as e:
+            print(f"Error leyendo la cache {self.nombre} de Redis:", e)
+            return entrada
+        if crudo is not None:
+            compartida = json.loads(crudo)
+            if entrada is None or compartida["guardado"] > entrada[0]:
+                entrada = (compartida["guardado"], compartida["valor"])
+                with self.lock:
+                    self.datos[clave] = entrada
+        return entrada
+
+    def _guardar(self, clave, valor):
+        guardado = time.time()
+        with self.lock:
+            self.datos[clave] = (guardado, valor)
+        if self.redis is not None:
+            try:
+                self.redis.setex(self._clave_redis(clave), self.ttl + self.ttl_vencido,
+                                 json.dumps({"guardado": guardado, "valor": valor}))
+            except Exception as e:
+                print(f"Error escribiendo la cache {self.nombre} en Redis:", e)
+
+    def obtener(self, clave, cargar):
+        entrada = self._leer(clave)
+        edad = time.time() - entrada[0] if entrada else None
+        if entrada is None or edad > self.ttl + self.ttl_vencido:
+            with self.lock:
+                self.fallos += 1
+            registrar_cache(self.nombre, 0, 1)
+            valor = cargar()
+            self._guardar(clave, valor)
+            return valor
+        if edad > self.ttl:
+            with self.lock:
+                self.vencidos += 1
+            self._renovar_en_segundo_plano(clave, cargar)
+        else:
+            with self.lock:
+                self.aciertos += 1
+        registrar_cache(self.nombre, 1, 0)
+        return entrada[1]
+
+    def version(self, clave):
+        """Momento en que se guardó el valor local de la clave (None si no hay)"""
+        with self.lock:
+            entrada = self.datos.get(clave)
+        return entrada[0] if entrada else None
+
+    def _renovar_en_segundo_plano(self, clave, cargar):
+        with self.lock:
+            if clave in self.renovando or time.monotonic() < self.reintentar_desde.get(clave, 0):
+                return
+            self.renovando.add(clave)
+        pool_spotify.submit(self._renovar, clave, cargar)
+
+    def _renovar(self, clave, cargar):
+        cerrojo = self._clave_redis(clave) + ":renovando"
+        try:
+            if self.redis is not None and not self.redis.set(cerrojo, 1, nx=True, ex=RENOVACION_CERROJO_SEG):
+                # La está renovando otro worker; se vuelve a mirar Redis en la próxima lectura
+                with self.lock:
+                    self.reintentar_desde[clave] = time.monotonic() + RENOVACION_CERROJO_SEG
+                return
+            try:
+                self._guardar(clave, cargar())
+            finally:
+                if self.redis is not None:
+                    self.redis.delete(cerrojo)
+            with self.lock:
+                self.renovaciones += 1
+        except Exception as e:
+            print(f"Error renovando {clave} en la cache {self.nombre}:", e)
+            with self.lock:
+                self.errores_renovacion += 1
+                self.ultimo_error = str(e)
+                self.reintentar_desde[clave] = time.monotonic() + RENOVACION_REINTENTO_SEG
+        finally:
+            with self.lock:
+                self.renovando.discard(clave)
+
+    def estadisticas(self):
+        ahora = time.time()
+        with self.lock:
+            return {
+                "entradas": len(self.datos),
+                "ttl": self.ttl,
+                "ttl_vencido": self.ttl_vencido,
+                "edad_seg": {clave: round(ahora - guardado, 1) for clave, (guardado, _) in self.datos.items()},
+                "aciertos": self.aciertos,
+                "vencidos_servidos": self.vencidos,
+                "fallos": self.fallos,
+                "renovaciones": self.renovaciones,
+                "errores_renovacion": self.errores_renovacion,
+                "ultimo_error": self.ultimo_error,
+                "redis": self.redis is not None
+            }
+
+# Tracks, álbumes y playlists por ID de Spotify, compartidos por todas las rutas
+cache_metadatos = CacheLRU("metadatos", CACHE_METADATOS_TAMANIO, CACHE_METADATOS_TTL, redis_cliente)
+
+# Estado de reproducción por usuario (current_playback); se invalida con cada acción de control
+ESTADO_REPRODUCCION_TTL = float(os.getenv("ESTADO_REPRODUCCION_TTL", 0.75))
+estado_reproduccion = CacheCoalescente("estado_reproduccion", ESTADO_REPRODUCCION_TTL)
+
+def obtener_estado_reproduccion(sp, usuario_id):
+    def cargar():
+        playback = sp.current_playback()
+        # Cada consulta de estado dice gratis en qué dispositivo está sonando
+        if playback and playback.get("device") and playback["device"].get("id"):
+            registro_dispositivos.recordar(usuario_id, playback["device"]["id"])
+        if playback and playback.get("item"):
+            indice_tracks.agregar_tracks([playback["item"]], usuario_id=usuario_id)
+        return playback
+    return estado_reproduccion.obtener(usuario_id, cargar)
+
+def sin_mercados(objeto):
+    """Quita la lista de mercados, que es lo que más ocupa y no se usa"""
+    objeto = {k: v for k, v in objeto.items() if k != "available_markets"}
+    if isinstance(objeto.get("album"), dict):
+        objeto["album"] = {k: v for k, v in objeto["album"].items() if k != "available_markets"}
+    return objeto
+
+# Nuevos lanzamientos: iguales para todos los usuarios y cambian pocas veces al día
+LANZAMIENTOS_TTL = int(os.getenv("LANZAMIENTOS_TTL", 3600))
+LANZAMIENTOS_VENCIDO_SEG = int(os.getenv("LANZAMIENTOS_VENCIDO_SEG", 86400))
+cache_lanzamientos = CacheRenovable("lanzamientos", LANZAMIENTOS_TTL, LANZAMIENTOS_VENCIDO_SEG, redis_cliente)
+
+def obtener_lanzamientos(sp, pais="ES", limite=10):
+    def cargar():
+        # La renovación corre en segundo plano: mejor con las credenciales de la app que con el token del usuario
+        cliente = cliente_de_la_app() or sp
+        with prioridad_spotify(PRIORIDAD_BAJA):
+            respuesta = cliente.new_releases(limit=limite, country=pais)
+        indice_tracks.agregar_albumes(respuesta["albums"]["items"])
+        return [sin_mercados(album) for album in respuesta["albums"]["items"]]
+    return cache_lanzamientos.obtener(f"{pais}:{limite}", cargar)
+
+# Canciones de cada álbum: no cambian, así que se guardan más tiempo y en una cache propia
+ALBUMES_TAMANIO = int(os.getenv("ALBUMES_TAMANIO", 1000))
+ALBUMES_TTL = int(os.getenv("ALBUMES_TTL", 7 * 86400))
+ALBUM_TRACKS_POR_PAGINA = 50  # máximo que acepta album_tracks
+cache_albumes = CacheLRU("albumes", ALBUMES_TAMANIO, ALBUMES_TTL, redis_cliente)
+
+def obtener_album_tracks(sp, album_id):
+    """Nombre y todas las canciones del álbum (id, nombre, URI, artista y duración), no solo la primera página"""
+    def cargar():
+        # sp.album trae el nombre y la primera página de canciones en la misma llamada
+        album = sp.album(album_id)
+        primera = album["tracks"]
+        paginas = recorrer_paginas(
+            primera,
+            lambda offset: sp.album_tracks(album_id, limit=ALBUM_TRACKS_POR_PAGINA, offset=offset),
+            primera["limit"])
+        tracks = [track for pagina in paginas for track in pagina["items"]]
+        indice_tracks.agregar_tracks(tracks, album)
+        items = [{"id": track["id"], "name": track["name"], "uri": track["uri"],
+                  "artist": track["artists"][0]["name"] if track["artists"] else "",
+                  "duration_ms": track["duration_ms"]}
+                 for track in tracks]
+        return {"name": album["name"], "items": items, "total": primera["total"]}
+    return cache_albumes.obtener_o_cargar(album_id, cargar)
+
+# Cabeceras por usuario: que esté la suya significa que Spotify ya le dejó ver la playlist
+CABECERAS_PLAYLIST_TTL = int(os.getenv("CABECERAS_PLAYLIST_TTL", 300))
+cache_cabeceras_playlist = CacheLRU("cabeceras_playlist", CACHE_METADATOS_TAMANIO, CABECERAS_PLAYLIST_TTL,
+                                    redis_cliente)
+
+def obtener_playlist(sp, playlist_id, usuario_id, renovar=False):
+    """Solo la cabecera de la playlist; las canciones se piden por páginas.
+
+    Se pide con el token del usuario, así Spotify decide si puede verla (privadas,
+    colaborativas), y su snapshot_id dice qué páginas cacheadas siguen valiendo.
+    Las páginas siguientes usan la del usuario guardada unos minutos; renovar=True
+    (al abrir la playlist) la pide siempre.
+    """
+    clave = f"{usuario_id}:{playlist_id}"
+    if not renovar:
+        cabecera = cache_cabeceras_playlist.obtener(clave)
+        if cabecera is not None:
+            return cabecera
+    cabecera = sp.playlist(playlist_id, fields="id,name,images,snapshot_id,tracks(total)")
+    cache_cabeceras_playlist.guardar(clave, cabecera)
+    return cabecera
+
+# Solo los campos que se muestran: sin available_markets ni el resto del objeto track
+CAMPOS_PAGINA_PLAYLIST = "items(track(id,name,uri,duration_ms,artists(name),album(name,images))),offset,limit,total"
+PAGINA_PLAYLIST_MAX = 100  # máximo que acepta playlist_items
+PAGINAS_EN_VUELO = int(os.getenv("PAGINAS_EN_VUELO", 4))
+
+# Páginas que se están precargando, para no pedir dos veces la misma
+precargas = {}
+precargas_lock = threading.Lock()
+
+def clave_pagina_playlist(playlist_id, snapshot_id, offset, limit):
+    # Con el snapshot_id en la clave, editar la playlist deja atrás las páginas viejas
+    return f"playlist:{playlist_id}:{snapshot_id}:{offset}:{limit}"
+
+def cargar_pagina_playlist(sp, playlist_id, snapshot_id, offset, limit):
+    def cargar():
+        return sp.playlist_items(playlist_id, fields=CAMPOS_PAGINA_PLAYLIST,
+                                 limit=limit, offset=offset, additional_types=("track",))
+    return cache_metadatos.obtener_o_cargar(clave_pagina_playlist(playlist_id, snapshot_id, offset, limit), cargar)
+
+def indexar_pagina_playlist(pagina, usuario_id):
+    """Al índice de búsqueda, solo para quien la está viendo (la página puede venir de la cache de otro)"""
+    indice_tracks.agregar_tracks((item.get("track") for item in pagina["items"]), usuario_id=usuario_id)
+
+def obtener_pagina_playlist(sp, playlist_id, snapshot_id, offset, limit=PAGINA_PLAYLIST_MAX):
+    """Página de canciones de la versión `snapshot_id` de la playlist (ver obtener_playlist);
+    si se está precargando, espera a esa petición"""
+    with precargas_lock:
+        futuro = precargas.get(clave_pagina_playlist(playlist_id, snapshot_id, offset, limit))
+    if futuro is not None:
+        try:
+            return futuro.result()
+        except Exception:
+            pass  # la precarga falló; se intenta de nuevo abajo
+    return cargar_pagina_playlist(sp, playlist_id, snapshot_id, offset, limit)
+
+def precargar_pagina_playlist(sp, playlist_id, snapshot_id, offset, limit=PAGINA_PLAYLIST_MAX):
+    """Pide en segundo plano la página que probablemente se pida después"""
+    clave = clave_pagina_playlist(playlist_id, snapshot_id, offset, limit)
+    with precargas_lock:
+        if clave in precargas or cache_metadatos.obtener(clave) is not None:
+            return
+
+        def cargar():
+            try:
+                return cargar_pagina_playlist(sp, playlist_id, snapshot_id, offset, limit)
+            finally:
+                with precargas_lock:
+                    precargas.pop(clave, None)
+        precargas[clave] = pool_spotify.submit(cargar)
+
+def recorrer_paginas(primera, cargar, limite, en_vuelo=PAGINAS_EN_VUELO):
+    """Genera `primera` y las páginas que siguen, pidiendo hasta `en_vuelo` por adelantado en paralelo"""
+    yield primera
+    total = primera["total"]
+    siguiente = primera["offset"] + limite
+    pendientes = deque()
+    try:
+        while pendientes or siguiente < total:
+            while siguiente < total and len(pendientes) < en_vuelo:
+                pendientes.append(pool_spotify.submit(cargar, siguiente))
+                siguiente += limite
+            yield pendientes.popleft().result()
+    finally:
+        # Si el cliente se desconecta no tiene sentido terminar de pedir el resto
+        for futuro in pendientes:
+            futuro.cancel()
+
+def item_playlist(item):
+    """Canción de una página de playlist_items en el formato de la API; None para locales o no disponibles"""
+    track = item.get("track")
+    if not track or not track.get("id"):
+        return None
+    return {
+        "id": track["id"],
+        "name": track["name"],
+        "artist": track["artists"][0]["name"] if track["artists"] else "",
+        "album": track["album"]["name"],
+        "image": track["album"]["images"][0]["url"] if track["album"]["images"] else None,
+        "uri": track["uri"]
+    }
+
+def items_de_pagina(pagina):
+    return [cancion for cancion in map(item_playlist, pagina["items"]) if cancion]
+
+def mapear_acotado(funcion, elementos, en_vuelo):
+    """Como pool_spotify.map, pero con a lo sumo `en_vuelo` tareas a la vez para no acaparar el pool"""
+    pendientes = deque()
+    try:
+        for elemento in elementos:
+            if len(pendientes) >= en_vuelo:
+                yield pendientes.popleft().result()
+            pendientes.append(pool_spotify.submit(funcion, elemento))
+        while pendientes:
+            yield pendientes.popleft().result()
+    finally:
+        for futuro in pendientes:
+            futuro.cancel()
+
+# Resultado de buscar (título, artista) en Spotify; {"uri": None} si no hubo resultados
+BUSQUEDAS_TAMANIO = int(os.getenv("BUSQUEDAS_TAMANIO", 10000))
+BUSQUEDAS_TTL = int(os.getenv("BUSQUEDAS_TTL", 7 * 86400))
+cache_busquedas = CacheLRU("busquedas", BUSQUEDAS_TAMANIO, BUSQUEDAS_TTL, redis_cliente)
+
+def normalizar(texto):
+    """Sin mayúsculas, tildes ni espacios de más"""
+    if texto.isascii():
+        return " ".join(texto.casefold().split())
+    texto = unicodedata.normalize("NFKD", texto.casefold())
+    return " ".join("".join(c for c in texto if not unicodedata.combining(c)).split())
+
+def clave_busqueda(titulo, artista):
+    """Misma clave para 'Juliana', 'DLG' y ' juliana ', 'Dlg'"""
+    return normalizar(f"{titulo}|{artista}")
+
+def track_resuelto(track):
+    return {
+        "name": track["name"],
+        "artist": track["artists"][0]["name"],
+        "album": track["album"]["name"],
+        "image": track["album"]["images"][0]["url"] if track["album"]["images"] else None,
+        "uri": track["uri"]
+    }
+
+def buscar_track(sp, titulo, artista):
+    def cargar():
+        items = sp.search(q=f"{titulo} {artista}", type="track", limit=1)["tracks"]["items"]
+        indice_tracks.agregar_tracks(items)
+        return track_resuelto(items[0]) if items else {"uri": None}
+    return cache_busquedas.obtener_o_cargar(clave_busqueda(titulo, artista), cargar)
+
+@app.route("/api/cache/stats")
+def estadisticas_cache():
+    return jsonify({nombre: cache.estadisticas() for nombre, cache in caches.items()})
+
+@app.route("/api/spotify/stats")
+def estadisticas_spotify():
+    return jsonify(limitador_spotify.estadisticas())
+
+# ----------------- BÚSQUEDA LOCAL -----------------
+# Índice invertido en memoria de todo lo que la app ya vio de Spotify (favoritos,
+# playlists, álbumes, lanzamientos, búsquedas y lo que está sonando): palabras
+# ordenadas para buscar por prefijo y trigramas para tolerar errores de tipeo.
+# Se guarda cada tanto en un snapshot JSON-lines comprimido para arrancar en caliente.
+# Lo que sale de favoritos, playlists o de lo que está sonando solo lo encuentran los
+# usuarios que lo vieron ahí; lanzamientos, álbumes y búsquedas son de todos.
+
+INDICE_RUTA = os.getenv("INDICE_RUTA", "indice_tracks.jsonl.gz")  # vacío: sin snapshot
+INDICE_MAX = int(os.getenv("INDICE_MAX", 200000))
+INDICE_GUARDAR_SEG = int(os.getenv("INDICE_GUARDAR_SEG", 300))
+PREFIJO_MIN = 2  # una sola letra solo coincide con palabras exactas
+PALABRAS_POR_PREFIJO = 200
+SIMILITUD_MIN = 0.4  # Dice de trigramas para aceptar una palabra con errores ("noche" ~ "nxche")
+PESO_CAMPO = {"name": 1.0, "artist": 0.8, "album": 0.5}
+PESO_EXACTA, PESO_PREFIJO, PESO_SIMILAR = 1.0, 0.8, 0.6
+FORMATO_INDICE = 2  # primera línea del snapshot; los de antes no decían de quién era cada entrada
+
+def palabras(texto):
+    return normalizar(texto).replace("|", " ").split()
+
+def trigramas(palabra):
+    relleno = f" {palabra} "
+    return {relleno[i:i + 3] for i in range(len(relleno) - 2)}
+
+class IndiceTracks:
+    """Índice de búsqueda por prefijo y trigramas sobre los tracks (y álbumes) vistos"""
+    def __init__(self, tamanio_max):
+        self.tamanio_max = tamanio_max
+        self.docs = OrderedDict()  # número -> entrada, de la más vieja a la más reciente
+        self.por_uri = {}  # uri -> número
+        self.vistas = {}  # número -> veces que se vio, para desempatar
+        self.usuarios = {}  # número -> usuarios que pueden encontrarlo; sin entrada, es de todos
+        self.postings = {}  # palabra -> {número: peso del campo}
+        self.vocabulario = []  # palabras ordenadas, para buscar por prefijo con bisect
+        self.trigramas = {}  # trigrama -> palabras que lo contienen
+        self.siguiente = 0
+        self.modificado = False
+        self.lock = threading.Lock()
+        self.busquedas = 0
+
+    def _palabras_doc(self, entrada):
+        pesos = {}
+        for campo, peso in PESO_CAMPO.items():
+            for palabra in palabras(entrada.get(campo) or ""):
+                pesos[palabra] = max(peso, pesos.get(palabra, 0))
+        return pesos
+
+    def _agregar_palabra(self, palabra):
+        bisect.insort(self.vocabulario, palabra)
+        for trigrama in trigramas(palabra):
+            self.trigramas.setdefault(trigrama, set()).add(palabra)
+
+    def _quitar_palabra(self, palabra):
+        del self.postings[palabra]
+        del self.vocabulario[bisect.bisect_left(self.vocabulario, palabra)]
+        for trigrama in trigramas(palabra):
+            palabras_trigrama = self.trigramas[trigrama]
+            palabras_trigrama.discard(palabra)
+            if not palabras_trigrama:
+                del self.trigramas[trigrama]
+
+    def _quitar(self, numero):
+        entrada = self.docs.pop(numero)
+        del self.por_uri[entrada["uri"]]
+        del self.vistas[numero]
+        self.usuarios.pop(numero, None)
+        for palabra in self._palabras_doc(entrada):
+            self.postings[palabra].pop(numero, None)
+            if not self.postings[palabra]:
+                self._quitar_palabra(palabra)
+
+    def _agregar(self, entrada, vistas=1, modifica=True, usuarios=None):
+        """`usuarios`: quiénes pueden encontrarla, o None si es pública"""
+        numero = self.por_uri.get(entrada["uri"])
+        if numero is not None:
+            self.vistas[numero] += vistas
+            self.docs.move_to_end(numero)
+            privada = self.usuarios.get(numero)
+            if privada is not None and (usuarios is None or not privada.issuperset(usuarios)):
+                if usuarios is None:
+                    del self.usuarios[numero]
+                else:
+                    privada.update(usuarios)
+                self.modificado = self.modificado or modifica
+            return
+        numero = self.siguiente
+        self.siguiente += 1
+        self.docs[numero] = entrada
+        self.por_uri[entrada["uri"]] = numero
+        self.vistas[numero] = vistas
+        if usuarios is not None:
+            self.usuarios[numero] = set(usuarios)
+        for palabra, peso in self._palabras_doc(entrada).items():
+            if palabra not in self.postings:
+                self.postings[palabra] = {}
+                self._agregar_palabra(palabra)
+            self.postings[palabra][numero] = peso
+        self.modificado = self.modificado or modifica
+        while len(self.docs) > self.tamanio_max:
+            self._quitar(next(iter(self.docs)))
+
+    def agregar(self, entradas, usuario_id=None):
+        """Con `usuario_id`, las entradas nuevas solo las encuentra ese usuario"""
+        usuarios = None if usuario_id is None else (usuario_id,)
+        with self.lock:
+            for entrada in entradas:
+                if entrada.get("uri") and entrada.get("name"):
+                    self._agregar(entrada, usuarios=usuarios)
+
+    def agregar_tracks(self, tracks, album=None, usuario_id=None):
+        """Tracks de la API de Spotify; `album` para los de album_tracks, que no traen el suyo"""
+        entradas = []
+        for track in tracks:
+            if not track or not track.get("uri"):
+                continue
+            album_track = track.get("album") or album or {}
+            entradas.append({
+                "tipo": "track",
+                "name": track["name"],
+                "artist": track["artists"][0]["name"] if track.get("artists") else "",
+                "album": album_track.get("name", ""),
+                "image": album_track["images"][0]["url"] if album_track.get("images") else None,
+                "uri": track["uri"],
+                "duration_ms": track.get("duration_ms")
+            })
+        self.agregar(entradas, usuario_id)
+
+    def agregar_albumes(self, albumes):
+        self.agregar({
+            "tipo": "album",
+            "name": album["name"],
+            "artist": album["artists"][0]["name"] if album.get("artists") else "",
+            "album": album["name"],
+            "image": album["images"][0]["url"] if album.get("images") else None,
+            "uri": album["uri"]
+        } for album in albumes)
+
+    def _coincidencias(self, token):
+        """{palabra del vocabulario: peso} para un término de la consulta"""
+        coincidencias = {}
+        if token in self.postings:
+            coincidencias[token] = PESO_EXACTA
+        if len(token) >= PREFIJO_MIN:
+            inicio = bisect.bisect_left(self.vocabulario, token)
+            for palabra in self.vocabulario[inicio:inicio + PALABRAS_POR_PREFIJO]:
+                if not palabra.startswith(token):
+                    break
+                coincidencias.setdefault(palabra, PESO_PREFIJO)
+        if not coincidencias and len(token) >= 4:
+            propios = trigramas(token)
+            compartidos = {}
+            for trigrama in propios:
+                for palabra in self.trigramas.get(trigrama, ()):
+                    compartidos[palabra] = compartidos.get(palabra, 0) + 1
+            for palabra, comunes in compartidos.items():
+                similitud = 2 * comunes / (len(propios) + len(trigramas(palabra)))
+                if similitud >= SIMILITUD_MIN:
+                    coincidencias[palabra] = PESO_SIMILAR * similitud
+        return coincidencias
+
+    def buscar(self, consulta, limite=10, tipo=None, usuario_id=None):
+        """Entradas públicas o vistas por `usuario_id` que coinciden con todos los términos, de mejor a peor"""
+        terminos = palabras(consulta)
+        if not terminos:
+            return []
+        with self.lock:
+            self.busquedas += 1
+            # Del término más raro al más común: los siguientes solo miran a los candidatos
+            coincidencias = sorted(
+                (self._coincidencias(termino) for termino in terminos),
+                key=lambda palabras_termino: sum(len(self.postings[palabra]) for palabra in palabras_termino))
+            puntajes = None
+            for palabras_termino in coincidencias:
+                listas = [(peso, self.postings[palabra]) for palabra, peso in palabras_termino.items()]
+                if puntajes is None or sum(map(len, (lista for _, lista in listas))) < len(puntajes) * len(listas):
+                    del_termino = {}
+                    for peso, lista in listas:
+                        for numero, peso_campo in lista.items():
+                            puntaje = peso * peso_campo
+                            if puntaje > del_termino.get(numero, 0):
+                                del_termino[numero] = puntaje
+                    if puntajes is not None:
+                        del_termino = {numero: puntaje + del_termino[numero]
+                                       for numero, puntaje in puntajes.items() if numero in del_termino}
+                else:
+                    del_termino = {}
+                    for numero, puntaje in puntajes.items():
+                        mejor = max(peso * lista.get(numero, 0) for peso, lista in listas)
+                        if mejor:
+                            del_termino[numero] = puntaje + mejor
+                puntajes = del_termino
+                if not puntajes:
+                    return []
+            if tipo:
+                puntajes = {numero: puntaje for numero, puntaje in puntajes.items()
+                            if self.docs[numero]["tipo"] == tipo}
+            if self.usuarios:
+                puntajes = {numero: puntaje for numero, puntaje in puntajes.items()
+                            if numero not in self.usuarios or usuario_id in self.usuarios[numero]}
+            mejores = sorted(puntajes, key=lambda numero: (-puntajes[numero], -self.vistas[numero]))[:limite]
+            return [dict(self.docs[numero], puntaje=round(puntajes[numero], 3)) for numero in mejores]
+
+    def guardar(self, ruta):
+        """Snapshot JSON-lines comprimido; se escribe aparte y se reemplaza de una vez"""
+        with self.lock:
+            if not self.modificado:
+                return
+            lineas = [json.dumps({"formato": FORMATO_INDICE})]
+            for numero, entrada in self.docs.items():
+                linea = [self.vistas[numero], entrada]
+                if numero in self.usuarios:
+                    linea.append(sorted(self.usuarios[numero]))
+                lineas.append(json.dumps(linea, ensure_ascii=False, separators=(",", ":")))
+            self.modificado = False
+        temporal = f"{ruta}.{os.getpid()}.tmp"
+        with gzip.open(temporal, "wt", encoding="utf-8", compresslevel=6) as archivo:
+            archivo.write("\n".join(lineas))
+        os.replace(temporal, ruta)
+
+    def cargar(self, ruta, lote=1000):
+        """Carga el snapshot de a lotes para no frenar las búsquedas mientras tanto"""
+        if not os.path.exists(ruta):
+            return
+        with gzip.open(ruta, "rt", encoding="utf-8") as archivo:
+            cabecera = json.loads(archivo.readline() or "null")
+            if not isinstance(cabecera, dict) or cabecera.get("formato") != FORMATO_INDICE:
+                print("Snapshot del índice de búsqueda de un formato anterior: se descarta")
+                return
+            while True:
+                lineas = [json.loads(linea) for linea in itertools.islice(archivo, lote)]
+                if not lineas:
+                    break
+                with self.lock:
+                    for vistas, entrada, *usuarios in lineas:
+                        self._agregar(entrada, vistas, modifica=False, usuarios=usuarios[0] if usuarios else None)
+                time.sleep(0)  # con gevent es un greenlet: deja pasar a las peticiones entre lotes
+
+    def estadisticas(self):
+        with self.lock:
+            return {
+                "entradas": len(self.docs),
+                "palabras": len(self.vocabulario),
+                "trigramas": len(self.trigramas),
+                "privadas": len(self.usuarios),
+                "busquedas": self.busquedas
+            }
+
+indice_tracks = IndiceTracks(INDICE_MAX)
+
+def guardar_indice():
+    try:
+        indice_tracks.guardar(INDICE_RUTA)
+    except Exception as e:
+        print("Error guardando el índice de búsqueda:", e)
+
+def mantener_indice():
+    """Arranque en caliente desde el snapshot y después guardado periódico"""
+    try:
+        indice_tracks.cargar(INDICE_RUTA)
+    except Exception as e:
+        print("No se pudo cargar el índice de búsqueda, se empieza vacío:", e)
+    while True:
+        time.sleep(INDICE_GUARDAR_SEG)
+        guardar_indice()
+
+if INDICE_RUTA:
+    threading.Thread(target=mantener_indice, name="indice-tracks", daemon=True).start()
+    atexit.register(guardar_indice)
+
+BUSQUEDA_LOCAL_MAX = 50
+
+@app.route("/api/search/local")
+def busqueda_local():
+    """Coincidencias del índice local; solo si no hay ninguna se pregunta a Spotify"""
+    sp = get_spotify()
+    if not sp:
+        return jsonify({"error": "No autenticado"}), 401
+    usuario_id = get_usuario_id(sp)
+
+    consulta = request.args.get("q", "").strip()
+    limite = min(max(request.args.get("limit", 10, type=int), 1), BUSQUEDA_LOCAL_MAX)
+    tipo = request.args.get("tipo")
+    if not consulta:
+        return jsonify({"resultados": [], "fuente": "local"})
+
+    resultados = indice_tracks.buscar(consulta, limite, tipo, usuario_id)
+    if resultados or tipo == "album":
+        return jsonify({"resultados": resultados, "fuente": "local"})
+
+    try:
+        items = sp.search(q=consulta, type="track", limit=limite)["tracks"]["items"]
+    except LimiteSpotify:
+        raise
+    except Exception as e:
+        print("Error buscando en Spotify:", e)
+        return jsonify({"resultados": [], "fuente": "local"})
+    indice_tracks.agregar_tracks(items)
+    return jsonify({"resultados": indice_tracks.buscar(consulta, limite, tipo, usuario_id), "fuente": "spotify"})
+
+# ----------------- FRAGMENTOS HTML -----------------
+# Las partes caras de las páginas (templates/parciales) se renderizan una vez por
+# versión de sus datos: la clave incluye la versión de la entrada de cache de la que
+# salen, o el contador de versión de los favoritos, así que cuando los datos cambian
+# la clave es otra y el HTML viejo simplemente sale por LRU.
+
+FRAGMENTOS_TAMANIO = int(os.getenv("FRAGMENTOS_TAMANIO", 500))
+FRAGMENTOS_TTL = int(os.getenv("FRAGMENTOS_TTL", 3600))
+cache_fragmentos = CacheLRU("fragmentos", FRAGMENTOS_TAMANIO, FRAGMENTOS_TTL)  # sin Redis: HTML grande y local
+
+def fragmento(clave, version, plantilla, contexto, completo=None):
+    """HTML de `plantilla` con contexto().
+
+    No se cachea con version None (datos recién cargados) ni si completo(contexto) dice
+    que faltan datos, p. ej. porque falló Spotify: se volvería a servir hasta que cambie la versión.
+    """
+    clave = f"{clave}:{version}"
+    if version is not None:
+        html = cache_fragmentos.obtener(clave)
+        if html is not None:
+            return Markup(html)
+    datos = contexto()
+    html = render_template(plantilla, **datos)
+    if version is not None and (completo is None or completo(datos)):
+        cache_fragmentos.guardar(clave, html)
+    return Markup(html)
+
+def precompilar_plantillas():
+    """Compila todas las plantillas al arrancar: la primera petición de cada worker no lo paga"""
+    for nombre in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(nombre)
+
+precompilar_plantillas()
 
 # ----------------- RUTAS PRINCIPALES -----------------
 
@@ -45,66 +1673,346 @@ def index():
     if not sp:
         return redirect("/login")
     
-    # Obtener lanzamientos recientes
+    # Obtener lanzamientos recientes; la versión se lee antes, por si se renuevan entretanto
+    version = cache_lanzamientos.version("ES:10")
     try:
-        new_releases = sp.new_releases(limit=10, country='ES')
-        lanzamientos = new_releases['albums']['items']
-    except:
+        lanzamientos = obtener_lanzamientos(sp, pais="ES", limite=10)
+    except LimiteSpotify:
+        raise
+    except Exception:
         lanzamientos = []
-    
-    return render_template("index.html", lanzamientos=lanzamientos)
+        version = None
+
+    lanzamientos_html = fragmento("lanzamientos:ES:10", version, "parciales/lanzamientos.html",
+                                  lambda: {"lanzamientos": lanzamientos})
+    return render_template("index.html", lanzamientos_html=lanzamientos_html)
 
 # ----------------- FAVORITOS -----------------
 
+ALMACEN_FAVORITOS = os.getenv("ALMACEN_FAVORITOS", "redis" if redis_cliente else "sqlite")  # memoria | sqlite | redis
+FAVORITOS_IMPORTAR_MAX = 10000
+
+class FavoritosMemoria:
+    """Favoritos en la memoria del proceso: un dict ordenado por usuario (pertenencia O(1))"""
+    persistente = False  # se pierden al reiniciar
+
+    def __init__(self):
+        self.favoritos = {}  # usuario -> {track_id: None}, en orden de agregado
+        self.versiones = {}
+        self.lock = threading.Lock()
+
+    def contiene(self, usuario_id, track_id):
+        return track_id in self.favoritos.get(usuario_id, ())
+
+    def listar(self, usuario_id):
+        with self.lock:
+            return list(self.favoritos.get(usuario_id, ()))
+
+    def version(self, usuario_id):
+        return self.versiones.get(usuario_id, 0)
+
+    def alternar(self, usuario_id, track_id):
+        """Agrega o quita un favorito; devuelve True si quedó agregado"""
+        with self.lock:
+            favoritos = self.favoritos.setdefault(usuario_id, {})
+            self.versiones[usuario_id] = self.versiones.get(usuario_id, 0) + 1
+            if track_id in favoritos:
+                del favoritos[track_id]
+                return False
+            favoritos[track_id] = None
+            return True
+
+    def agregar_muchos(self, usuario_id, track_ids):
+        """Agrega los que falten, en orden; devuelve cuántos eran nuevos"""
+        with self.lock:
+            favoritos = self.favoritos.setdefault(usuario_id, {})
+            antes = len(favoritos)
+            favoritos.update(dict.fromkeys(track_ids))
+            if len(favoritos) != antes:
+                self.versiones[usuario_id] = self.versiones.get(usuario_id, 0) + 1
+            return len(favoritos) - antes
+
+class FavoritosSQLite:
+    """Favoritos en SQLite: clave primaria (usuario, track_id) y un contador de versión por usuario"""
+    persistente = True
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.local = threading.local()
+        self._conexion().executescript("""
+            CREATE TABLE IF NOT EXISTS favoritos (
+                usuario TEXT NOT NULL,
+                track_id TEXT NOT NULL,
+                orden INTEGER NOT NULL,
+                PRIMARY KEY (usuario, track_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS favoritos_versiones (
+                usuario TEXT PRIMARY KEY,
+                version INTEGER NOT NULL
+            );
+        """)
+
+    def _conexion(self):
+        conexion = getattr(self.local, "conexion", None)
+        if conexion is None:
+            conexion = self.local.conexion = conectar_sqlite(self.ruta)
+        return conexion
+
+    def contiene(self, usuario_id, track_id):
+        return self._conexion().execute(
+            "SELECT 1 FROM favoritos WHERE usuario = ? AND track_id = ?", (usuario_id, track_id)).fetchone() is not None
+
+    def listar(self, usuario_id):
+        filas = self._conexion().execute(
+            "SELECT track_id FROM favoritos WHERE usuario = ? ORDER BY orden", (usuario_id,)).fetchall()
+        return [fila[0] for fila in filas]
+
+    def version(self, usuario_id):
+        fila = self._conexion().execute(
+            "SELECT version FROM favoritos_versiones WHERE usuario = ?", (usuario_id,)).fetchone()
+        return fila[0] if fila else 0
+
+    def _subir_version(self, conexion, usuario_id, cuanto):
+        """Sube la versión del usuario y devuelve la nueva; dentro de una transacción"""
+        return conexion.execute(
+            "INSERT INTO favoritos_versiones (usuario, version) VALUES (?, ?)"
+            " ON CONFLICT (usuario) DO UPDATE SET version = version + excluded.version RETURNING version",
+            (usuario_id, cuanto)).fetchone()[0]
+
+    def alternar(self, usuario_id, track_id):
+        conexion = self._conexion()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            version = self._subir_version(conexion, usuario_id, 1)
+            quitado = conexion.execute("DELETE FROM favoritos WHERE usuario = ? AND track_id = ?",
+                                       (usuario_id, track_id)).rowcount
+            if not quitado:
+                conexion.execute("INSERT INTO favoritos (usuario, track_id, orden) VALUES (?, ?, ?)",
+                                 (usuario_id, track_id, version))
+            conexion.execute("COMMIT")
+            return not quitado
+        except Exception:
+            conexion.execute("ROLLBACK")
+            raise
+
+    def agregar_muchos(self, usuario_id, track_ids):
+        track_ids = list(dict.fromkeys(track_ids))
+        conexion = self._conexion()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            # El orden de cada favorito sale de la versión, que se reserva para todo el lote
+            version = self._subir_version(conexion, usuario_id, len(track_ids)) - len(track_ids)
+            antes = conexion.total_changes
+            conexion.executemany(
+                "INSERT OR IGNORE INTO favoritos (usuario, track_id, orden) VALUES (?, ?, ?)",
+                [(usuario_id, track_id, version + i) for i, track_id in enumerate(track_ids, 1)])
+            agregados = conexion.total_changes - antes
+            conexion.execute("COMMIT")
+            return agregados
+        except Exception:
+            conexion.execute("ROLLBACK")
+            raise
+
+class FavoritosRedis:
+    """Favoritos en un sorted set de Redis por usuario; el puntaje es la versión al agregarlo"""
+    persistente = True
+    ALTERNAR = """
+        if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+            redis.call('ZREM', KEYS[1], ARGV[1])
+            redis.call('INCR', KEYS[2])
+            return 0
+        end
+        redis.call('ZADD', KEYS[1], redis.call('INCR', KEYS[2]), ARGV[1])
+        return 1
+    """
+    AGREGAR_MUCHOS = """
+        local agregados = 0
+        for _, track_id in ipairs(ARGV) do
+            if not redis.call('ZSCORE', KEYS[1], track_id) then
+                redis.call('ZADD', KEYS[1], redis.call('INCR', KEYS[2]), track_id)
+                agregados = agregados + 1
+            end
+        end
+        return agregados
+    """
+
+    def __init__(self, cliente):
+        self.cliente = cliente
+        self.alternar_script = cliente.register_script(self.ALTERNAR)
+        self.agregar_muchos_script = cliente.register_script(self.AGREGAR_MUCHOS)
+
+    def _claves(self, usuario_id):
+        return [f"favoritos:{usuario_id}", f"favoritos:{usuario_id}:version"]
+
+    def contiene(self, usuario_id, track_id):
+        return self.cliente.zscore(f"favoritos:{usuario_id}", track_id) is not None
+
+    def listar(self, usuario_id):
+        return [track_id.decode() for track_id in self.cliente.zrange(f"favoritos:{usuario_id}", 0, -1)]
+
+    def version(self, usuario_id):
+        return int(self.cliente.get(f"favoritos:{usuario_id}:version") or 0)
+
+    def alternar(self, usuario_id, track_id):
+        return self.alternar_script(keys=self._claves(usuario_id), args=[track_id]) == 1
+
+    def agregar_muchos(self, usuario_id, track_ids):
+        return self.agregar_muchos_script(keys=self._claves(usuario_id), args=list(track_ids))
+
+def crear_almacen_favoritos():
+    if ALMACEN_FAVORITOS == "sqlite":
+        return FavoritosSQLite(SQLITE_PATH)
+    if ALMACEN_FAVORITOS == "redis":
+        if redis_cliente:
+            return FavoritosRedis(redis_cliente)
+        print("ALMACEN_FAVORITOS=redis pero Redis no está disponible; los favoritos quedan en SQLite")
+        return FavoritosSQLite(SQLITE_PATH)
+    return FavoritosMemoria()
+
+almacen_favoritos = crear_almacen_favoritos()
+
+def usuario_con_favoritos(sp):
+    """ID del usuario; la primera vez pasa al almacén los favoritos que quedaran en la cookie de sesión"""
+    usuario_id = get_usuario_id(sp)
+    if almacen_favoritos.persistente:
+        anteriores = session.pop("favoritos", None)
+    elif almacen_favoritos.version(usuario_id) == 0:
+        # En memoria se pierden al reiniciar: la cookie sigue siendo la copia que dura
+        anteriores = session.get("favoritos")
+    else:
+        anteriores = None
+    if anteriores:
+        almacen_favoritos.agregar_muchos(usuario_id, anteriores)
+    return usuario_id
+
 @app.route("/toggle_favorito/<track_id>", methods=["POST"])
 def toggle_favorito(track_id):
     sp = get_spotify()
     if not sp:
         return jsonify({"error": "No autenticado"}), 401
     
-    if "favoritos" not in session:
-        session["favoritos"] = []
-    
-    favoritos = session["favoritos"]
-    
-    if track_id in favoritos:
-        favoritos.remove(track_id)
-        estado = "removed"
-    else:
-        favoritos.append(track_id)
-        estado = "added"
-    
-    session["favoritos"] = favoritos
-    session.modified = True
-    
-    return jsonify({"status": estado})
+    agregado = almacen_favoritos.alternar(usuario_con_favoritos(sp), track_id)
+    return jsonify({"status": "added" if agregado else "removed"})
 
-@app.route("/favoritos")
-def favoritos():
+@app.route("/api/favoritos/exportar")
+def exportar_favoritos():
     sp = get_spotify()
     if not sp:
-        return redirect("/login")
+        return jsonify({"error": "No autenticado"}), 401
+    return jsonify({"favoritos": almacen_favoritos.listar(usuario_con_favoritos(sp))})
+
+@app.route("/api/favoritos/importar", methods=["POST"])
+def importar_favoritos():
+    """Agrega en bloque una lista de IDs ({"favoritos": [...]}, como la que devuelve /exportar)"""
+    sp = get_spotify()
+    if not sp:
+        return jsonify({"error": "No autenticado"}), 401
+
+    data = request.get_json(silent=True) or {}
+    track_ids = data.get("favoritos") if isinstance(data, dict) else data
+    if not isinstance(track_ids, list) or not all(isinstance(track_id, str) and track_id for track_id in track_ids):
+        return jsonify({"error": "Se espera una lista de IDs de tracks"}), 400
+    if len(track_ids) > FAVORITOS_IMPORTAR_MAX:
+        return jsonify({"error": f"Máximo {FAVORITOS_IMPORTAR_MAX} favoritos por importación"}), 400
+
+    usuario_id = usuario_con_favoritos(sp)
+    agregados = almacen_favoritos.agregar_muchos(usuario_id, track_ids) if track_ids else 0
+    return jsonify({"importados": agregados, "total": len(almacen_favoritos.listar(usuario_id))})
+
+TRACKS_POR_LOTE = 50  # máximo de IDs que acepta sp.tracks()
+
+def track_a_favorito(track):
+    return {
+        "id": track["id"],
+        "name": track["name"],
+        "artist": ", ".join([a["name"] for a in track["artists"]]),
+        "album": track["album"]["name"],
+        "image": track["album"]["images"][0]["url"] if track["album"]["images"] else None
+    }
+
+def obtener_lote_tracks(sp, ids):
+    """Pide un lote de tracks; si Spotify rechaza el lote por un ID inválido, los pide uno por uno"""
+    try:
+        tracks = sp.tracks(ids)["tracks"]
+        # Spotify devuelve null para los IDs que no encuentra
+        for track_id, track in zip(ids, tracks):
+            if not track:
+                print(f"Error obteniendo track {track_id}: no encontrado")
+        return tracks
+    except LimiteSpotify:
+        raise
+    except SpotifyException as e:
+        # Con 429 o 5xx, pedirlos de a uno sería multiplicar por 50 las llamadas justo cuando hay que frenar
+        if e.http_status not in (400, 404):
+            print(f"Error obteniendo lote de {len(ids)} tracks:", e)
+            return [None] * len(ids)
+        print(f"Error obteniendo lote de {len(ids)} tracks, reintentando uno por uno:", e)
+    except Exception as e:
+        print(f"Error obteniendo lote de {len(ids)} tracks:", e)
+        return [None] * len(ids)
+
+    tracks = []
+    for track_id in ids:
+        try:
+            tracks.append(sp.track(track_id))
+        except LimiteSpotify:
+            raise
+        except Exception as e:
+            print(f"Error obteniendo track {track_id}:", e)
+            tracks.append(None)
+    return tracks
+
+def hidratar_favoritos(sp, favoritos_ids, usuario_id):
+    """Convierte los IDs de favoritos en dicts para la plantilla usando lotes concurrentes"""
+    en_cache = cache_metadatos.obtener_muchos([f"track:{track_id}" for track_id in favoritos_ids])
+    tracks_por_id = {clave.split(":", 1)[1]: track for clave, track in en_cache.items()}
+
+    faltantes = [track_id for track_id in dict.fromkeys(favoritos_ids) if track_id not in tracks_por_id]
+    lotes = [faltantes[i:i + TRACKS_POR_LOTE]
+             for i in range(0, len(faltantes), TRACKS_POR_LOTE)]
+
+    nuevos = {}
+    for lote, tracks in zip(lotes, pool_spotify.map(lambda lote: obtener_lote_tracks(sp, lote), lotes)):
+        for track_id, track in zip(lote, tracks):
+            if track:
+                tracks_por_id[track_id] = nuevos[f"track:{track_id}"] = sin_mercados(track)
+    cache_metadatos.guardar_muchos(nuevos)
+    indice_tracks.agregar_tracks(tracks_por_id.values(), usuario_id=usuario_id)
 
-    favoritos_ids = session.get("favoritos", [])
     favoritos_list = []
-    
     for track_id in favoritos_ids:
+        track = tracks_por_id.get(track_id)
+        if not track:
+            continue
         try:
-            track = sp.track(track_id)
-            favoritos_list.append({
-                "id": track["id"],
-                "name": track["name"],
-                "artist": ", ".join([a["name"] for a in track["artists"]]),
-                "album": track["album"]["name"],
-                "image": track["album"]["images"][0]["url"] if track["album"]["images"] else None
-            })
+            favoritos_list.append(track_a_favorito(track))
         except Exception as e:
             print(f"Error obteniendo track {track_id}:", e)
+    return favoritos_list
 
-    return render_template("favoritos.html", favoritos=favoritos_list)
+@app.route("/favoritos")
+def favoritos():
+    sp = get_spotify()
+    if not sp:
+        return redirect("/login")
+
+    usuario_id = usuario_con_favoritos(sp)
+    def contexto():
+        favoritos_ids = almacen_favoritos.listar(usuario_id)
+        return {"favoritos": hidratar_favoritos(sp, favoritos_ids, usuario_id), "total": len(favoritos_ids)}
+
+    # Con el fragmento en cache ni siquiera se listan ni se hidratan los favoritos; si
+    # Spotify no devolvió alguno (error o track que ya no existe) no se guarda
+    favoritos_html = fragmento(
+        f"favoritos:{usuario_id}", almacen_favoritos.version(usuario_id), "parciales/favoritos.html",
+        contexto, completo=lambda datos: len(datos["favoritos"]) == datos["total"])
+
+    return render_template("favoritos.html", favoritos_html=favoritos_html)
 
 # ----------------- PLAYLISTS -----------------
 
+PLAYLISTS_POR_PAGINA = 50  # máximo que acepta current_user_playlists
+
 @app.route("/playlists")
 def playlists():
     sp = get_spotify()
@@ -112,13 +2020,25 @@ def playlists():
         return redirect("/login")
 
     try:
-        playlists_data = sp.current_user_playlists(limit=20)
-        playlists = playlists_data["items"]
+        # La primera página trae el total; el resto se pide en paralelo
+        primera = sp.current_user_playlists(limit=PLAYLISTS_POR_PAGINA)
+        paginas = recorrer_paginas(
+            primera,
+            lambda offset: sp.current_user_playlists(limit=PLAYLISTS_POR_PAGINA, offset=offset),
+            PLAYLISTS_POR_PAGINA)
+        playlists = [playlist for pagina in paginas for playlist in pagina["items"]]
+        # Sin cache detrás: la versión es el snapshot_id de cada playlist, que cambia con cualquier edición
+        version = etag_de(*((playlist["id"], playlist.get("snapshot_id"), playlist["name"]) for playlist in playlists))
+    except LimiteSpotify:
+        raise
     except Exception as e:
         print("Error obteniendo playlists:", e)
         playlists = []
+        version = None
 
-    return render_template("playlists.html", playlists=playlists)
+    playlists_html = fragmento(f"playlists:{get_usuario_id(sp)}", version, "parciales/playlists.html",
+                               lambda: {"playlists": playlists})
+    return render_template("playlists.html", playlists_html=playlists_html)
 
 @app.route("/playlist/<playlist_id>")
 def playlist_detail(playlist_id):
@@ -126,34 +2046,307 @@ def playlist_detail(playlist_id):
     if not sp:
         return redirect("/login")
 
+    clave_pagina = version = None
     try:
-        playlist = sp.playlist(playlist_id)
-        tracks = playlist["tracks"]["items"]
+        playlist = obtener_playlist(sp, playlist_id, get_usuario_id(sp), renovar=True)
+        snapshot_id = playlist.get("snapshot_id")
+        clave_pagina = clave_pagina_playlist(playlist_id, snapshot_id, 0, PAGINA_PLAYLIST_MAX)
+        version = cache_metadatos.version(clave_pagina)
+        pagina = obtener_pagina_playlist(sp, playlist_id, snapshot_id, 0)
+        indexar_pagina_playlist(pagina, get_usuario_id(sp))
+        if pagina["total"] > PAGINA_PLAYLIST_MAX:
+            precargar_pagina_playlist(sp, playlist_id, snapshot_id, PAGINA_PLAYLIST_MAX)
+    except LimiteSpotify:
+        raise
     except Exception as e:
         print("Error obteniendo canciones:", e)
         playlist = {}
-        tracks = []
+        pagina = {"items": []}
+        version = None
+
+    tracks_html = fragmento(clave_pagina, version, "parciales/tracks_playlist.html",
+                            lambda: {"tracks": items_de_pagina(pagina)})
+    return render_template("playlist_detail.html", playlist=playlist, tracks_html=tracks_html,
+                           pagina_tamanio=PAGINA_PLAYLIST_MAX)
 
-    return render_template("playlist_detail.html", playlist=playlist, tracks=tracks)
+@app.route("/api/playlist/<playlist_id>/tracks")
+def playlist_tracks(playlist_id):
+    """Una página de canciones, o con ?stream=1 todas desde `offset` en NDJSON (una línea por página)"""
+    sp = get_spotify()
+    if not sp:
+        return jsonify({"error": "No autenticado"}), 401
+
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", PAGINA_PLAYLIST_MAX, type=int), 1), PAGINA_PLAYLIST_MAX)
+
+    usuario_id = get_usuario_id(sp)
+    try:
+        cabecera = obtener_playlist(sp, playlist_id, usuario_id)
+        # La versión con la que se abrió la página, para que el scroll no mezcle dos versiones
+        snapshot_id = request.args.get("snapshot_id") or cabecera.get("snapshot_id")
+        pagina = obtener_pagina_playlist(sp, playlist_id, snapshot_id, offset, limit)
+    except LimiteSpotify:
+        raise
+    except Exception as e:
+        print("Error obteniendo canciones:", e)
+        return jsonify({"error": str(e)}), 400
+
+    if request.args.get("stream"):
+        def lineas():
+            paginas = recorrer_paginas(
+                pagina, lambda offset: obtener_pagina_playlist(sp, playlist_id, snapshot_id, offset, limit), limit)
+            for actual in paginas:
+                indexar_pagina_playlist(actual, usuario_id)
+                yield json.dumps({"offset": actual["offset"], "total": actual["total"],
+                                  "items": items_de_pagina(actual)}) + "\n"
+
+        return Response(stream_with_context(lineas()), mimetype="application/x-ndjson",
+                        headers={"X-Accel-Buffering": "no"})
+
+    indexar_pagina_playlist(pagina, usuario_id)
+    siguiente = offset + limit
+    if siguiente < pagina["total"]:
+        precargar_pagina_playlist(sp, playlist_id, snapshot_id, siguiente, limit)
+    return jsonify({
+        "items": items_de_pagina(pagina),
+        "offset": offset,
+        "limit": limit,
+        "total": pagina["total"],
+        "siguiente": siguiente if siguiente < pagina["total"] else None
+    })
 
 # ----------------- REPRODUCCIÓN -----------------
 
+DISPOSITIVO_TTL = int(os.getenv("DISPOSITIVO_TTL", 300))
+MENSAJE_SIN_DISPOSITIVO = "No hay dispositivos de Spotify activos. Abre Spotify en tu dispositivo."
+
+class SinDispositivo(Exception):
+    """El usuario no tiene ningún dispositivo de Spotify disponible"""
+
+class RegistroDispositivos:
+    """Último dispositivo activo de cada usuario, para reproducir directamente en él"""
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.dispositivos = {}  # usuario -> (expira, device_id)
+        self.lock = threading.Lock()
+
+    def obtener(self, usuario_id):
+        with self.lock:
+            entrada = self.dispositivos.get(usuario_id)
+            if entrada and entrada[0] > time.monotonic():
+                return entrada[1]
+            self.dispositivos.pop(usuario_id, None)
+            return None
+
+    def recordar(self, usuario_id, device_id):
+        with self.lock:
+            self.dispositivos[usuario_id] = (time.monotonic() + self.ttl, device_id)
+
+    def olvidar(self, usuario_id):
+        with self.lock:
+            self.dispositivos.pop(usuario_id, None)
+
+registro_dispositivos = RegistroDispositivos(DISPOSITIVO_TTL)
+
+def reproducir_en_spotify(sp, **kwargs):
+    """start_playback en el dispositivo conocido del usuario (una sola llamada).
+
+    Si no hay ninguno recordado o ya no responde, elige uno de sp.devices() y
+    reproduce ahí: start_playback con device_id ya transfiere la reproducción.
+    """
+    usuario_id = get_usuario_id(sp)
+    device_id = registro_dispositivos.obtener(usuario_id)
+    try:
+        sp.start_playback(device_id=device_id, **kwargs)
+    except LimiteSpotify:
+        raise
+    except SpotifyException:
+        devices = sp.devices()["devices"]
+        if not devices:
+            registro_dispositivos.olvidar(usuario_id)
+            raise SinDispositivo()
+        elegido = next((d for d in devices if d["is_active"]), devices[0])
+        registro_dispositivos.recordar(usuario_id, elegido["id"])
+        sp.start_playback(device_id=elegido["id"], **kwargs)
+    tras_accion_de_control()
+
 @app.route("/play_track/<track_id>", methods=["POST"])
+@prioridad_spotify(PRIORIDAD_ALTA)
 def play_track(track_id):
     sp = get_spotify()
     if not sp:
         return jsonify({"error": "No autenticado"}), 401
     try:
-        sp.start_playback(uris=[f"spotify:track:{track_id}"])
+        reproducir_en_spotify(sp, uris=[f"spotify:track:{track_id}"])
         return ("", 204)
+    except SinDispositivo:
+        return jsonify({"error": MENSAJE_SIN_DISPOSITIVO}), 400
+    except LimiteSpotify:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 400
 
-@app.route("/current")
-def current():
+# Poller compartido: una sola consulta de estado por usuario e intervalo,
+# sin importar cuántas pestañas tenga abiertas
+POLLER_INTERVALO = float(os.getenv("POLLER_INTERVALO", 3))
+POLLER_INTERVALO_MINIMO = float(os.getenv("POLLER_INTERVALO_MINIMO", 1))
+POLLER_INTERVALO_PAUSA = float(os.getenv("POLLER_INTERVALO_PAUSA", 10))
+POLLER_INACTIVO_SEG = int(os.getenv("POLLER_INACTIVO_SEG", 60))
+SSE_KEEPALIVE_SEG = 15
+SSE_DURACION_MAX_SEG = 300  # el navegador se reconecta solo y libera el hilo
+
+class PollerActual:
+    """Consulta el estado de reproducción en segundo plano y reparte el resultado a todos los suscriptores"""
+    def __init__(self, usuario_id, token_info):
+        self.usuario_id = usuario_id
+        self.token_info = token_info  # de una sesión verificada de este usuario
+        self.snapshot = None  # (instante, respuesta de current_playback)
+        self.version = 0
+        self.condicion = threading.Condition()
+        self.evento = threading.Event()
+        self.suscriptores = 0
+        self.ultimo_uso = time.monotonic()
+        self.proxima_consulta = 0
+        self.activo = True
+        self.hilo = threading.Thread(target=self._bucle, name=f"poller-{usuario_id}", daemon=True)
+        self.hilo.start()
+
+    def _consultar(self):
+        try:
+            # El gestor de tokens lo mantiene vigente aunque el usuario no haga peticiones
+            token_info = gestor_tokens.vigente(self.token_info["refresh_token"], self.token_info)
+            sp = registro_clientes.obtener(token_info["access_token"])
+            # El polling es lo primero que se descarta si Spotify limita las peticiones
+            with prioridad_spotify(PRIORIDAD_BAJA):
+                track = obtener_estado_reproduccion(sp, self.usuario_id)
+        except Exception as e:
+            print(f"Error en el poller de {self.usuario_id}:", e)
+            track = self.snapshot[1] if self.snapshot else None
+        with self.condicion:
+            self.snapshot = (time.time(), track)
+            self.version += 1
+            self.condicion.notify_all()
+
+    def _intervalo(self):
+        """Más rápido cerca del final de la canción, más lento si no suena nada"""
+        track = self.snapshot[1] if self.snapshot else None
+        if not track or not track.get("is_playing") or not track.get("item"):
+            return max(POLLER_INTERVALO_PAUSA, limitador_spotify.pausa_restante())
+        restante = (track["item"]["duration_ms"] - (track.get("progress_ms") or 0)) / 1000
+        intervalo = max(POLLER_INTERVALO_MINIMO, min(POLLER_INTERVALO, restante + 0.5))
+        return max(intervalo, limitador_spotify.pausa_restante())
+
+    def _bucle(self):
+        while self.activo:
+            self._consultar()
+            self.proxima_consulta = time.monotonic() + self._intervalo()
+            while True:
+                restante = self.proxima_consulta - time.monotonic()
+                if restante <= 0:
+                    break
+                self.evento.wait(restante)
+                self.evento.clear()
+            with self.condicion:
+                if self.suscriptores == 0 and time.monotonic() - self.ultimo_uso > POLLER_INACTIVO_SEG:
+                    self.activo = False
+        descartar_poller(self)
+
+    def adelantar_consulta(self, segundos=0.5):
+        """Vuelve a consultar pronto, p. ej. después de un cambio de canción"""
+        self.proxima_consulta = min(self.proxima_consulta, time.monotonic() + segundos)
+        self.evento.set()
+
+    def esperar(self, version, timeout):
+        """Espera un snapshot más nuevo que `version`; devuelve (version, snapshot)"""
+        with self.condicion:
+            self.condicion.wait_for(lambda: self.version > version, timeout)
+            return self.version, self.snapshot
+
+    def suscribir(self):
+        with self.condicion:
+            self.suscriptores += 1
+
+    def desuscribir(self):
+        with self.condicion:
+            self.suscriptores -= 1
+            self.ultimo_uso = time.monotonic()
+
+pollers = {}
+pollers_lock = threading.Lock()
+
+def obtener_poller(usuario_id, token_info):
+    """Poller del usuario; `usuario_id` tiene que venir de get_usuario_id (verificado con ese token)"""
+    with pollers_lock:
+        poller = pollers.get(usuario_id)
+        if poller is None or not poller.activo:
+            poller = pollers[usuario_id] = PollerActual(usuario_id, token_info)
+        poller.token_info = token_info
+        poller.ultimo_uso = time.monotonic()
+        return poller
+
+def descartar_poller(poller):
+    with pollers_lock:
+        if pollers.get(poller.usuario_id) is poller:
+            del pollers[poller.usuario_id]
+
+def poller_de_la_sesion():
     sp = get_spotify()
     if not sp:
-        return jsonify({
+        return None
+    return obtener_poller(usuario_con_favoritos(sp), session["token_info"])
+
+def tras_accion_de_control():
+    """Descarta el estado cacheado y hace que el poller consulte enseguida en vez de esperar su intervalo"""
+    usuario_id = usuario_verificado()
+    estado_reproduccion.invalidar(usuario_id)
+    poller = pollers.get(usuario_id)
+    if poller:
+        poller.adelantar_consulta()
+
+NADA_REPRODUCIENDO = {
+    "trackId": None,
+    "trackTitle": "Nada reproduciéndose",
+    "trackArtist": "",
+    "albumTitle": "",
+    "coverUrl": None,
+    "duration": 0,
+    "progress": 0,
+    "isFavorite": False
+}
+
+def formatear_actual(snapshot, es_favorito):
+    """Convierte un snapshot del poller en el JSON que espera el reproductor"""
+    if not snapshot:
+        return NADA_REPRODUCIENDO
+    instante, track = snapshot
+    if not (track and track.get("is_playing") and track.get("item")):
+        return NADA_REPRODUCIENDO
+
+    item = track["item"]
+    # El snapshot puede tener unos segundos; se estima el progreso actual
+    progreso = min(item["duration_ms"], track["progress_ms"] + int((time.time() - instante) * 1000))
+    return {
+        "trackId": item["id"],
+        "trackTitle": item["name"],
+        "trackArtist": ", ".join([artist["name"] for artist in item["artists"]]),
+        "albumTitle": item["album"]["name"],
+        "coverUrl": item["album"]["images"][0]["url"] if item["album"]["images"] else None,
+        "duration": item["duration_ms"],
+        "progress": progreso,
+        "isFavorite": es_favorito(item["id"])
+    }
+
+@app.route("/current")
+def current():
+    try:
+        poller = poller_de_la_sesion()
+    except LimiteSpotify:
+        raise
+    except Exception as e:
+        print("Error en /current:", e)
+        return jsonify(NADA_REPRODUCIENDO)
+    if not poller:
+        return con_etag_del_contenido(jsonify({
             "trackId": None,
             "trackTitle": "Nada reproduciéndose",
             "trackArtist": "",
@@ -161,86 +2354,108 @@ def current():
             "coverUrl": None,
             "duration": 0,
             "progress": 0
-        })
-    
-    try:
-        track = sp.currently_playing()
-        if track and track.get("is_playing") and track.get("item"):
-            item = track["item"]
-            
-            # Verificar si está en favoritos
-            favoritos = session.get("favoritos", [])
-            is_favorite = item["id"] in favoritos
-            
-            return jsonify({
-                "trackId": item["id"],
-                "trackTitle": item["name"],
-                "trackArtist": ", ".join([artist["name"] for artist in item["artists"]]),
-                "albumTitle": item["album"]["name"],
-                "coverUrl": item["album"]["images"][0]["url"] if item["album"]["images"] else None,
-                "duration": item["duration_ms"],
-                "progress": track["progress_ms"],
-                "isFavorite": is_favorite
-            })
-    except Exception as e:
-        print("Error en /current:", e)
-    
-    return jsonify({
-        "trackId": None,
-        "trackTitle": "Nada reproduciéndose",
-        "trackArtist": "",
-        "albumTitle": "",
-        "coverUrl": None,
-        "duration": 0,
-        "progress": 0,
-        "isFavorite": False
-    })
+        }))
+
+    # La primera vez se espera a la consulta inicial del poller
+    _, snapshot = poller.esperar(0, timeout=5)
+    # Mientras suena el progreso cambia en cada consulta; en pausa o sin nada sonando, 304
+    return con_etag_del_contenido(jsonify(
+        formatear_actual(snapshot, lambda track_id: almacen_favoritos.contiene(poller.usuario_id, track_id))))
+
+@app.route("/current/stream")
+def current_stream():
+    """Server-Sent Events con el estado de reproducción que publica el poller del usuario"""
+    poller = poller_de_la_sesion()
+    if not poller:
+        return jsonify({"error": "No autenticado"}), 401
+    usuario_id = poller.usuario_id
+
+    def es_favorito(track_id):
+        # Se consulta en cada evento: los cambios de favoritos llegan sin reconectar
+        return almacen_favoritos.contiene(usuario_id, track_id)
+
+    def eventos():
+        poller.suscribir()
+        try:
+            yield f"retry: {int(POLLER_INTERVALO * 1000)}\n\n"
+            fin = time.monotonic() + SSE_DURACION_MAX_SEG
+            version = 0
+            while time.monotonic() < fin:
+                nueva_version, snapshot = poller.esperar(version, SSE_KEEPALIVE_SEG)
+                if nueva_version == version:
+                    yield ": keep-alive\n\n"
+                    continue
+                version = nueva_version
+                yield f"data: {json.dumps(formatear_actual(snapshot, es_favorito))}\n\n"
+        finally:
+            poller.desuscribir()
+
+    return Response(stream_with_context(eventos()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route("/seek/<int:position_ms>", methods=["POST"])
+@prioridad_spotify(PRIORIDAD_ALTA)
 def seek(position_ms):
     sp = get_spotify()
     if not sp:
         return jsonify({"error": "No autenticado"}), 401
     try:
         sp.seek_track(position_ms)
+        tras_accion_de_control()
         return ("", 204)
+    except LimiteSpotify:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 400
 
 @app.route("/play")
+@prioridad_spotify(PRIORIDAD_ALTA)
 def play_pause():
     sp = get_spotify()
     if not sp:
         return jsonify({"error": "No autenticado"}), 401
     try:
-        playback = sp.current_playback()
+        playback = obtener_estado_reproduccion(sp, get_usuario_id(sp))
         if playback and playback["is_playing"]:
             sp.pause_playback()
+            tras_accion_de_control()
         else:
-            sp.start_playback()
+            reproducir_en_spotify(sp)
         return ("", 204)
+    except SinDispositivo:
+        return jsonify({"error": MENSAJE_SIN_DISPOSITIVO}), 400
+    except LimiteSpotify:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 400
 
 @app.route("/next")
+@prioridad_spotify(PRIORIDAD_ALTA)
 def next_track():
     sp = get_spotify()
     if not sp:
         return jsonify({"error": "No autenticado"}), 401
     try:
         sp.next_track()
+        tras_accion_de_control()
         return ("", 204)
+    except LimiteSpotify:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 400
 
 @app.route("/prev")
+@prioridad_spotify(PRIORIDAD_ALTA)
 def prev_track():
     sp = get_spotify()
     if not sp:
         return jsonify({"error": "No autenticado"}), 401
     try:
         sp.previous_track()
+        tras_accion_de_control()
         return ("", 204)
+    except LimiteSpotify:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 400
 
@@ -256,44 +2471,243 @@ def callback():
     code = request.args.get("code")
     token_info = sp_oauth.get_access_token(code)
     session["token_info"] = token_info
+    session["usuario_id"] = registro_clientes.obtener(token_info["access_token"]).current_user()["id"]
+    gestor_tokens.vincular(token_info, session["usuario_id"])
     return redirect(url_for("index"))
 
 # ==================================================
 # LISTA DOBLEMENTE ENLAZADA - PLAYLIST PERSONALIZADA
 # ==================================================
 
-import uuid
+DIGITOS_ID = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def id_compacto(numero):
+    """Entero -> texto en base 36 ('1', 'a', '2s'...), mucho más corto que un uuid4"""
+    texto = ""
+    while True:
+        numero, resto = divmod(numero, 36)
+        texto = DIGITOS_ID[resto] + texto
+        if numero == 0:
+            return texto
+
+def internar(texto):
+    """Artistas, álbumes y duraciones se repiten mucho: se guarda una sola copia de cada texto"""
+    return sys.intern(texto) if isinstance(texto, str) else texto
 
 class Nodo:
-    """Nodo de la lista doblemente enlazada"""
-    def __init__(self, cancion):
-        self.id = str(uuid.uuid4())
-        self.cancion = cancion
+    """Nodo de la lista doblemente enlazada y, a la vez, del árbol de posiciones (treap implícito)"""
+    __slots__ = ("id", "titulo", "artista", "duracion", "album", "uri",
+                 "siguiente", "anterior", "izq", "der", "padre", "tam", "_json")
+
+    def __init__(self, nodo_id, cancion):
+        self.id = nodo_id
+        self.titulo = cancion["titulo"]
+        self.artista = internar(cancion["artista"])
+        self.duracion = internar(cancion["duracion"])
+        self.album = internar(cancion.get("album", ""))
+        self.uri = cancion.get("uri")  # URI de Spotify, una vez resuelta la búsqueda
         self.siguiente = None
         self.anterior = None
+        # Árbol de posiciones: el orden en el árbol es el orden en la lista.
+        # La prioridad del treap es hash(id), que Python ya guarda en el propio string.
+        self.izq = None
+        self.der = None
+        self.padre = None
+        self.tam = 1  # nodos en este subárbol
+        self._json = None
     
     def to_dict(self):
         return {
             "id": self.id,
-            "titulo": self.cancion["titulo"],
-            "artista": self.cancion["artista"],
-            "duracion": self.cancion["duracion"],
-            "album": self.cancion.get("album", "")
+            "titulo": self.titulo,
+            "artista": self.artista,
+            "duracion": self.duracion,
+            "album": self.album,
+            "uri": self.uri
         }
 
+    def serializado_json(self, es_actual=False):
+        """JSON del nodo para los listados; el caso habitual (no actual) se cachea mientras el nodo no cambie"""
+        if es_actual:
+            return json.dumps(dict(self.to_dict(), es_actual=True))
+        if self._json is None:
+            self._json = json.dumps(dict(self.to_dict(), es_actual=False))
+        return self._json
+
+CAMBIOS_MAX = 500  # cambios que se guardan para responder a since_revision
+
+def tam_arbol(nodo):
+    return nodo.tam if nodo else 0
+
+def actualizar_tam(nodo):
+    nodo.tam = 1 + tam_arbol(nodo.izq) + tam_arbol(nodo.der)
+
 class ListaDobleEnlazada:
-    """Lista doblemente enlazada para playlist personalizada"""
+    """Lista doblemente enlazada para playlist personalizada.
+
+    Además de los enlaces siguiente/anterior, los nodos forman un treap implícito
+    ordenado por posición, para insertar, eliminar y ubicar canciones en O(log n).
+    """
     def __init__(self):
         self.cabeza = None
         self.cola = None
         self.actual = None
         self.tamanio = 0
+        self.indice = {}  # id -> Nodo, para buscar y eliminar en O(1)
+        self.raiz = None  # raíz del árbol de posiciones
+        # Cada cambio sube la revisión y queda en un historial corto, para mandar solo deltas
+        self.revision = 0
+        self.cambios = deque(maxlen=CAMBIOS_MAX)
+        self.lock = threading.RLock()
+        self.contador_ids = 0
+        self.revision_snapshot = 0  # revisión del último snapshot guardado en el almacén
     
+    # ---- árbol de posiciones ----
+
+    def _unir(self, a, b):
+        """Une dos árboles donde todo `a` va antes que todo `b`"""
+        if a is None:
+            return b
+        if b is None:
+            return a
+        if hash(a.id) > hash(b.id):
+            a.der = self._unir(a.der, b)
+            a.der.padre = a
+            actualizar_tam(a)
+            return a
+        b.izq = self._unir(a, b.izq)
+        b.izq.padre = b
+        actualizar_tam(b)
+        return b
+
+    def _dividir(self, nodo, k):
+        """Separa el árbol en (primeros k nodos, resto)"""
+        if nodo is None:
+            return None, None
+        nodo.padre = None
+        if tam_arbol(nodo.izq) >= k:
+            izq, der = self._dividir(nodo.izq, k)
+            nodo.izq = der
+            if der:
+                der.padre = nodo
+            actualizar_tam(nodo)
+            return izq, nodo
+        izq, der = self._dividir(nodo.der, k - tam_arbol(nodo.izq) - 1)
+        nodo.der = izq
+        if izq:
+            izq.padre = nodo
+        actualizar_tam(nodo)
+        return nodo, der
+
+    def _fijar_raiz(self, raiz):
+        self.raiz = raiz
+        if raiz:
+            raiz.padre = None
+
+    def _nodo_en(self, posicion):
+        nodo = self.raiz
+        while nodo:
+            tam_izq = tam_arbol(nodo.izq)
+            if posicion < tam_izq:
+                nodo = nodo.izq
+            elif posicion == tam_izq:
+                return nodo
+            else:
+                posicion -= tam_izq + 1
+                nodo = nodo.der
+        return None
+
+    def _construir_arbol(self, nodos):
+        """Treap de `nodos` (ya en orden de lista) en O(k): árbol cartesiano por hash(id) armado con una pila"""
+        pila = []
+        for nodo in nodos:
+            ultimo = None
+            while pila and hash(pila[-1].id) < hash(nodo.id):
+                ultimo = pila.pop()
+                actualizar_tam(ultimo)  # su subárbol ya no cambia
+            nodo.izq = ultimo
+            if ultimo:
+                ultimo.padre = nodo
+            if pila:
+                pila[-1].der = nodo
+            nodo.padre = pila[-1] if pila else None
+            pila.append(nodo)
+        while pila:
+            raiz = pila.pop()
+            actualizar_tam(raiz)
+        return raiz
+
+    def _quitar_del_arbol(self, nodo):
+        subarbol = self._unir(nodo.izq, nodo.der)
+        padre = nodo.padre
+        if padre is None:
+            self.raiz = subarbol
+        elif padre.izq is nodo:
+            padre.izq = subarbol
+        else:
+            padre.der = subarbol
+        if subarbol:
+            subarbol.padre = padre
+        while padre:
+            padre.tam -= 1
+            padre = padre.padre
+        nodo.izq = nodo.der = nodo.padre = None
+        nodo.tam = 1
+
+    # ---- revisiones ----
+
+    def _registrar(self, cambio):
+        self.revision += 1
+        cambio["revision"] = self.revision
+        cambio["actual"] = self.actual.id if self.actual else None
+        cambio["tamanio"] = self.tamanio
+        self.cambios.append(cambio)
+        return cambio
+
+    def _registrar_insercion(self, nodo, posicion):
+        self._registrar({"op": "insertar", "posicion": posicion, "cancion": nodo.to_dict()})
+
+    def _mover_actual(self, nodo):
+        if nodo is not self.actual:
+            self.actual = nodo
+            self._registrar({"op": "actual"})
+
+    def cambios_desde(self, revision):
+        """Cambios posteriores a `revision`, o None si ya no están en el historial"""
+        if revision == self.revision:
+            return []
+        if revision > self.revision or not self.cambios or self.cambios[0]["revision"] > revision + 1:
+            return None
+        return [cambio for cambio in self.cambios if cambio["revision"] > revision]
+
+    # ---- lista ----
+
+    def _nuevo_nodo(self, cancion):
+        nodo_id = cancion.get("id")
+        if nodo_id is None:
+            self.contador_ids += 1
+            nodo_id = id_compacto(self.contador_ids)
+        else:
+            # Cambio repetido desde el almacén: el nodo conserva su ID
+            self.contador_ids = max(self.contador_ids, int(nodo_id, 36))
+        return Nodo(nodo_id, cancion)
+
+    def _nodos_rango(self, inicio, fin):
+        actual = self._nodo_en(max(inicio, 0))
+        for _ in range(max(0, min(fin, self.tamanio) - max(inicio, 0))):
+            yield actual
+            actual = actual.siguiente
+
+    def _item_lista(self, nodo):
+        cancion_dict = nodo.to_dict()
+        cancion_dict["es_actual"] = (nodo == self.actual)
+        return cancion_dict
+
     def esta_vacia(self):
         return self.cabeza is None
     
     def agregar_al_inicio(self, cancion):
-        nuevo_nodo = Nodo(cancion)
+        nuevo_nodo = self._nuevo_nodo(cancion)
         if self.esta_vacia():
             self.cabeza = nuevo_nodo
             self.cola = nuevo_nodo
@@ -302,11 +2716,14 @@ class ListaDobleEnlazada:
             nuevo_nodo.siguiente = self.cabeza
             self.cabeza.anterior = nuevo_nodo
             self.cabeza = nuevo_nodo
+        self._fijar_raiz(self._unir(nuevo_nodo, self.raiz))
+        self.indice[nuevo_nodo.id] = nuevo_nodo
         self.tamanio += 1
+        self._registrar_insercion(nuevo_nodo, 0)
         return nuevo_nodo.id
     
     def agregar_al_final(self, cancion):
-        nuevo_nodo = Nodo(cancion)
+        nuevo_nodo = self._nuevo_nodo(cancion)
         if self.esta_vacia():
             self.cabeza = nuevo_nodo
             self.cola = nuevo_nodo
@@ -315,7 +2732,10 @@ class ListaDobleEnlazada:
             nuevo_nodo.anterior = self.cola
             self.cola.siguiente = nuevo_nodo
             self.cola = nuevo_nodo
+        self._fijar_raiz(self._unir(self.raiz, nuevo_nodo))
+        self.indice[nuevo_nodo.id] = nuevo_nodo
         self.tamanio += 1
+        self._registrar_insercion(nuevo_nodo, self.tamanio - 1)
         return nuevo_nodo.id
     
     def agregar_en_posicion(self, cancion, posicion):
@@ -324,59 +2744,115 @@ class ListaDobleEnlazada:
         if posicion >= self.tamanio:
             return self.agregar_al_final(cancion)
         
-        nuevo_nodo = Nodo(cancion)
-        actual = self.cabeza
-        for i in range(posicion):
-            actual = actual.siguiente
+        nuevo_nodo = self._nuevo_nodo(cancion)
+        actual = self._nodo_en(posicion)
         
         nuevo_nodo.anterior = actual.anterior
         nuevo_nodo.siguiente = actual
         actual.anterior.siguiente = nuevo_nodo
         actual.anterior = nuevo_nodo
+
+        izq, der = self._dividir(self.raiz, posicion)
+        self._fijar_raiz(self._unir(self._unir(izq, nuevo_nodo), der))
+        self.indice[nuevo_nodo.id] = nuevo_nodo
         self.tamanio += 1
+        self._registrar_insercion(nuevo_nodo, posicion)
         return nuevo_nodo.id
     
+    def agregar_muchos(self, canciones, posicion=None):
+        """Inserta las canciones seguidas en `posicion` (al final si es None) como un solo cambio, en O(k + log n)"""
+        if not canciones:
+            return []
+        posicion = self.tamanio if posicion is None else min(max(posicion, 0), self.tamanio)
+        nodos = [self._nuevo_nodo(cancion) for cancion in canciones]
+        for anterior, siguiente in zip(nodos, nodos[1:]):
+            anterior.siguiente = siguiente
+            siguiente.anterior = anterior
+
+        antes = self._nodo_en(posicion - 1) if posicion else None
+        despues = antes.siguiente if antes else self.cabeza
+        nodos[0].anterior = antes
+        nodos[-1].siguiente = despues
+        if antes:
+            antes.siguiente = nodos[0]
+        else:
+            self.cabeza = nodos[0]
+        if despues:
+            despues.anterior = nodos[-1]
+        else:
+            self.cola = nodos[-1]
+        if self.actual is None:
+            self.actual = nodos[0]
+
+        izq, der = self._dividir(self.raiz, posicion)
+        self._fijar_raiz(self._unir(self._unir(izq, self._construir_arbol(nodos)), der))
+        for nodo in nodos:
+            self.indice[nodo.id] = nodo
+        self.tamanio += len(nodos)
+        self._registrar({"op": "insertar_muchos", "posicion": posicion,
+                         "canciones": [nodo.to_dict() for nodo in nodos]})
+        return [nodo.id for nodo in nodos]
+
     def eliminar_por_id(self, nodo_id):
-        if self.esta_vacia():
+        actual = self.indice.pop(nodo_id, None)
+        if actual is None:
             return False
-        
-        actual = self.cabeza
-        while actual:
-            if actual.id == nodo_id:
-                if self.tamanio == 1:
-                    self.cabeza = None
-                    self.cola = None
-                    self.actual = None
-                elif actual == self.cabeza:
-                    self.cabeza = actual.siguiente
-                    self.cabeza.anterior = None
-                    if self.actual == actual:
-                        self.actual = self.cabeza
-                elif actual == self.cola:
-                    self.cola = actual.anterior
-                    self.cola.siguiente = None
-                    if self.actual == actual:
-                        self.actual = self.cola
-                else:
-                    actual.anterior.siguiente = actual.siguiente
-                    actual.siguiente.anterior = actual.anterior
-                    if self.actual == actual:
-                        self.actual = actual.siguiente
-                
-                self.tamanio -= 1
-                return True
-            actual = actual.siguiente
-        return False
+
+        if self.tamanio == 1:
+            self.cabeza = None
+            self.cola = None
+            self.actual = None
+        elif actual == self.cabeza:
+            self.cabeza = actual.siguiente
+            self.cabeza.anterior = None
+            if self.actual == actual:
+                self.actual = self.cabeza
+        elif actual == self.cola:
+            self.cola = actual.anterior
+            self.cola.siguiente = None
+            if self.actual == actual:
+                self.actual = self.cola
+        else:
+            actual.anterior.siguiente = actual.siguiente
+            actual.siguiente.anterior = actual.anterior
+            if self.actual == actual:
+                self.actual = actual.siguiente
+
+        self._quitar_del_arbol(actual)
+        self.tamanio -= 1
+        self._registrar({"op": "eliminar", "id": nodo_id})
+        return True
     
+    def posicion_de(self, nodo_id):
+        """Posición (desde 0) de un nodo en la lista, o None si no existe"""
+        nodo = self.indice.get(nodo_id)
+        if nodo is None:
+            return None
+        posicion = tam_arbol(nodo.izq)
+        while nodo.padre:
+            if nodo is nodo.padre.der:
+                posicion += tam_arbol(nodo.padre.izq) + 1
+            nodo = nodo.padre
+        return posicion
+
+    def obtener_rango(self, inicio, fin):
+        """Canciones en las posiciones [inicio, fin), sin recorrer la lista desde la cabeza"""
+        return [self._item_lista(nodo) for nodo in self._nodos_rango(inicio, fin)]
+
+    def obtener_rango_json(self, inicio, fin):
+        """Como obtener_rango, pero ya serializado a partir del JSON cacheado de cada nodo"""
+        return "[" + ",".join(nodo.serializado_json(nodo is self.actual)
+                              for nodo in self._nodos_rango(inicio, fin)) + "]"
+
     def adelantar(self):
         if self.actual and self.actual.siguiente:
-            self.actual = self.actual.siguiente
+            self._mover_actual(self.actual.siguiente)
             return self.actual.to_dict()
         return None
     
     def retroceder(self):
         if self.actual and self.actual.anterior:
-            self.actual = self.actual.anterior
+            self._mover_actual(self.actual.anterior)
             return self.actual.to_dict()
         return None
     
@@ -389,23 +2865,467 @@ class ListaDobleEnlazada:
         canciones = []
         actual = self.cabeza
         while actual:
-            cancion_dict = actual.to_dict()
-            cancion_dict["es_actual"] = (actual == self.actual)
-            canciones.append(cancion_dict)
+            canciones.append(self._item_lista(actual))
             actual = actual.siguiente
         return canciones
     
     def reproducir_por_id(self, nodo_id):
+        actual = self.indice.get(nodo_id)
+        if actual is None:
+            return None
+        self._mover_actual(actual)
+        return actual.to_dict()
+
+    def resolver(self, nodo_id, uri):
+        """Guarda en el nodo el URI de Spotify encontrado para la canción"""
+        nodo = self.indice.get(nodo_id)
+        if nodo is None or nodo.uri == uri:
+            return False
+        nodo.uri = uri
+        nodo._json = None
+        self._registrar({"op": "resolver", "id": nodo_id, "uri": uri})
+        return True
+
+    def sin_resolver(self, limite):
+        """Hasta `limite` canciones, en orden, que todavía no tienen URI de Spotify"""
+        pendientes = []
         actual = self.cabeza
-        while actual:
-            if actual.id == nodo_id:
-                self.actual = actual
-                return actual.to_dict()
+        while actual and len(pendientes) < limite:
+            if actual.uri is None:
+                pendientes.append(actual.to_dict())
+            actual = actual.siguiente
+        return pendientes
+
+    def uris(self, limite):
+        """URIs de las canciones resueltas en orden, y la posición de la actual entre ellas (o None)"""
+        uris, posicion_actual = [], None
+        actual = self.cabeza
+        while actual and len(uris) < limite:
+            if actual.uri:
+                if actual is self.actual:
+                    posicion_actual = len(uris)
+                uris.append(actual.uri)
             actual = actual.siguiente
+        return uris, posicion_actual
+
+    # ---- persistencia ----
+
+    def aplicar_cambio(self, cambio):
+        """Repite un cambio registrado por otra copia de la lista (otro worker, o el almacén al cargar)"""
+        if cambio["op"] == "insertar":
+            self.agregar_en_posicion(cambio["cancion"], cambio["posicion"])
+        elif cambio["op"] == "insertar_muchos":
+            self.agregar_muchos(cambio["canciones"], cambio["posicion"])
+        elif cambio["op"] == "eliminar":
+            self.eliminar_por_id(cambio["id"])
+        elif cambio["op"] == "actual":
+            self.reproducir_por_id(cambio["actual"])
+        elif cambio["op"] == "resolver":
+            self.resolver(cambio["id"], cambio["uri"])
+        if self.revision != cambio["revision"]:
+            raise ValueError(f"Cambio {cambio['revision']} fuera de orden: la lista está en la revisión {self.revision}")
+
+    def a_snapshot(self):
+        """Estado completo en JSON, para compactar el historial del almacén"""
+        datos = {
+            "revision": self.revision,
+            "contador_ids": self.contador_ids,
+            "actual": self.actual.id if self.actual else None
+        }
+        return json.dumps(datos)[:-1] + ', "canciones": ' + self.obtener_rango_json(0, self.tamanio) + "}"
+
+    @classmethod
+    def desde_snapshot(cls, snapshot):
+        lista = cls()
+        if snapshot:
+            datos = json.loads(snapshot)
+            lista.agregar_muchos(datos["canciones"])
+            lista.actual = lista.indice.get(datos["actual"])
+            lista.contador_ids = datos["contador_ids"]
+            lista.revision = lista.revision_snapshot = datos["revision"]
+            lista.cambios.clear()
+        return lista
+
+# ========================================
+# ALMACENAMIENTO DE LAS PLAYLISTS PERSONALIZADAS
+# ========================================
+# Cada playlist se guarda como un historial de cambios (los mismos que se mandan
+# al navegador) más un snapshot ocasional. Un cambio solo se agrega si el historial
+# sigue en la revisión que vio el worker (compare-and-set), así que varios workers
+# o máquinas pueden escribir la misma playlist sin pisarse.
+
+ALMACEN_PLAYLIST = os.getenv("ALMACEN_PLAYLIST", "redis" if redis_cliente else "sqlite")  # memoria | sqlite | redis
+PLAYLISTS_EN_MEMORIA = int(os.getenv("PLAYLISTS_EN_MEMORIA", 200))
+COMPACTAR_CADA = int(os.getenv("COMPACTAR_CADA", 200))  # cambios mínimos entre snapshots
+REINTENTOS_CONFLICTO = 5
+
+class AlmacenMemoria:
+    """Historial en la memoria del proceso: solo sirve con un worker y se pierde al reiniciar"""
+    def __init__(self):
+        # Las revisiones vuelven a empezar al reiniciar: cambia los ETag de las respuestas
+        self.generacion = secrets.token_hex(4)
+        self.datos = {}  # usuario -> {"base": revisión del snapshot, "snapshot": json, "cambios": [json]}
+        self.lock = threading.Lock()
+
+    def cargar(self, usuario_id):
+        """(snapshot o None, cambios posteriores al snapshot)"""
+        with self.lock:
+            datos = self.datos.get(usuario_id)
+            if datos is None:
+                return None, []
+            return datos["snapshot"], list(datos["cambios"])
+
+    def cambios_desde(self, usuario_id, revision):
+        """Cambios posteriores a `revision`, o None si ya se compactaron y hay que cargar de nuevo"""
+        with self.lock:
+            datos = self.datos.get(usuario_id, {"base": 0, "cambios": []})
+            if not datos["base"] <= revision <= datos["base"] + len(datos["cambios"]):
+                return None
+            return datos["cambios"][revision - datos["base"]:]
+
+    def guardar_cambios(self, usuario_id, revision, cambios):
+        """Agrega los cambios si el historial sigue en `revision`; devuelve si se guardaron"""
+        with self.lock:
+            datos = self.datos.setdefault(usuario_id, {"base": 0, "snapshot": None, "cambios": []})
+            if datos["base"] + len(datos["cambios"]) != revision:
+                return False
+            datos["cambios"].extend(cambios)
+            return True
+
+    def reemplazar(self, usuario_id, revision_anterior, revision, snapshot):
+        """Como guardar_cambios, pero guarda el snapshot en `revision` en lugar de los cambios"""
+        with self.lock:
+            datos = self.datos.setdefault(usuario_id, {"base": 0, "snapshot": None, "cambios": []})
+            if datos["base"] + len(datos["cambios"]) != revision_anterior:
+                return False
+            datos.update(base=revision, snapshot=snapshot, cambios=[])
+            return True
+
+    def compactar(self, usuario_id, revision, snapshot):
+        """Reemplaza los cambios hasta `revision` por el snapshot"""
+        with self.lock:
+            datos = self.datos.get(usuario_id)
+            if datos is None or revision <= datos["base"]:
+                return
+            datos["cambios"] = datos["cambios"][revision - datos["base"]:]
+            datos["base"], datos["snapshot"] = revision, snapshot
+
+class AlmacenSQLite:
+    """Historial en SQLite con WAL: persistente y compartido por los workers de una máquina"""
+    generacion = ""  # las revisiones sobreviven a los reinicios
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.local = threading.local()  # una conexión por hilo
+        self._conexion().executescript("""
+            CREATE TABLE IF NOT EXISTS playlist_cambios (
+                usuario TEXT NOT NULL,
+                revision INTEGER NOT NULL,
+                cambio TEXT NOT NULL,
+                PRIMARY KEY (usuario, revision)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS playlist_snapshots (
+                usuario TEXT PRIMARY KEY,
+                revision INTEGER NOT NULL,
+                snapshot TEXT NOT NULL
+            );
+        """)
+
+    def _conexion(self):
+        conexion = getattr(self.local, "conexion", None)
+        if conexion is None:
+            conexion = self.local.conexion = conectar_sqlite(self.ruta)
+        return conexion
+
+    def _base(self, conexion, usuario_id):
+        fila = conexion.execute("SELECT revision, snapshot FROM playlist_snapshots WHERE usuario = ?",
+                                (usuario_id,)).fetchone()
+        return fila or (0, None)
+
+    def cargar(self, usuario_id):
+        conexion = self._conexion()
+        conexion.execute("BEGIN")  # lectura consistente de snapshot + cambios
+        try:
+            base, snapshot = self._base(conexion, usuario_id)
+            filas = conexion.execute(
+                "SELECT cambio FROM playlist_cambios WHERE usuario = ? AND revision > ? ORDER BY revision",
+                (usuario_id, base)).fetchall()
+        finally:
+            conexion.execute("COMMIT")
+        return snapshot, [fila[0] for fila in filas]
+
+    def cambios_desde(self, usuario_id, revision):
+        conexion = self._conexion()
+        # Se pide también el cambio `revision` para confirmar que el historial no se compactó
+        filas = conexion.execute(
+            "SELECT revision, cambio FROM playlist_cambios WHERE usuario = ? AND revision >= ? ORDER BY revision",
+            (usuario_id, revision)).fetchall()
+        if filas and filas[0][0] == revision:
+            return [fila[1] for fila in filas[1:]]
+        if revision == self._base(conexion, usuario_id)[0] and (not filas or filas[0][0] == revision + 1):
+            return [fila[1] for fila in filas]
         return None
 
-# Instancia global de la playlist personalizada
-mi_playlist = ListaDobleEnlazada()
+    def _ultima(self, conexion, usuario_id):
+        return conexion.execute(
+            "SELECT COALESCE((SELECT MAX(revision) FROM playlist_cambios WHERE usuario = ?),"
+            " (SELECT revision FROM playlist_snapshots WHERE usuario = ?), 0)",
+            (usuario_id, usuario_id)).fetchone()[0]
+
+    def guardar_cambios(self, usuario_id, revision, cambios):
+        conexion = self._conexion()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            if self._ultima(conexion, usuario_id) != revision:
+                conexion.execute("ROLLBACK")
+                return False
+            conexion.executemany(
+                "INSERT INTO playlist_cambios (usuario, revision, cambio) VALUES (?, ?, ?)",
+                [(usuario_id, revision + i, cambio) for i, cambio in enumerate(cambios, 1)])
+            conexion.execute("COMMIT")
+            return True
+        except Exception:
+            conexion.execute("ROLLBACK")
+            raise
+
+    def reemplazar(self, usuario_id, revision_anterior, revision, snapshot):
+        conexion = self._conexion()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            if self._ultima(conexion, usuario_id) != revision_anterior:
+                conexion.execute("ROLLBACK")
+                return False
+            conexion.execute(
+                "INSERT INTO playlist_snapshots (usuario, revision, snapshot) VALUES (?, ?, ?)"
+                " ON CONFLICT (usuario) DO UPDATE SET revision = excluded.revision, snapshot = excluded.snapshot",
+                (usuario_id, revision, snapshot))
+            conexion.execute("DELETE FROM playlist_cambios WHERE usuario = ?", (usuario_id,))
+            conexion.execute("COMMIT")
+            return True
+        except Exception:
+            conexion.execute("ROLLBACK")
+            raise
+
+    def compactar(self, usuario_id, revision, snapshot):
+        conexion = self._conexion()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            conexion.execute(
+                "INSERT INTO playlist_snapshots (usuario, revision, snapshot) VALUES (?, ?, ?)"
+                " ON CONFLICT (usuario) DO UPDATE SET revision = excluded.revision, snapshot = excluded.snapshot"
+                " WHERE excluded.revision > playlist_snapshots.revision",
+                (usuario_id, revision, snapshot))
+            conexion.execute("DELETE FROM playlist_cambios WHERE usuario = ? AND revision <= ?",
+                             (usuario_id, revision))
+            conexion.execute("COMMIT")
+        except Exception:
+            conexion.execute("ROLLBACK")
+            raise
+
+class AlmacenRedis:
+    """Historial en Redis (una lista de cambios y un hash con el snapshot), compartido entre máquinas.
+
+    Cada operación es un script Lua, así que la comprobación de revisión y la escritura son atómicas.
+    """
+    generacion = ""
+    CARGAR = """
+        return {redis.call('HGET', KEYS[1], 'snapshot') or '', redis.call('LRANGE', KEYS[2], 0, -1)}
+    """
+    CAMBIOS_DESDE = """
+        local base = tonumber(redis.call('HGET', KEYS[1], 'base') or '0')
+        local revision = tonumber(ARGV[1])
+        if revision < base or revision > base + redis.call('LLEN', KEYS[2]) then
+            return false
+        end
+        return redis.call('LRANGE', KEYS[2], revision - base, -1)
+    """
+    GUARDAR_CAMBIOS = """
+        local base = tonumber(redis.call('HGET', KEYS[1], 'base') or '0')
+        if base + redis.call('LLEN', KEYS[2]) ~= tonumber(ARGV[1]) then
+            return 0
+        end
+        redis.call('RPUSH', KEYS[2], unpack(ARGV, 2))
+        return 1
+    """
+    REEMPLAZAR = """
+        local base = tonumber(redis.call('HGET', KEYS[1], 'base') or '0')
+        if base + redis.call('LLEN', KEYS[2]) ~= tonumber(ARGV[1]) then
+            return 0
+        end
+        redis.call('DEL', KEYS[2])
+        redis.call('HSET', KEYS[1], 'base', ARGV[2], 'snapshot', ARGV[3])
+        return 1
+    """
+    COMPACTAR = """
+        local base = tonumber(redis.call('HGET', KEYS[1], 'base') or '0')
+        local compactados = tonumber(ARGV[1]) - base
+        if compactados <= 0 then
+            return 0
+        end
+        redis.call('LTRIM', KEYS[2], compactados, -1)
+        redis.call('HSET', KEYS[1], 'base', ARGV[1], 'snapshot', ARGV[2])
+        return 1
+    """
+
+    def __init__(self, cliente):
+        self.cargar_script = cliente.register_script(self.CARGAR)
+        self.cambios_desde_script = cliente.register_script(self.CAMBIOS_DESDE)
+        self.guardar_script = cliente.register_script(self.GUARDAR_CAMBIOS)
+        self.reemplazar_script = cliente.register_script(self.REEMPLAZAR)
+        self.compactar_script = cliente.register_script(self.COMPACTAR)
+
+    def _claves(self, usuario_id):
+        return [f"mi_playlist:{usuario_id}", f"mi_playlist:{usuario_id}:cambios"]
+
+    def cargar(self, usuario_id):
+        snapshot, cambios = self.cargar_script(keys=self._claves(usuario_id))
+        return snapshot or None, cambios
+
+    def cambios_desde(self, usuario_id, revision):
+        return self.cambios_desde_script(keys=self._claves(usuario_id), args=[revision])
+
+    def guardar_cambios(self, usuario_id, revision, cambios):
+        return self.guardar_script(keys=self._claves(usuario_id), args=[revision, *cambios]) == 1
+
+    def reemplazar(self, usuario_id, revision_anterior, revision, snapshot):
+        return self.reemplazar_script(keys=self._claves(usuario_id),
+                                      args=[revision_anterior, revision, snapshot]) == 1
+
+    def compactar(self, usuario_id, revision, snapshot):
+        self.compactar_script(keys=self._claves(usuario_id), args=[revision, snapshot])
+
+def crear_almacen_playlist():
+    if ALMACEN_PLAYLIST == "sqlite":
+        return AlmacenSQLite(SQLITE_PATH)
+    if ALMACEN_PLAYLIST == "redis":
+        if redis_cliente:
+            return AlmacenRedis(redis_cliente)
+        print("ALMACEN_PLAYLIST=redis pero Redis no está disponible; las playlists quedan en SQLite")
+        return AlmacenSQLite(SQLITE_PATH)
+    return AlmacenMemoria()
+
+class ConflictoPlaylist(Exception):
+    """Otros workers siguen modificando la misma playlist y se agotaron los reintentos"""
+
+class PlaylistsUsuarios:
+    """Copias en memoria de las playlists de los usuarios recientes (LRU), al día con el almacén.
+
+    Las lecturas aplican primero lo que otros workers hayan escrito. Las escrituras
+    guardan sus cambios con compare-and-set; si otro worker escribió antes, la copia
+    se descarta, se vuelve a cargar y la modificación se reintenta.
+    """
+    def __init__(self, almacen, tamanio_max):
+        self.almacen = almacen
+        self.tamanio_max = tamanio_max
+        self.listas = OrderedDict()  # usuario -> ListaDobleEnlazada
+        self.lock = threading.Lock()
+
+    def _en_memoria(self, usuario_id):
+        with self.lock:
+            lista = self.listas.get(usuario_id)
+            if lista is not None:
+                self.listas.move_to_end(usuario_id)
+                return lista
+        snapshot, cambios = self.almacen.cargar(usuario_id)
+        lista = ListaDobleEnlazada.desde_snapshot(snapshot)
+        for cambio in cambios:
+            lista.aplicar_cambio(json.loads(cambio))
+        with self.lock:
+            lista = self.listas.setdefault(usuario_id, lista)
+            self.listas.move_to_end(usuario_id)
+            while len(self.listas) > self.tamanio_max:
+                self.listas.popitem(last=False)
+        return lista
+
+    def _ponerse_al_dia(self, usuario_id, lista):
+        """Aplica los cambios de otros workers; False si la copia ya no sirve y hay que recargarla"""
+        with self.lock:
+            # Otro hilo pudo descartarla (con cambios que no llegaron al almacén) mientras esperábamos el lock
+            if self.listas.get(usuario_id) is not lista:
+                return False
+        cambios = self.almacen.cambios_desde(usuario_id, lista.revision)
+        if cambios is None:
+            return False
+        try:
+            for cambio in cambios:
+                lista.aplicar_cambio(json.loads(cambio))
+        except (KeyError, ValueError) as e:
+            print(f"Playlist de {usuario_id} desincronizada, se recarga: {e}")
+            return False
+        return True
+
+    def descartar(self, usuario_id, lista):
+        with self.lock:
+            if self.listas.get(usuario_id) is lista:
+                del self.listas[usuario_id]
+
+    def obtener(self, usuario_id):
+        """Playlist del usuario para leer (con lista.lock)"""
+        for _ in range(REINTENTOS_CONFLICTO):
+            lista = self._en_memoria(usuario_id)
+            with lista.lock:
+                if self._ponerse_al_dia(usuario_id, lista):
+                    return lista
+            self.descartar(usuario_id, lista)
+        raise ConflictoPlaylist(usuario_id)
+
+    def modificar(self, usuario_id, mutar):
+        """Ejecuta mutar(lista) y guarda sus cambios; devuelve (lista, revisión anterior, resultado)"""
+        for _ in range(REINTENTOS_CONFLICTO):
+            lista = self._en_memoria(usuario_id)
+            snapshot = None
+            with lista.lock:
+                if not self._ponerse_al_dia(usuario_id, lista):
+                    self.descartar(usuario_id, lista)
+                    continue
+                revision = lista.revision
+                resultado = mutar(lista)
+                cambios = lista.cambios_desde(revision)
+                if cambios == []:
+                    return lista, revision, resultado
+                guardado = False
+                try:
+                    if cambios is None:
+                        # Más cambios de los que caben en el historial: se guarda la lista entera
+                        guardado = self.almacen.reemplazar(usuario_id, revision, lista.revision, lista.a_snapshot())
+                        if guardado:
+                            lista.revision_snapshot = lista.revision
+                    else:
+                        guardado = self.almacen.guardar_cambios(
+                            usuario_id, revision, [json.dumps(cambio) for cambio in cambios])
+                finally:
+                    if not guardado:
+                        # La copia tiene cambios que no están en el almacén
+                        self.descartar(usuario_id, lista)
+                if guardado and lista.revision - lista.revision_snapshot >= max(COMPACTAR_CADA, lista.tamanio):
+                    snapshot = lista.a_snapshot()
+                    revision_snapshot = lista.revision_snapshot = lista.revision
+            if guardado:
+                if snapshot:
+                    self.almacen.compactar(usuario_id, revision_snapshot, snapshot)
+                return lista, revision, resultado
+        raise ConflictoPlaylist(usuario_id)
+
+playlists_usuarios = PlaylistsUsuarios(crear_almacen_playlist(), PLAYLISTS_EN_MEMORIA)
+
+def usuario_de_la_playlist():
+    """Dueño de la playlist: el usuario de Spotify, o un invitado identificado por su sesión.
+
+    La playlist es local: con el usuario en la sesión no hace falta ni el token ni Spotify.
+    """
+    usuario_id = usuario_verificado()
+    if usuario_id:
+        return usuario_id
+    sp = get_spotify()
+    if sp:
+        return get_usuario_id(sp)
+    if "invitado" not in session:
+        session["invitado"] = "invitado-" + secrets.token_hex(8)
+    return session["invitado"]
+
+@app.errorhandler(ConflictoPlaylist)
+def conflicto_playlist(e):
+    return jsonify({"success": False, "message": "La playlist está cambiando, intenta de nuevo"}), 409
 
 # ========================================
 # RUTAS PARA LA PLAYLIST PERSONALIZADA
@@ -415,12 +3335,51 @@ mi_playlist = ListaDobleEnlazada()
 def mi_playlist_page():
     return render_template("mi_playlist.html")
 
+def respuesta_con_cambios(lista, revision_anterior, **datos):
+    """Respuesta de una mutación: solo los cambios desde `revision_anterior`, no la lista entera"""
+    with lista.lock:
+        datos["cambios"] = lista.cambios_desde(revision_anterior)
+        datos["revision"] = lista.revision
+        datos["tamanio"] = lista.tamanio
+    return jsonify(datos)
+
+def respuesta_con_canciones_json(canciones_json, **datos):
+    """Como jsonify, pero la lista de canciones llega ya serializada desde la cache de cada nodo"""
+    cuerpo = json.dumps(datos)[:-1] + ', "canciones": ' + canciones_json + "}\n"
+    return app.response_class(cuerpo, mimetype="application/json")
+
 @app.route("/api/mi_playlist/canciones", methods=["GET"])
 def obtener_mis_canciones():
-    return jsonify({
-        "canciones": mi_playlist.obtener_todas(),
-        "tamanio": mi_playlist.tamanio
-    })
+    """Lista completa, una página (offset/limit) o solo los cambios desde since_revision"""
+    since_revision = request.args.get("since_revision", type=int)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = request.args.get("limit", type=int)
+
+    usuario_id = usuario_de_la_playlist()
+    lista = playlists_usuarios.obtener(usuario_id)
+
+    def generar():
+        if since_revision is not None:
+            cambios = lista.cambios_desde(since_revision)
+            if cambios is not None:
+                return jsonify({
+                    "cambios": cambios,
+                    "revision": lista.revision,
+                    "tamanio": lista.tamanio
+                })
+
+        fin = lista.tamanio if limit is None else offset + max(limit, 0)
+        return respuesta_con_canciones_json(
+            lista.obtener_rango_json(offset, fin),
+            offset=offset,
+            tamanio=lista.tamanio,
+            revision=lista.revision
+        )
+
+    with lista.lock:
+        etag = etag_de(usuario_id, playlists_usuarios.almacen.generacion, lista.revision,
+                       since_revision, offset, limit)
+        return respuesta_condicional(etag, generar)
 
 @app.route("/api/mi_playlist/agregar", methods=["POST"])
 def agregar_a_mi_playlist():
@@ -434,81 +3393,76 @@ def agregar_a_mi_playlist():
     
     posicion = data.get("posicion", "final")
     
-    if posicion == "inicio":
-        nodo_id = mi_playlist.agregar_al_inicio(cancion)
-    elif posicion == "final":
-        nodo_id = mi_playlist.agregar_al_final(cancion)
-    else:
-        try:
-            pos = int(posicion)
-            nodo_id = mi_playlist.agregar_en_posicion(cancion, pos)
-        except:
-            nodo_id = mi_playlist.agregar_al_final(cancion)
-    
-    return jsonify({
-        "success": True,
-        "id": nodo_id,
-        "canciones": mi_playlist.obtener_todas()
-    })
+    def agregar(lista):
+        if posicion == "inicio":
+            return lista.agregar_al_inicio(cancion)
+        elif posicion == "final":
+            return lista.agregar_al_final(cancion)
+        else:
+            try:
+                pos = int(posicion)
+                return lista.agregar_en_posicion(cancion, pos)
+            except:
+                return lista.agregar_al_final(cancion)
+
+    lista, revision, nodo_id = playlists_usuarios.modificar(usuario_de_la_playlist(), agregar)
+    return respuesta_con_cambios(lista, revision, success=True, id=nodo_id)
 
 @app.route("/api/mi_playlist/eliminar/<nodo_id>", methods=["DELETE"])
 def eliminar_de_mi_playlist(nodo_id):
-    success = mi_playlist.eliminar_por_id(nodo_id)
-    return jsonify({
-        "success": success,
-        "canciones": mi_playlist.obtener_todas(),
-        "actual": mi_playlist.obtener_actual()
-    })
+    lista, revision, (success, actual) = playlists_usuarios.modificar(
+        usuario_de_la_playlist(), lambda lista: (lista.eliminar_por_id(nodo_id), lista.obtener_actual()))
+    return respuesta_con_cambios(lista, revision, success=success, actual=actual)
 
 @app.route("/api/mi_playlist/reproducir/<nodo_id>", methods=["POST"])
 def reproducir_de_mi_playlist(nodo_id):
-    cancion = mi_playlist.reproducir_por_id(nodo_id)
+    lista, revision, cancion = playlists_usuarios.modificar(
+        usuario_de_la_playlist(), lambda lista: lista.reproducir_por_id(nodo_id))
     if cancion:
-        return jsonify({
-            "success": True,
-            "cancion": cancion,
-            "canciones": mi_playlist.obtener_todas()
-        })
+        return respuesta_con_cambios(lista, revision, success=True, cancion=cancion)
     return jsonify({"success": False}), 404
 
 @app.route("/api/mi_playlist/adelantar", methods=["POST"])
 def adelantar_mi_playlist():
-    cancion = mi_playlist.adelantar()
+    lista, revision, cancion = playlists_usuarios.modificar(
+        usuario_de_la_playlist(), lambda lista: lista.adelantar())
     if cancion:
-        return jsonify({
-            "success": True,
-            "cancion": cancion,
-            "canciones": mi_playlist.obtener_todas()
-        })
+        return respuesta_con_cambios(lista, revision, success=True, cancion=cancion)
     return jsonify({"success": False, "message": "No hay siguiente canción"})
 
 @app.route("/api/mi_playlist/retroceder", methods=["POST"])
 def retroceder_mi_playlist():
-    cancion = mi_playlist.retroceder()
+    lista, revision, cancion = playlists_usuarios.modificar(
+        usuario_de_la_playlist(), lambda lista: lista.retroceder())
     if cancion:
-        return jsonify({
-            "success": True,
-            "cancion": cancion,
-            "canciones": mi_playlist.obtener_todas()
-        })
+        return respuesta_con_cambios(lista, revision, success=True, cancion=cancion)
     return jsonify({"success": False, "message": "No hay canción anterior"})
 
 @app.route("/api/mi_playlist/actual", methods=["GET"])
 def obtener_actual_mi_playlist():
-    cancion = mi_playlist.obtener_actual()
-    if cancion:
-        return jsonify(cancion)
-    return jsonify({
-        "titulo": "No hay canciones",
-        "artista": "Agrega una canción para empezar",
-        "duracion": "0:00"
-    })
+    usuario_id = usuario_de_la_playlist()
+    lista = playlists_usuarios.obtener(usuario_id)
+
+    def generar():
+        cancion = lista.obtener_actual()
+        if cancion:
+            return jsonify(cancion)
+        return jsonify({
+            "titulo": "No hay canciones",
+            "artista": "Agrega una canción para empezar",
+            "duracion": "0:00"
+        })
+
+    with lista.lock:
+        etag = etag_de(usuario_id, playlists_usuarios.almacen.generacion, lista.revision, "actual")
+        return respuesta_condicional(etag, generar)
     
 # ========================================
 # RUTA PARA REPRODUCIR EN SPOTIFY DESDE MI PLAYLIST
 # ========================================
 
 @app.route("/api/mi_playlist/reproducir_spotify/<nodo_id>", methods=["POST"])
+@prioridad_spotify(PRIORIDAD_ALTA)
 def reproducir_spotify_desde_mi_playlist(nodo_id):
     """Busca y reproduce en Spotify la canción de mi playlist"""
     # <CHANGE> Agregar get_spotify() que faltaba
@@ -518,66 +3472,46 @@ def reproducir_spotify_desde_mi_playlist(nodo_id):
     
     try:
         # Obtener la canción de la lista doblemente enlazada
-        cancion = mi_playlist.reproducir_por_id(nodo_id)
+        lista, revision, cancion = playlists_usuarios.modificar(
+            get_usuario_id(sp), lambda lista: lista.reproducir_por_id(nodo_id))
         
         if not cancion:
             return jsonify({"success": False, "message": "Canción no encontrada"}), 404
         
-        # Buscar la canción en Spotify
-        query = f"{cancion['titulo']} {cancion['artista']}"
-        resultados = sp.search(q=query, type='track', limit=1)
-        
-        if not resultados['tracks']['items']:
-            return jsonify({
-                "success": False, 
-                "message": f"No se encontró '{cancion['titulo']}' en Spotify"
-            }), 404
+        if cancion["uri"]:
+            # Ya resuelta: sin búsqueda, los datos del track salen de la cache si están
+            track = cache_busquedas.obtener(clave_busqueda(cancion["titulo"], cancion["artista"]))
+            if not track or track["uri"] != cancion["uri"]:
+                track = {"name": cancion["titulo"], "artist": cancion["artista"], "album": cancion["album"],
+                         "image": None, "uri": cancion["uri"]}
+        else:
+            track = buscar_track(sp, cancion["titulo"], cancion["artista"])
+            if not track["uri"]:
+                return jsonify({
+                    "success": False, 
+                    "message": f"No se encontró '{cancion['titulo']}' en Spotify"
+                }), 404
+            lista, _, _ = playlists_usuarios.modificar(
+                get_usuario_id(sp), lambda lista: lista.resolver(nodo_id, track["uri"]))
+            cancion["uri"] = track["uri"]
         
-        track = resultados['tracks']['items'][0]
         track_uri = track['uri']
         
         # Reproducir en Spotify
-        try:
-            sp.start_playback(uris=[track_uri])
-            
-            return jsonify({
-                "success": True,
-                "cancion": cancion,
-                "spotify_track": {
-                    "name": track['name'],
-                    "artist": track['artists'][0]['name'],
-                    "album": track['album']['name'],
-                    "image": track['album']['images'][0]['url'] if track['album']['images'] else None,
-                    "uri": track_uri
-                },
-                "canciones": mi_playlist.obtener_todas()
-            })
-            
-        except Exception as playback_error:
-            # Si no hay dispositivo activo, intentar transferir a uno disponible
-            devices = sp.devices()
-            if devices['devices']:
-                sp.transfer_playback(devices['devices'][0]['id'], force_play=True)
-                sp.start_playback(uris=[track_uri])
-                
-                return jsonify({
-                    "success": True,
-                    "cancion": cancion,
-                    "spotify_track": {
-                        "name": track['name'],
-                        "artist": track['artists'][0]['name'],
-                        "album": track['album']['name'],
-                        "image": track['album']['images'][0]['url'] if track['album']['images'] else None,
-                        "uri": track_uri
-                    },
-                    "canciones": mi_playlist.obtener_todas()
-                })
-            else:
-                return jsonify({
-                    "success": False,
-                    "message": "No hay dispositivos de Spotify activos. Abre Spotify en tu dispositivo."
-                }), 400
+        reproducir_en_spotify(sp, uris=[track_uri])
+        
+        return respuesta_con_cambios(
+            lista,
+            revision,
+            success=True,
+            cancion=cancion,
+            spotify_track=track
+        )
         
+    except SinDispositivo:
+        return jsonify({"success": False, "message": MENSAJE_SIN_DISPOSITIVO}), 400
+    except LimiteSpotify:
+        raise
     except Exception as e:
         print(f"Error reproduciendo en Spotify: {str(e)}")
         return jsonify({
@@ -585,6 +3519,195 @@ def reproducir_spotify_desde_mi_playlist(nodo_id):
             "message": f"Error: {str(e)}"
         }), 500
         
+RESOLVER_MAX = int(os.getenv("RESOLVER_MAX", 500))  # canciones por llamada a /resolver
+RESOLVER_EN_PARALELO = int(os.getenv("RESOLVER_EN_PARALELO", 4))
+COLA_MAX_URIS = 500
+
+@app.route("/api/mi_playlist/resolver", methods=["POST"])
+def resolver_mi_playlist():
+    """Busca en Spotify, en paralelo, las canciones de mi playlist que todavía no tienen URI"""
+    sp = get_spotify()
+    if not sp:
+        return jsonify({"success": False, "message": "No autenticado"}), 401
+
+    usuario_id = get_usuario_id(sp)
+    lista = playlists_usuarios.obtener(usuario_id)
+    with lista.lock:
+        pendientes = lista.sin_resolver(RESOLVER_MAX)
+
+    # Canciones repetidas en la lista se buscan una sola vez
+    busquedas = list({clave_busqueda(c["titulo"], c["artista"]): c for c in pendientes}.values())
+
+    def buscar(cancion):
+        try:
+            return buscar_track(sp, cancion["titulo"], cancion["artista"])["uri"]
+        except LimiteSpotify:
+            raise
+        except Exception as e:
+            print(f"Error buscando '{cancion['titulo']}' en Spotify:", e)
+            return None
+
+    uris = {}
+    for cancion, uri in zip(busquedas, mapear_acotado(buscar, busquedas, RESOLVER_EN_PARALELO)):
+        uris[clave_busqueda(cancion["titulo"], cancion["artista"])] = uri
+
+    def guardar(lista):
+        resueltas = 0
+        for cancion in pendientes:
+            uri = uris.get(clave_busqueda(cancion["titulo"], cancion["artista"]))
+            if uri and lista.resolver(cancion["id"], uri):
+                resueltas += 1
+        return resueltas
+
+    lista, revision, resueltas = playlists_usuarios.modificar(usuario_id, guardar)
+    return respuesta_con_cambios(lista, revision, success=True, resueltas=resueltas,
+                                 no_encontradas=len(pendientes) - resueltas,
+                                 completo=len(pendientes) < RESOLVER_MAX)
+
+@app.route("/api/mi_playlist/reproducir_todo_spotify", methods=["POST"])
+@prioridad_spotify(PRIORIDAD_ALTA)
+def reproducir_todo_en_spotify():
+    """Manda a Spotify toda la playlist ya resuelta como una sola lista de URIs, empezando por la actual"""
+    sp = get_spotify()
+    if not sp:
+        return jsonify({"success": False, "message": "No autenticado"}), 401
+
+    lista = playlists_usuarios.obtener(get_usuario_id(sp))
+    with lista.lock:
+        uris, posicion = lista.uris(COLA_MAX_URIS)
+    if not uris:
+        return jsonify({"success": False, "message": "Ninguna canción de la playlist está resuelta en Spotify"}), 404
+
+    try:
+        reproducir_en_spotify(sp, uris=uris, offset={"position": posicion or 0})
+        return jsonify({"success": True, "canciones": len(uris)})
+    except SinDispositivo:
+        return jsonify({"success": False, "message": MENSAJE_SIN_DISPOSITIVO}), 400
+    except LimiteSpotify:
+        raise
+    except Exception as e:
+        print(f"Error reproduciendo mi playlist en Spotify: {str(e)}")
+        return jsonify({"success": False, "message": f"Error: {str(e)}"}), 500
+
+# ---- importar en bloque ----
+
+IMPORTAR_MAX = int(os.getenv("IMPORTAR_MAX", 10000))  # canciones por importación
+
+def formato_duracion(duracion_ms):
+    segundos = (duracion_ms or 0) // 1000
+    return f"{segundos // 60}:{segundos % 60:02d}"
+
+def cancion_importada(titulo, artista, duracion_ms, album, uri):
+    """Canción de mi playlist que viene de Spotify, ya resuelta (con su URI)"""
+    return {"titulo": titulo, "artista": artista, "duracion": formato_duracion(duracion_ms), "album": album, "uri": uri}
+
+def canciones_a_importar(sp, datos):
+    """Genera (canciones, total) por cada página de la fuente: playlist_id, album_id o una lista de canciones"""
+    if datos.get("playlist_id"):
+        playlist_id = datos["playlist_id"]
+        snapshot_id = obtener_playlist(sp, playlist_id, get_usuario_id(sp), renovar=True).get("snapshot_id")
+        primera = obtener_pagina_playlist(sp, playlist_id, snapshot_id, 0)
+        paginas = recorrer_paginas(
+            primera, lambda offset: obtener_pagina_playlist(sp, playlist_id, snapshot_id, offset),
+            PAGINA_PLAYLIST_MAX)
+        for pagina in paginas:
+            canciones = []
+            for item in pagina["items"]:
+                track = item.get("track")
+                if track and track.get("id"):  # sin canciones locales ni no disponibles
+                    canciones.append(cancion_importada(
+                        track["name"], track["artists"][0]["name"] if track["artists"] else "",
+                        track.get("duration_ms"), track["album"]["name"], track["uri"]))
+            yield canciones, pagina["total"]
+    elif datos.get("album_id"):
+        album = obtener_album_tracks(sp, datos["album_id"])
+        yield [cancion_importada(track["name"], track.get("artist", ""), track.get("duration_ms"),
+                                 album.get("name", ""), track["uri"])
+               for track in album["items"]], album["total"]
+    else:
+        canciones = []
+        for cancion in datos.get("canciones") or []:
+            if not isinstance(cancion, dict) or not cancion.get("titulo") or not cancion.get("artista"):
+                raise ValueError("Cada canción necesita al menos titulo y artista")
+            canciones.append({
+                "titulo": str(cancion["titulo"]),
+                "artista": str(cancion["artista"]),
+                "duracion": str(cancion.get("duracion") or "3:30"),
+                "album": str(cancion.get("album") or ""),
+                "uri": cancion.get("uri") if isinstance(cancion.get("uri"), str) else None
+            })
+        yield canciones, len(canciones)
+
+@app.route("/api/mi_playlist/importar", methods=["POST"])
+def importar_a_mi_playlist():
+    """Agrega de una vez una playlist o un álbum de Spotify, o una lista de canciones.
+
+    Las páginas de Spotify se piden en paralelo y todas las canciones entran en la
+    lista como un solo cambio. Con ?progreso=1 responde NDJSON: una línea por
+    página cargada y al final el resumen.
+    """
+    datos = request.get_json(silent=True)
+    if isinstance(datos, list):
+        datos = {"canciones": datos}
+    if not isinstance(datos, dict) or not (datos.get("playlist_id") or datos.get("album_id")
+                                           or isinstance(datos.get("canciones"), list)):
+        return jsonify({"success": False, "message": "Se espera playlist_id, album_id o una lista de canciones"}), 400
+
+    sp = get_spotify()
+    if not sp and (datos.get("playlist_id") or datos.get("album_id")):
+        return jsonify({"success": False, "message": "No autenticado"}), 401
+    usuario_id = usuario_de_la_playlist()
+
+    posicion = datos.get("posicion", "final")
+    if posicion == "inicio":
+        posicion = 0
+    elif posicion == "final":
+        posicion = None
+    else:
+        try:
+            posicion = int(posicion)
+        except (TypeError, ValueError):
+            posicion = None
+
+    def importar():
+        """Genera el progreso y, al final, el resumen"""
+        canciones, truncada = [], False
+        for pagina, total in canciones_a_importar(sp, datos):
+            canciones.extend(pagina)
+            if len(canciones) >= IMPORTAR_MAX:
+                truncada = total > IMPORTAR_MAX
+                del canciones[IMPORTAR_MAX:]
+                break
+            yield {"cargadas": len(canciones), "total": total}
+        lista, _, ids = playlists_usuarios.modificar(
+            usuario_id, lambda lista: lista.agregar_muchos(canciones, posicion))
+        with lista.lock:
+            yield {"success": True, "importadas": len(ids), "truncada": truncada,
+                   "revision": lista.revision, "tamanio": lista.tamanio}
+
+    if request.args.get("progreso"):
+        def lineas():
+            try:
+                for linea in importar():
+                    yield json.dumps(linea) + "\n"
+            except Exception as e:
+                print(f"Error importando a mi playlist: {str(e)}")
+                yield json.dumps({"success": False, "message": f"Error: {str(e)}"}) + "\n"
+        return Response(stream_with_context(lineas()), mimetype="application/x-ndjson",
+                        headers={"X-Accel-Buffering": "no"})
+
+    try:
+        for resumen in importar():
+            pass
+        return jsonify(resumen)
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    except (ConflictoPlaylist, LimiteSpotify):
+        raise
+    except Exception as e:
+        print(f"Error importando a mi playlist: {str(e)}")
+        return jsonify({"success": False, "message": f"Error: {str(e)}"}), 500
+
 @app.route("/api/album/<album_id>/tracks")
 def get_album_tracks(album_id):
     sp = get_spotify()
@@ -592,14 +3715,17 @@ def get_album_tracks(album_id):
         return jsonify({"error": "No autenticado"}), 401
     
     try:
-        album = sp.album_tracks(album_id)
+        album = obtener_album_tracks(sp, album_id)
         tracks = [{"id": track["id"], "name": track["name"]} for track in album["items"]]
-        return jsonify({"tracks": tracks})
+        return con_etag_del_contenido(jsonify({"tracks": tracks}))
+    except LimiteSpotify:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 400
     
     
 @app.route("/play_album/<album_id>", methods=["POST"])
+@prioridad_spotify(PRIORIDAD_ALTA)
 def play_album(album_id):
     """Reproduce un álbum completo en Spotify"""
     sp = get_spotify()
@@ -607,31 +3733,14 @@ def play_album(album_id):
         return jsonify({"success": False, "message": "No autenticado"}), 401
     
     try:
-        # Obtener las canciones del álbum
-        album = sp.album_tracks(album_id)
-        
-        if not album['items']:
-            return jsonify({"success": False, "message": "Álbum vacío"}), 404
-        
-        # Crear lista de URIs de las canciones
-        track_uris = [f"spotify:track:{track['id']}" for track in album['items']]
-        
-        # Reproducir el álbum
-        try:
-            sp.start_playback(uris=track_uris)
-            return jsonify({"success": True, "message": "Álbum reproducido"})
-        except Exception as playback_error:
-            devices = sp.devices()
-            if devices['devices']:
-                sp.transfer_playback(devices['devices'][0]['id'], force_play=True)
-                sp.start_playback(uris=track_uris)
-                return jsonify({"success": True, "message": "Álbum reproducido"})
-            else:
-                return jsonify({
-                    "success": False,
-                    "message": "No hay dispositivos de Spotify activos. Abre Spotify en tu dispositivo."
-                }), 400
+        # El álbum como contexto: Spotify ya conoce sus canciones y sigue con la siguiente al terminar cada una
+        reproducir_en_spotify(sp, context_uri=f"spotify:album:{album_id}")
+        return jsonify({"success": True, "message": "Álbum reproducido"})
                 
+    except SinDispositivo:
+        return jsonify({"success": False, "message": MENSAJE_SIN_DISPOSITIVO}), 400
+    except LimiteSpotify:
+        raise
     except Exception as e:
         print(f"Error reproduciendo álbum: {str(e)}")
         return jsonify({"success": False, "message": f"Error: {str(e)}"}), 500
@@ -0,0 +1,103 @@
+"""
+Índice local de búsqueda (IndiceTracks) con muchos tracks sintéticos: tiempo de
+construcción, latencia de las consultas de autocompletado (prefijos de 2 a 6
+letras, títulos completos, título + artista y errores de tipeo), y tamaño y
+tiempo de carga del snapshot comprimido.
+
+Uso:
+    python benchmarks/bench_busqueda.py --tracks 100000 --consultas 2000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app import IndiceTracks
+
+PALABRAS = ("amor noche corazón fuego luna sol mar cielo vida baila canción sueño tiempo calle "
+            "ciudad lluvia verano invierno perdido solo juntos siempre nunca otra vez quiero "
+            "volver mañana ayer estrella camino ritmo mundo").split()
+
+
+def entrada(i, rng):
+    return {
+        "tipo": "track",
+        "name": " ".join(rng.sample(PALABRAS, rng.randint(1, 4))) + f" {i}",
+        "artist": f"Artista {i % 3000}",
+        "album": f"Álbum {i % 9000}",
+        "image": None,
+        "uri": f"spotify:track:{i:022d}",
+        "duration_ms": 180000 + i % 120000
+    }
+
+
+def con_error(palabra, rng):
+    i = rng.randrange(1, len(palabra) - 1)
+    return palabra[:i] + "x" + palabra[i + 1:]
+
+
+def consultas(entradas, cantidad, rng):
+    tipos = {"prefijo": [], "título": [], "título + artista": [], "con error": []}
+    for _ in range(cantidad):
+        e = rng.choice(entradas)
+        nombre = e["name"]
+        tipos["prefijo"].append(nombre[:rng.randint(2, 6)])
+        tipos["título"].append(nombre)
+        tipos["título + artista"].append(f"{nombre.rsplit(' ', 1)[0]} {e['artist']}")
+        tipos["con error"].append(con_error(rng.choice([p for p in PALABRAS if len(p) >= 5]), rng))
+    return tipos
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tracks", type=int, default=100000)
+    parser.add_argument("--consultas", type=int, default=2000)
+    parser.add_argument("--semilla", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.semilla)
+
+    entradas = [entrada(i, rng) for i in range(args.tracks)]
+    indice = IndiceTracks(args.tracks)
+    inicio = time.perf_counter()
+    for i in range(0, len(entradas), 50):  # de a una página, como llegan de Spotify
+        indice.agregar(entradas[i:i + 50])
+    construccion = time.perf_counter() - inicio
+    estadisticas = indice.estadisticas()
+
+    print(f"{args.tracks} tracks, {estadisticas['palabras']} palabras, {estadisticas['trigramas']} trigramas")
+    print(f"construcción: {construccion:.2f} s\n")
+    print(f"{'consulta':<18} {'p50 (ms)':>10} {'p99 (ms)':>10} {'sin resultado':>14}")
+    for tipo, lista in consultas(entradas, args.consultas, rng).items():
+        tiempos, vacias = [], 0
+        for consulta in lista:
+            inicio = time.perf_counter()
+            resultados = indice.buscar(consulta, 10)
+            tiempos.append(time.perf_counter() - inicio)
+            vacias += not resultados
+        print(f"{tipo:<18} {percentil(tiempos, 50) * 1000:10.2f} {percentil(tiempos, 99) * 1000:10.2f} {vacias:>14}")
+
+    with tempfile.TemporaryDirectory() as directorio:
+        ruta = os.path.join(directorio, "indice.jsonl.gz")
+        inicio = time.perf_counter()
+        indice.guardar(ruta)
+        guardado = time.perf_counter() - inicio
+        cargado = IndiceTracks(args.tracks)
+        inicio = time.perf_counter()
+        cargado.cargar(ruta)
+        carga = time.perf_counter() - inicio
+        print(f"\nsnapshot: {os.path.getsize(ruta) / 1024:.0f} KiB, guardado en {guardado:.2f} s, "
+              f"cargado en {carga:.2f} s")
+        assert cargado.estadisticas()["entradas"] == estadisticas["entradas"]
+
+
+if __name__ == "__main__":
+    main()
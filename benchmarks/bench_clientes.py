@@ -0,0 +1,63 @@
+"""
+Compara crear un cliente de Spotify por petición (lo que hacía get_spotify())
+con reutilizar los clientes del RegistroClientes sobre la sesión HTTP compartida.
+
+Corre contra el servidor local de fake_spotify.py, que simula el coste de abrir
+una conexión nueva (handshake TCP/TLS) con --latencia-conexion.
+
+Uso:
+    python benchmarks/bench_clientes.py --peticiones 300 --hilos 8 --latencia-conexion 0.03
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fake_spotify import FakeSpotify
+
+
+def medir(nombre, fake, peticiones, hilos, obtener_cliente):
+    fake.reiniciar_contadores()
+
+    def una_peticion(i):
+        sp = obtener_cliente(f"token-{i % hilos}")
+        sp.currently_playing()
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=hilos) as pool:
+        list(pool.map(una_peticion, range(peticiones)))
+    total = time.perf_counter() - inicio
+
+    print(f"{nombre:<28} {total:8.2f} s {total / peticiones * 1000:10.2f} ms/pet {fake.conexiones:8d} conexiones")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--peticiones", type=int, default=300)
+    parser.add_argument("--hilos", type=int, default=8)
+    parser.add_argument("--latencia", type=float, default=0.005)
+    parser.add_argument("--latencia-conexion", type=float, default=0.03)
+    args = parser.parse_args()
+
+    fake = FakeSpotify(latencia=args.latencia, latencia_conexion=args.latencia_conexion).iniciar()
+    os.environ["SPOTIFY_API_URL"] = fake.url
+    import app
+    from spotipy import Spotify
+
+    def cliente_nuevo(token):
+        sp = Spotify(auth=token)
+        sp.prefix = fake.url
+        return sp
+
+    print(f"{args.peticiones} peticiones, {args.hilos} hilos, "
+          f"{args.latencia * 1000:.0f} ms por llamada, {args.latencia_conexion * 1000:.0f} ms por conexión nueva\n")
+    medir("cliente nuevo por petición", fake, args.peticiones, args.hilos, cliente_nuevo)
+    medir("RegistroClientes", fake, args.peticiones, args.hilos, app.registro_clientes.obtener)
+    fake.detener()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Micro-benchmark de ListaDobleEnlazada frente al recorrido lineal desde la cabeza
+que se hacía antes: buscar y eliminar por ID (índice id -> Nodo), insertar en una
+posición, ubicar un nodo y leer un rango (árbol de posiciones).
+
+Uso:
+    python benchmarks/bench_lista.py --tamanios 10000 100000 --operaciones 200
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app import ListaDobleEnlazada
+
+
+def buscar_lineal(lista, nodo_id):
+    """Lo que hacían reproducir_por_id y eliminar_por_id antes del índice"""
+    actual = lista.cabeza
+    while actual:
+        if actual.id == nodo_id:
+            return actual
+        actual = actual.siguiente
+    return None
+
+
+def nodo_en_lineal(lista, posicion):
+    """Lo que hacía agregar_en_posicion antes del árbol de posiciones"""
+    actual = lista.cabeza
+    for _ in range(posicion):
+        actual = actual.siguiente
+    return actual
+
+
+def posicion_lineal(lista, nodo_id):
+    posicion, actual = 0, lista.cabeza
+    while actual.id != nodo_id:
+        actual = actual.siguiente
+        posicion += 1
+    return posicion
+
+
+def crear_lista(tamanio):
+    lista = ListaDobleEnlazada()
+    for i in range(tamanio):
+        lista.agregar_al_final({"titulo": f"Canción {i}", "artista": "Artista", "duracion": "3:30", "album": ""})
+    return lista
+
+
+CANCION = {"titulo": "Nueva", "artista": "Artista", "duracion": "3:30", "album": ""}
+
+
+def medir(funcion, ids):
+    inicio = time.perf_counter()
+    for nodo_id in ids:
+        funcion(nodo_id)
+    return (time.perf_counter() - inicio) / len(ids) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tamanios", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--operaciones", type=int, default=200)
+    args = parser.parse_args()
+
+    random.seed(1)
+    print(f"{'nodos':>8} {'operación':<22} {'lineal (µs)':>12} {'nuevo (µs)':>12} {'mejora':>8}")
+    for tamanio in args.tamanios:
+        lista = crear_lista(tamanio)
+        ids = random.sample(list(lista.indice), args.operaciones)
+
+        lineal_busqueda = medir(lambda nodo_id: buscar_lineal(lista, nodo_id), ids)
+        indice = medir(lista.reproducir_por_id, ids)
+        print(f"{tamanio:>8} {'reproducir_por_id':<22} {lineal_busqueda:12.1f} {indice:12.2f} "
+              f"{lineal_busqueda / indice:7.0f}x")
+
+        lineal = medir(lambda nodo_id: posicion_lineal(lista, nodo_id), ids)
+        indice = medir(lista.posicion_de, ids)
+        print(f"{tamanio:>8} {'posicion_de':<22} {lineal:12.1f} {indice:12.2f} {lineal / indice:7.0f}x")
+
+        # Leer 50 canciones cerca del final: antes había que materializar la lista entera
+        inicio = tamanio - 100
+        lineal = medir(lambda _: lista.obtener_todas()[inicio:inicio + 50], range(5))
+        indice = medir(lambda _: lista.obtener_rango(inicio, inicio + 50), range(args.operaciones))
+        print(f"{tamanio:>8} {'obtener_rango (50)':<22} {lineal:12.1f} {indice:12.2f} {lineal / indice:7.0f}x")
+
+        # La eliminación con recorrido lineal cuesta lo mismo que buscar el nodo
+        indice = medir(lista.eliminar_por_id, ids)
+        print(f"{tamanio:>8} {'eliminar_por_id':<22} {lineal_busqueda:12.1f} {indice:12.2f} "
+              f"{lineal_busqueda / indice:7.0f}x")
+
+        # Insertar cerca del final: antes se caminaban `posicion` nodos desde la cabeza
+        posiciones = [random.randrange(lista.tamanio * 9 // 10, lista.tamanio) for _ in range(args.operaciones)]
+        lineal = medir(lambda posicion: nodo_en_lineal(lista, posicion), posiciones)
+        indice = medir(lambda posicion: lista.agregar_en_posicion(CANCION, posicion), posiciones)
+        print(f"{tamanio:>8} {'agregar_en_posicion':<22} {lineal:12.1f} {indice:12.2f} {lineal / indice:7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Memoria por nodo y tiempo de serialización de la playlist personalizada:
+el Nodo anterior (__dict__, uuid4, dict `cancion`, to_dict() nuevo en cada
+llamada) frente al Nodo con __slots__, IDs compactos, textos internados y
+JSON cacheado por nodo.
+
+Uso:
+    python benchmarks/bench_nodos.py --canciones 100000
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app import ListaDobleEnlazada
+
+
+class NodoAnterior:
+    """Copia del Nodo original, como referencia"""
+    def __init__(self, cancion):
+        self.id = str(uuid.uuid4())
+        self.cancion = cancion
+        self.siguiente = None
+        self.anterior = None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "titulo": self.cancion["titulo"],
+            "artista": self.cancion["artista"],
+            "duracion": self.cancion["duracion"],
+            "album": self.cancion.get("album", "")
+        }
+
+
+def cancion(i):
+    # Como llegan del JSON de /agregar: cada petición trae sus propias copias de los textos
+    return {
+        "titulo": f"Canción {i}",
+        "artista": "".join(["Artista ", str(i % 500)]),
+        "duracion": "".join(["3:", str(i % 60).zfill(2)]),
+        "album": "".join(["Álbum ", str(i % 2000)])
+    }
+
+
+def crear_anterior(n):
+    cabeza = anterior = None
+    for i in range(n):
+        nodo = NodoAnterior(cancion(i))
+        if anterior:
+            anterior.siguiente = nodo
+            nodo.anterior = anterior
+        else:
+            cabeza = nodo
+        anterior = nodo
+    return cabeza
+
+
+def obtener_todas_anterior(cabeza):
+    canciones = []
+    actual = cabeza
+    while actual:
+        cancion_dict = actual.to_dict()
+        cancion_dict["es_actual"] = False
+        canciones.append(cancion_dict)
+        actual = actual.siguiente
+    return canciones
+
+
+def crear_nueva(n):
+    lista = ListaDobleEnlazada()
+    for i in range(n):
+        lista.agregar_al_final(cancion(i))
+    # El historial de cambios guarda copias de las últimas inserciones; no es parte del nodo
+    lista.cambios.clear()
+    return lista
+
+
+def memoria(funcion):
+    """Bytes que quedan reservados después de llamar a funcion(); devuelve (resultado, bytes)"""
+    gc.collect()
+    tracemalloc.start()
+    resultado = funcion()
+    gc.collect()
+    usado = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return resultado, usado
+
+
+def medir_tiempo(funcion, repeticiones=5):
+    mejor = float("inf")
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        mejor = min(mejor, time.perf_counter() - inicio)
+    return mejor * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--canciones", type=int, default=100000)
+    args = parser.parse_args()
+    n = args.canciones
+
+    cabeza, bytes_anterior = memoria(lambda: crear_anterior(n))
+    lista, bytes_nuevo = memoria(lambda: crear_nueva(n))
+
+    def serializar_anterior():
+        return json.dumps(obtener_todas_anterior(cabeza))
+
+    def serializar_nuevo():
+        return lista.obtener_rango_json(0, lista.tamanio)
+
+    # Solo cuenta lo que queda cacheado en los nodos, no el string devuelto
+    _, bytes_cache = memoria(lambda: serializar_nuevo() and None)
+
+    def serializar_nuevo_sin_cache():
+        for nodo in lista.indice.values():
+            nodo._json = None
+        inicio = time.perf_counter()
+        serializar_nuevo()
+        return time.perf_counter() - inicio
+    primera = min(serializar_nuevo_sin_cache() for _ in range(3)) * 1000
+
+    print(f"{n} canciones\n")
+    print(f"{'':<40} {'anterior':>10} {'nuevo':>10}")
+    print(f"{'bytes por nodo':<40} {bytes_anterior / n:10.0f} {bytes_nuevo / n:10.0f}")
+    print(f"{'bytes por nodo con el JSON cacheado':<40} {bytes_anterior / n:10.0f} "
+          f"{(bytes_nuevo + bytes_cache) / n:10.0f}")
+    print(f"{'serializar la lista, 1ª vez (ms)':<40} {medir_tiempo(serializar_anterior):10.1f} {primera:10.1f}")
+    print(f"{'serializar la lista, cacheada (ms)':<40} {medir_tiempo(serializar_anterior):10.1f} "
+          f"{medir_tiempo(serializar_nuevo):10.1f}")
+    print(f"{'bytes del JSON':<40} {len(serializar_anterior()):10d} {len(serializar_nuevo()):10d}")
+
+    assert json.loads(serializar_nuevo())[5]["titulo"] == json.loads(serializar_anterior())[5]["titulo"]
+
+
+if __name__ == "__main__":
+    main()
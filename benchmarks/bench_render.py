@@ -0,0 +1,123 @@
+"""
+Tiempo de render (Jinja) por ruta, con y sin la cache de fragmentos HTML, contra
+fake_spotify.py. Solo cuenta el tiempo dentro de render_template (señales
+before_render_template / template_rendered de Flask), no las llamadas a Spotify;
+la columna "petición" es el tiempo total de la ruta.
+
+También mide la primera petición de un worker recién arrancado con las plantillas
+sin compilar frente a precompiladas (precompilar_plantillas()).
+
+Uso:
+    python benchmarks/bench_render.py --favoritos 2000 --repeticiones 50
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, RAIZ)
+os.environ.setdefault("INDICE_RUTA", "")
+# El límite de peticiones a Spotify no es lo que se mide aquí
+for variable in ("SPOTIFY_PETICIONES_SEG", "SPOTIFY_PETICIONES_RAFAGA",
+                 "USUARIO_PETICIONES_SEG", "USUARIO_PETICIONES_RAFAGA"):
+    os.environ.setdefault(variable, "100000")
+
+from fake_spotify import FakeSpotify
+
+RUTAS = ["/", "/playlists", "/playlist/pl1234", "/favoritos"]
+
+
+def cliente(app, usuario_id):
+    cliente = app.app.test_client()
+    with cliente.session_transaction() as sesion:
+        # fake_spotify responde /me con "usuario-X" para el token "token-X"
+        token = "token-" + usuario_id.removeprefix("usuario-")
+        sesion["token_info"] = {"access_token": token, "refresh_token": f"refresh-{token}",
+                                "expires_at": int(time.time()) + 3600, "expires_in": 3600}
+        sesion["usuario_id"] = usuario_id
+    return cliente
+
+
+class Cronometro:
+    """Suma el tiempo pasado dentro de render_template (también el de los fragmentos)"""
+    def __init__(self, flask):
+        self.total = 0.0
+        self.inicios = []
+        flask.before_render_template.connect(self.antes, weak=False)
+        flask.template_rendered.connect(self.despues, weak=False)
+
+    def antes(self, *args, **kwargs):
+        self.inicios.append(time.perf_counter())
+
+    def despues(self, *args, **kwargs):
+        self.total += time.perf_counter() - self.inicios.pop()
+
+    def medir(self, funcion):
+        self.total = 0.0
+        inicio = time.perf_counter()
+        funcion()
+        return self.total, time.perf_counter() - inicio
+
+
+def medir_ruta(cronometro, cliente, ruta, repeticiones):
+    for _ in range(3):  # llena las caches de datos (y la de fragmentos, si está activa)
+        cliente.get(ruta)
+    renders, peticiones = [], []
+    for _ in range(repeticiones):
+        render, peticion = cronometro.medir(lambda: cliente.get(ruta))
+        renders.append(render)
+        peticiones.append(peticion)
+    return statistics.median(renders) * 1000, statistics.median(peticiones) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--favoritos", type=int, default=2000)
+    parser.add_argument("--repeticiones", type=int, default=50)
+    args = parser.parse_args()
+
+    fake = FakeSpotify().iniciar()
+    os.environ["SPOTIFY_API_URL"] = fake.url
+    import flask
+    import app
+
+    cronometro = Cronometro(flask)
+    usuario = cliente(app, "usuario-bench")
+    app.almacen_favoritos.agregar_muchos("usuario-bench", [f"fav{i}" for i in range(args.favoritos)])
+
+    # Primera petición: plantillas sin compilar frente a precompiladas. La compilación
+    # ocurre antes de las señales de render, así que aquí se mide la petición entera
+    primeras = {}
+    for ruta in RUTAS:
+        usuario.get(ruta)  # datos en cache, para medir solo el render
+        app.app.jinja_env.cache.clear()
+        app.cache_fragmentos.datos.clear()
+        _, sin_compilar = cronometro.medir(lambda: usuario.get(ruta))
+        app.app.jinja_env.cache.clear()
+        app.precompilar_plantillas()
+        app.cache_fragmentos.datos.clear()
+        _, precompiladas = cronometro.medir(lambda: usuario.get(ruta))
+        primeras[ruta] = (sin_compilar * 1000, precompiladas * 1000)
+
+    tamanio = app.cache_fragmentos.tamanio_max
+    app.cache_fragmentos.tamanio_max = 0  # sin cache de fragmentos: se desaloja al guardar
+    sin_cache = {ruta: medir_ruta(cronometro, usuario, ruta, args.repeticiones) for ruta in RUTAS}
+    app.cache_fragmentos.tamanio_max = tamanio
+    con_cache = {ruta: medir_ruta(cronometro, usuario, ruta, args.repeticiones) for ruta in RUTAS}
+
+    print(f"{args.favoritos} favoritos, mediana de {args.repeticiones} peticiones (ms)\n")
+    print(f"{'ruta':<18} {'render sin':>11} {'render con':>11} {'petición sin':>13} {'petición con':>13}")
+    for ruta in RUTAS:
+        print(f"{ruta:<18} {sin_cache[ruta][0]:11.2f} {con_cache[ruta][0]:11.2f} "
+              f"{sin_cache[ruta][1]:13.2f} {con_cache[ruta][1]:13.2f}")
+
+    print(f"\n{'primera petición':<18} {'sin compilar':>13} {'precompiladas':>14}")
+    for ruta in RUTAS:
+        print(f"{ruta:<18} {primeras[ruta][0]:13.2f} {primeras[ruta][1]:14.2f}")
+    fake.detener()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Prueba de carga de la app bajo gunicorn con distintos tipos de worker (sync,
+gthread, gevent) contra fake_spotify.py con latencia de red realista.
+
+Cada cliente simulado es un usuario distinto que repite la misma ruta durante
+--duracion segundos; por defecto /next, que hace una llamada a Spotify por
+petición. Con un solo worker, sync atiende una petición a la vez, gthread tantas
+como hilos y gevent tantas como greenlets (GUNICORN_CONEXIONES).
+
+Uso:
+    python benchmarks/bench_workers.py --clientes 50 500 --latencia 0.2 --duracion 10
+"""
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, RAIZ)
+# La misma clave para las cookies que se firman aquí y el gunicorn que las recibe
+os.environ.setdefault("SECRET_KEY", "clave-de-los-benchmarks")
+
+from fake_spotify import FakeSpotify
+
+
+def cookies_de_sesion(usuarios):
+    """Cookie de sesión firmada por usuario, como la que deja /callback"""
+    import app
+    serializador = app.app.session_interface.get_signing_serializer(app.app)
+    nombre = app.app.config["SESSION_COOKIE_NAME"]
+    cookies = []
+    for i in range(usuarios):
+        sesion = {
+            "token_info": {"access_token": f"token-{i}", "refresh_token": f"refresh-{i}",
+                           "expires_at": int(time.time()) + 3600, "expires_in": 3600},
+            "usuario_id": f"usuario-{i}"
+        }
+        cookies.append(f"{nombre}={serializador.dumps(sesion)}")
+    return cookies
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def esperar_puerto(proceso, puerto, nombre, segundos=20):
+    limite = time.monotonic() + segundos
+    while time.monotonic() < limite:
+        try:
+            socket.create_connection(("127.0.0.1", puerto), timeout=0.2).close()
+            return proceso
+        except OSError:
+            time.sleep(0.1)
+    proceso.kill()
+    raise RuntimeError(f"{nombre} no arrancó")
+
+
+def arrancar_gunicorn(worker, puerto, fake_url, sin_limite=True):
+    entorno = dict(os.environ,
+                   PORT=str(puerto),
+                   GUNICORN_WORKER=worker,
+                   WEB_CONCURRENCY="1",
+                   SPOTIFY_API_URL=fake_url)
+    if sin_limite:
+        # El límite de peticiones no es lo que se mide aquí
+        entorno.update(SPOTIFY_PETICIONES_SEG="100000", SPOTIFY_PETICIONES_RAFAGA="100000",
+                       USUARIO_PETICIONES_SEG="100000", USUARIO_PETICIONES_RAFAGA="100000")
+    proceso = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+                               cwd=RAIZ, env=entorno, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return esperar_puerto(proceso, puerto, f"gunicorn ({worker})")
+
+
+def percentil(valores, p):
+    if not valores:
+        return float("nan")
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p / 100))]
+
+
+def cargar(puerto, ruta, cookies, duracion, timeout):
+    latencias, errores = [], [0]
+    lock = threading.Lock()
+    fin = time.monotonic() + duracion
+
+    def cliente(cookie):
+        while time.monotonic() < fin:
+            inicio = time.perf_counter()
+            try:
+                conexion = http.client.HTTPConnection("127.0.0.1", puerto, timeout=timeout)
+                conexion.request("GET", ruta, headers={"Cookie": cookie, "Connection": "close"})
+                respuesta = conexion.getresponse()
+                respuesta.read()
+                conexion.close()
+                correcta = respuesta.status < 400
+            except OSError:
+                correcta = False
+            with lock:
+                if correcta:
+                    latencias.append(time.perf_counter() - inicio)
+                else:
+                    errores[0] += 1
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(cookies)) as pool:
+        list(pool.map(cliente, cookies))
+    return latencias, errores[0], time.perf_counter() - inicio
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", nargs="+", default=["sync", "gthread", "gevent"])
+    parser.add_argument("--clientes", type=int, nargs="+", default=[50, 500])
+    parser.add_argument("--ruta", default="/next")
+    parser.add_argument("--latencia", type=float, default=0.2, help="segundos por llamada a Spotify")
+    parser.add_argument("--duracion", type=float, default=10)
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args()
+
+    fake = FakeSpotify(latencia=args.latencia).iniciar()
+    cookies = cookies_de_sesion(max(args.clientes))
+
+    print(f"{args.ruta}, {args.latencia * 1000:.0f} ms por llamada a Spotify, 1 worker, {args.duracion:.0f} s\n")
+    print(f"{'worker':<10} {'clientes':>8} {'pet/s':>8} {'p50 (ms)':>10} {'p95 (ms)':>10} {'errores':>8}")
+    for worker in args.workers:
+        puerto = puerto_libre()
+        proceso = arrancar_gunicorn(worker, puerto, fake.url)
+        try:
+            for clientes in args.clientes:
+                latencias, errores, total = cargar(puerto, args.ruta, cookies[:clientes], args.duracion, args.timeout)
+                print(f"{worker:<10} {clientes:>8} {len(latencias) / total:8.1f} "
+                      f"{percentil(latencias, 50) * 1000:10.0f} {percentil(latencias, 95) * 1000:10.0f} {errores:>8}")
+        finally:
+            proceso.terminate()
+            proceso.wait()
+    fake.detener()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+"""
+Prueba de carga de extremo a extremo: la app bajo gunicorn contra fake_spotify.py
+(en otro proceso, con latencia, paginación y 429 configurables) y un driver asyncio.
+
+Cada usuario simulado tiene --pestanas pestañas consultando /current cada
+--intervalo-current segundos y, según su número, una de estas actividades:
+
+    favoritos    abre /favoritos con --favoritos favoritos
+    playlist     abre /playlist/<id> de --canciones-playlist canciones y la
+                 recorre entera con /api/playlist/<id>/tracks
+    mi_playlist  agrega, pide los cambios, adelanta y elimina en /api/mi_playlist/*
+
+Informa por ruta p50/p95/p99, peticiones por segundo y llamadas a Spotify por
+petición (de /metrics de la app), y puede guardar el resultado como línea base
+JSON o compararlo con una anterior (sale con código 1 si algo empeora).
+
+Uso:
+    python benchmarks/carga.py --usuarios 50 --duracion 30 --guardar benchmarks/lineas_base/local.json
+    python benchmarks/carga.py --usuarios 50 --duracion 30 --comparar benchmarks/lineas_base/local.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+import urllib.request
+from collections import defaultdict
+
+from bench_workers import RAIZ, arrancar_gunicorn, cookies_de_sesion, esperar_puerto, percentil, puerto_libre
+
+ACTIVIDADES = ["favoritos", "playlist", "mi_playlist"]
+PAGINA_PLAYLIST = 100
+PAUSA_FAVORITOS = 5
+PAUSA_PAGINA = 0.5
+PAUSA_MI_PLAYLIST = 0.5
+
+
+class Conexion:
+    """HTTP/1.1 con keep-alive sobre asyncio, lo justo para las rutas de la app"""
+
+    def __init__(self, puerto, cookie, timeout):
+        self.puerto = puerto
+        self.cookie = cookie
+        self.nombre_cookie = cookie.split("=", 1)[0]
+        self.timeout = timeout
+        self.lector = self.escritor = None
+
+    def cerrar(self):
+        if self.escritor is not None:
+            self.escritor.close()
+        self.lector = self.escritor = None
+
+    async def pedir(self, metodo, ruta, cuerpo=None):
+        # Una conexión keep-alive que el servidor ya cerró se reabre una vez
+        for intento in range(2):
+            reutilizada = self.escritor is not None
+            if not reutilizada:
+                self.lector, self.escritor = await asyncio.open_connection("127.0.0.1", self.puerto)
+            try:
+                return await asyncio.wait_for(self._pedir(metodo, ruta, cuerpo), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.cerrar()
+                if not reutilizada or intento:
+                    raise
+            except asyncio.TimeoutError:
+                self.cerrar()
+                raise
+
+    async def _pedir(self, metodo, ruta, cuerpo):
+        datos = json.dumps(cuerpo).encode() if cuerpo is not None else b""
+        cabeceras = [f"{metodo} {ruta} HTTP/1.1", "Host: 127.0.0.1", f"Cookie: {self.cookie}",
+                     f"Content-Length: {len(datos)}"]
+        if cuerpo is not None:
+            cabeceras.append("Content-Type: application/json")
+        self.escritor.write(("\r\n".join(cabeceras) + "\r\n\r\n").encode() + datos)
+        await self.escritor.drain()
+
+        linea = await self.lector.readline()
+        if not linea:
+            raise ConnectionResetError("conexión cerrada")
+        estado = int(linea.split()[1])
+        respuesta = {}
+        while True:
+            linea = (await self.lector.readline()).decode("latin-1")
+            if linea in ("\r\n", ""):
+                break
+            nombre, _, valor = linea.partition(":")
+            nombre, valor = nombre.strip().lower(), valor.strip()
+            if nombre == "set-cookie" and valor.startswith(self.nombre_cookie + "="):
+                self.cookie = valor.split(";", 1)[0]
+            respuesta[nombre] = valor
+
+        if respuesta.get("transfer-encoding") == "chunked":
+            partes = []
+            while True:
+                tamanio = int((await self.lector.readline()).split(b";")[0], 16)
+                if tamanio == 0:
+                    await self.lector.readline()
+                    break
+                partes.append(await self.lector.readexactly(tamanio))
+                await self.lector.readexactly(2)
+            contenido = b"".join(partes)
+        else:
+            contenido = await self.lector.readexactly(int(respuesta.get("content-length", 0)))
+        if respuesta.get("connection", "").lower() == "close":
+            self.cerrar()
+        return estado, contenido
+
+
+class Resultados:
+    def __init__(self):
+        self.latencias = defaultdict(list)
+        self.errores = defaultdict(lambda: defaultdict(int))  # ruta -> estado -> peticiones
+
+    async def medir(self, conexion, ruta, metodo, url, cuerpo=None):
+        """Hace la petición y la anota bajo `ruta` (la regla de Flask, para cruzarla con /metrics)"""
+        inicio = time.perf_counter()
+        try:
+            estado, contenido = await conexion.pedir(metodo, url, cuerpo)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            self.errores[ruta][type(e).__name__] += 1
+            return None
+        if estado >= 400:
+            self.errores[ruta][str(estado)] += 1
+            return None
+        self.latencias[ruta].append(time.perf_counter() - inicio)
+        return contenido
+
+
+async def pestana_current(conexion, resultados, fin, intervalo):
+    while time.monotonic() < fin:
+        await resultados.medir(conexion, "/current", "GET", "/current")
+        await asyncio.sleep(intervalo)
+
+
+async def actividad_favoritos(conexion, resultados, fin, args):
+    while time.monotonic() < fin:
+        await resultados.medir(conexion, "/favoritos", "GET", "/favoritos")
+        await asyncio.sleep(PAUSA_FAVORITOS)
+
+
+async def actividad_playlist(conexion, resultados, fin, args):
+    playlist_id = f"pl{args.canciones_playlist}"
+    while time.monotonic() < fin:
+        pagina = await resultados.medir(conexion, "/playlist/<playlist_id>", "GET", f"/playlist/{playlist_id}")
+        # Como el navegador: las páginas siguientes piden la versión con la que se abrió
+        snapshot = re.search(rb'data-snapshot="([^"]*)"', pagina or b"")
+        snapshot_id = snapshot.group(1).decode() if snapshot else ""
+        for offset in range(PAGINA_PLAYLIST, args.canciones_playlist, PAGINA_PLAYLIST):
+            if time.monotonic() >= fin:
+                return
+            await resultados.medir(conexion, "/api/playlist/<playlist_id>/tracks", "GET",
+                                   f"/api/playlist/{playlist_id}/tracks?offset={offset}&limit={PAGINA_PLAYLIST}"
+                                   f"&snapshot_id={snapshot_id}")
+            await asyncio.sleep(PAUSA_PAGINA)
+
+
+async def actividad_mi_playlist(conexion, resultados, fin, args):
+    revision = 0
+    numero = 0
+    while time.monotonic() < fin:
+        numero += 1
+        contenido = await resultados.medir(conexion, "/api/mi_playlist/agregar", "POST", "/api/mi_playlist/agregar",
+                                           {"titulo": f"Canción {numero}", "artista": "Artista de prueba"})
+        nodo_id = json.loads(contenido)["id"] if contenido else None
+        contenido = await resultados.medir(conexion, "/api/mi_playlist/canciones", "GET",
+                                           f"/api/mi_playlist/canciones?since_revision={revision}")
+        if contenido:
+            revision = json.loads(contenido)["revision"]
+        await resultados.medir(conexion, "/api/mi_playlist/adelantar", "POST", "/api/mi_playlist/adelantar")
+        if nodo_id and numero % 2 == 0:
+            await resultados.medir(conexion, "/api/mi_playlist/eliminar/<nodo_id>", "DELETE",
+                                   f"/api/mi_playlist/eliminar/{nodo_id}")
+        await asyncio.sleep(PAUSA_MI_PLAYLIST)
+
+
+async def usuario(i, puerto, cookie, resultados, fin, args):
+    actividad = globals()["actividad_" + ACTIVIDADES[i % len(ACTIVIDADES)]]
+    conexiones = [Conexion(puerto, cookie, args.timeout) for _ in range(args.pestanas + 1)]
+    # Cada pestaña arranca en un momento distinto del intervalo, como en la realidad
+    await asyncio.sleep(args.intervalo_current * i / args.usuarios)
+    tareas = [pestana_current(conexion, resultados, fin, args.intervalo_current) for conexion in conexiones[1:]]
+    tareas.append(actividad(conexiones[0], resultados, fin, args))
+    try:
+        await asyncio.gather(*tareas)
+    finally:
+        for conexion in conexiones:
+            conexion.cerrar()
+
+
+async def preparar_favoritos(puerto, cookies, favoritos, timeout):
+    """Carga los favoritos de los usuarios que abren /favoritos"""
+    for i, cookie in enumerate(cookies):
+        if ACTIVIDADES[i % len(ACTIVIDADES)] != "favoritos":
+            continue
+        conexion = Conexion(puerto, cookie, timeout)
+        estado, _ = await conexion.pedir("POST", "/api/favoritos/importar",
+                                         {"favoritos": [f"fav{i}x{n}" for n in range(favoritos)]})
+        conexion.cerrar()
+        if estado >= 400:
+            raise RuntimeError(f"No se pudieron importar los favoritos ({estado})")
+
+
+async def correr(puerto, cookies, args):
+    await preparar_favoritos(puerto, cookies, args.favoritos, args.timeout)
+    resultados = Resultados()
+    inicio = time.perf_counter()
+    fin = time.monotonic() + args.duracion
+    await asyncio.gather(*(usuario(i, puerto, cookie, resultados, fin, args) for i, cookie in enumerate(cookies)))
+    return resultados, time.perf_counter() - inicio
+
+
+def leer(url):
+    with urllib.request.urlopen(url, timeout=10) as respuesta:
+        return respuesta.read().decode()
+
+
+def llamadas_por_ruta(metricas):
+    """{ruta: [llamadas a Spotify, peticiones]} según /metrics; las llamadas incluyen las precargas en segundo plano"""
+    por_ruta = defaultdict(lambda: [0.0, 0])
+    for ruta, valor in re.findall(r'^http_spotify_llamadas_total\{ruta="([^"]*)"\} (\S+)$', metricas, re.MULTILINE):
+        por_ruta[ruta][0] += float(valor)
+    for ruta, valor in re.findall(r'^http_llamadas_spotify_count\{ruta="([^"]*)"\} (\S+)$', metricas, re.MULTILINE):
+        por_ruta[ruta][1] += float(valor)
+    return por_ruta
+
+
+def resumen(resultados, total_seg, llamadas_antes, llamadas_despues, fake_llamadas):
+    rutas = {}
+    for ruta in sorted(set(resultados.latencias) | set(resultados.errores)):
+        latencias = resultados.latencias[ruta]
+        sum_antes, count_antes = llamadas_antes.get(ruta, (0, 0))
+        sum_despues, count_despues = llamadas_despues.get(ruta, (0, 0))
+        peticiones_app = count_despues - count_antes
+        rutas[ruta] = {
+            "peticiones": len(latencias),
+            "errores": dict(resultados.errores[ruta]),
+            "pet_s": round(len(latencias) / total_seg, 2),
+            "p50_ms": round(percentil(latencias, 50) * 1000, 1),
+            "p95_ms": round(percentil(latencias, 95) * 1000, 1),
+            "p99_ms": round(percentil(latencias, 99) * 1000, 1),
+            "llamadas_spotify_por_peticion": round((sum_despues - sum_antes) / peticiones_app, 3)
+            if peticiones_app else None
+        }
+    peticiones = sum(r["peticiones"] for r in rutas.values())
+    llamadas = sum(v for k, v in fake_llamadas.items() if k != "429")
+    return {
+        "rutas": rutas,
+        "total": {
+            "peticiones": peticiones,
+            "pet_s": round(peticiones / total_seg, 2),
+            "llamadas_spotify": llamadas,
+            "respuestas_429": fake_llamadas.get("429", 0),
+            "llamadas_spotify_por_peticion": round(llamadas / peticiones, 3) if peticiones else None
+        }
+    }
+
+
+def imprimir(datos):
+    print(f"{'ruta':<38} {'pet':>7} {'pet/s':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'Spotify/pet':>12} errores")
+    for ruta, r in datos["rutas"].items():
+        amplificacion = "-" if r["llamadas_spotify_por_peticion"] is None else f"{r['llamadas_spotify_por_peticion']:.2f}"
+        print(f"{ruta:<38} {r['peticiones']:>7} {r['pet_s']:>7.1f} {r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} "
+              f"{r['p99_ms']:>8.1f} {amplificacion:>12} {r['errores'] or ''}")
+    t = datos["total"]
+    print(f"\n{t['peticiones']} peticiones, {t['pet_s']} pet/s, {t['llamadas_spotify']} llamadas a Spotify "
+          f"({t['llamadas_spotify_por_peticion']} por petición), {t['respuestas_429']} respuestas 429")
+
+
+def comparar(datos, base, tolerancia, margen_ms):
+    """Imprime las diferencias con la línea base; devuelve False si alguna ruta empeoró más de `tolerancia`"""
+    bien = True
+    print(f"\n{'ruta':<38} {'p95 base':>9} {'p95':>9} {'Spotify/pet base':>17} {'Spotify/pet':>12}")
+    for ruta, r in datos["rutas"].items():
+        anterior = base["rutas"].get(ruta)
+        if not anterior:
+            continue
+        empeora = r["p95_ms"] > max(anterior["p95_ms"] * (1 + tolerancia), anterior["p95_ms"] + margen_ms)
+        antes, ahora = anterior["llamadas_spotify_por_peticion"], r["llamadas_spotify_por_peticion"]
+        if antes is not None and ahora is not None and ahora > antes * (1 + tolerancia) + 0.01:
+            empeora = True
+        bien = bien and not empeora
+        print(f"{ruta:<38} {anterior['p95_ms']:>9.1f} {r['p95_ms']:>9.1f} {str(antes):>17} {str(ahora):>12}"
+              f"{'  << empeora' if empeora else ''}")
+    return bien
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--usuarios", type=int, default=30)
+    parser.add_argument("--pestanas", type=int, default=2, help="pestañas por usuario consultando /current")
+    parser.add_argument("--intervalo-current", type=float, default=3)
+    parser.add_argument("--favoritos", type=int, default=500)
+    parser.add_argument("--canciones-playlist", type=int, default=10000)
+    parser.add_argument("--duracion", type=float, default=30)
+    parser.add_argument("--latencia", type=float, default=0.05, help="segundos por llamada a Spotify")
+    parser.add_argument("--limite", type=int, default=None, help="llamadas por segundo antes de que Spotify responda 429")
+    parser.add_argument("--worker", default="gevent")
+    parser.add_argument("--sin-limite", action="store_true", help="desactiva el límite de peticiones de la app")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--guardar", help="guarda el resultado como línea base JSON")
+    parser.add_argument("--comparar", help="línea base JSON con la que comparar")
+    parser.add_argument("--tolerancia", type=float, default=0.2, help="empeoramiento admitido (0.2 = 20%%)")
+    parser.add_argument("--margen-ms", type=float, default=10, help="diferencia de p95 que se considera ruido")
+    args = parser.parse_args()
+
+    puerto_fake, puerto_app = puerto_libre(), puerto_libre()
+    comando_fake = [sys.executable, os.path.join(RAIZ, "benchmarks", "fake_spotify.py"),
+                    "--puerto", str(puerto_fake), "--latencia", str(args.latencia)]
+    if args.limite:
+        comando_fake += ["--limite", str(args.limite)]
+    fake = esperar_puerto(subprocess.Popen(comando_fake, stdout=subprocess.DEVNULL), puerto_fake, "fake_spotify")
+    fake_url = f"http://127.0.0.1:{puerto_fake}/v1/"
+    # Base de SQLite propia para no tocar la de desarrollo
+    os.environ.setdefault("SQLITE_PATH", os.path.join(RAIZ, "benchmarks", ".carga.db"))
+    app = arrancar_gunicorn(args.worker, puerto_app, fake_url, sin_limite=args.sin_limite)
+    try:
+        cookies = cookies_de_sesion(args.usuarios)
+        metricas_url = f"http://127.0.0.1:{puerto_app}/metrics"
+        llamadas_antes = llamadas_por_ruta(leer(metricas_url))
+        fake_antes = json.loads(leer(f"http://127.0.0.1:{puerto_fake}/__llamadas"))
+        resultados, total_seg = asyncio.run(correr(puerto_app, cookies, args))
+        llamadas_despues = llamadas_por_ruta(leer(metricas_url))
+        fake_despues = json.loads(leer(f"http://127.0.0.1:{puerto_fake}/__llamadas"))
+    finally:
+        app.terminate()
+        app.wait()
+        fake.terminate()
+        fake.wait()
+
+    fake_llamadas = {k: v - fake_antes.get(k, 0) for k, v in fake_despues.items()}
+    datos = resumen(resultados, total_seg, llamadas_antes, llamadas_despues, fake_llamadas)
+    datos["config"] = {k: v for k, v in vars(args).items() if k not in ("guardar", "comparar", "tolerancia")}
+
+    print(f"{args.usuarios} usuarios, {args.pestanas} pestañas, {args.duracion:.0f} s, "
+          f"{args.latencia * 1000:.0f} ms por llamada a Spotify, worker {args.worker}\n")
+    imprimir(datos)
+
+    if args.guardar:
+        os.makedirs(os.path.dirname(os.path.abspath(args.guardar)), exist_ok=True)
+        with open(args.guardar, "w") as f:
+            json.dump(datos, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+    if args.comparar:
+        with open(args.comparar) as f:
+            base = json.load(f)
+        if base.get("config") != datos["config"]:
+            print("\nAviso: la línea base se tomó con otra configuración")
+        if not comparar(datos, base, args.tolerancia, args.margen_ms):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
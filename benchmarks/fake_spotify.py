@@ -0,0 +1,320 @@
+"""
+Servidor local que imita la API web de Spotify para benchmarks y pruebas de carga.
+
+Solo implementa los endpoints que usa app.py y genera los datos a partir del ID:
+una playlist "pl5000" tiene 5000 canciones y un álbum "al120" tiene 120 (los IDs
+son base 62, como los que acepta spotipy).
+
+Uso:
+    python benchmarks/fake_spotify.py --puerto 8901 --latencia 0.05
+
+y arrancar la app con SPOTIFY_API_URL=http://127.0.0.1:8901/v1/
+"""
+import argparse
+import json
+import re
+import socket
+import sys
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+def track(track_id, album_id=None):
+    album_id = album_id or f"al{track_id}"
+    return {
+        "id": track_id,
+        "name": f"Canción {track_id}",
+        "uri": f"spotify:track:{track_id}",
+        "duration_ms": 210000,
+        "artists": [{"id": "ar1", "name": "Artista de prueba"}],
+        "album": {
+            "id": album_id,
+            "name": f"Álbum {album_id}",
+            "uri": f"spotify:album:{album_id}",
+            "images": [{"url": f"https://i.scdn.co/image/{album_id}"}]
+        }
+    }
+
+
+def total_desde_id(objeto_id, por_defecto):
+    """'pl5000' -> 5000; un ID sin número al final usa el valor por defecto"""
+    numero = re.search(r"\d+$", objeto_id)
+    return int(numero.group()) if numero else por_defecto
+
+
+def pagina(items_totales, offset, limit, generar, url_base=""):
+    fin = min(offset + limit, items_totales)
+    return {
+        "items": [generar(i) for i in range(offset, fin)],
+        "offset": offset,
+        "limit": limit,
+        "total": items_totales,
+        "next": f"{url_base}?offset={fin}&limit={limit}" if fin < items_totales else None
+    }
+
+
+class ServidorSilencioso(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Los clientes que se cierran a mitad de una petición (p. ej. al parar gunicorn) no son errores
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeSpotify:
+    """Servidor de pruebas con latencia configurable y contadores de conexiones y llamadas"""
+
+    def __init__(self, puerto=0, latencia=0.0, latencia_conexion=0.0, limite=None, retry_after=1):
+        self.latencia = latencia
+        self.latencia_conexion = latencia_conexion
+        # Como el límite de Spotify: más de `limite` llamadas por segundo responden 429 con Retry-After
+        self.limite = limite
+        self.retry_after = retry_after
+        self.ventana = deque()
+        self.limitado_hasta = 0
+        self.lock = threading.Lock()
+        self.conexiones = 0
+        self.llamadas = Counter()
+        self.inicio_reproduccion = time.time()
+        # None simula que el usuario no tiene ningún dispositivo activo (play responde 404)
+        self.dispositivo_activo = "dispositivo-1"
+
+        servidor = self
+
+        class Handler(ManejadorSpotify):
+            fake = servidor
+
+        self.httpd = ServidorSilencioso(("127.0.0.1", puerto), Handler)
+        self.httpd.daemon_threads = True
+        self.hilo = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/v1/"
+
+    def iniciar(self):
+        self.hilo = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.hilo.start()
+        return self
+
+    def detener(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reiniciar_contadores(self):
+        with self.lock:
+            self.conexiones = 0
+            self.llamadas = Counter()
+
+    def limitar(self):
+        """Segundos de Retry-After si esta llamada supera el límite, o None"""
+        if self.limite is None:
+            return None
+        with self.lock:
+            ahora = time.monotonic()
+            if ahora < self.limitado_hasta:
+                return self.retry_after
+            while self.ventana and self.ventana[0] <= ahora - 1:
+                self.ventana.popleft()
+            if len(self.ventana) >= self.limite:
+                self.limitado_hasta = ahora + self.retry_after
+                return self.retry_after
+            self.ventana.append(ahora)
+            return None
+
+    def total_llamadas(self):
+        with self.lock:
+            return sum(self.llamadas.values())
+
+
+class ManejadorSpotify(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, como api.spotify.com
+    fake = None
+
+    rutas = [
+        ("GET", r"/v1/me/?", "me"),
+        ("GET", r"/v1/me/player/currently-playing", "currently_playing"),
+        ("GET", r"/v1/me/player", "current_playback"),
+        ("GET", r"/v1/me/player/devices", "devices"),
+        ("PUT", r"/v1/me/player/play", "play"),
+        ("PUT", r"/v1/me/player/pause", "sin_contenido"),
+        ("PUT", r"/v1/me/player/seek", "sin_contenido"),
+        ("PUT", r"/v1/me/player", "sin_contenido"),
+        ("POST", r"/v1/me/player/next", "sin_contenido"),
+        ("POST", r"/v1/me/player/previous", "sin_contenido"),
+        ("GET", r"/v1/me/playlists", "mis_playlists"),
+        ("GET", r"/v1/tracks/?", "tracks"),
+        ("GET", r"/v1/tracks/(?P<id>[^/]+)", "track"),
+        ("GET", r"/v1/albums/(?P<id>[^/]+)/tracks/?", "album_tracks"),
+        ("GET", r"/v1/albums/(?P<id>[^/]+)/?", "album"),
+        ("GET", r"/v1/browse/new-releases", "new_releases"),
+        ("GET", r"/v1/playlists/(?P<id>[^/]+)/tracks", "playlist_items"),
+        ("GET", r"/v1/playlists/(?P<id>[^/]+)", "playlist"),
+        ("GET", r"/v1/search", "search"),
+    ]
+
+    def setup(self):
+        super().setup()
+        # Cabeceras y cuerpo van en escrituras separadas: sin esto Nagle añade ~40 ms en keep-alive
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.fake.lock:
+            self.fake.conexiones += 1
+        # Simula el coste del handshake TCP/TLS de una conexión nueva
+        if self.fake.latencia_conexion:
+            time.sleep(self.fake.latencia_conexion)
+
+    def log_message(self, formato, *args):
+        pass
+
+    def do_GET(self):
+        self._despachar("GET")
+
+    def do_PUT(self):
+        self._despachar("PUT")
+
+    def do_POST(self):
+        self._despachar("POST")
+
+    def _despachar(self, metodo):
+        longitud = int(self.headers.get("Content-Length") or 0)
+        if longitud:
+            self.rfile.read(longitud)
+
+        url = urlparse(self.path)
+        if url.path == "/__llamadas":
+            # Contadores para los benchmarks que corren el servidor en otro proceso
+            with self.fake.lock:
+                return self._responder(200, dict(self.fake.llamadas))
+        self.url_base = f"http://{self.headers.get('Host')}{url.path}"
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        for metodo_ruta, patron, nombre in self.rutas:
+            coincidencia = re.fullmatch(patron, url.path)
+            if metodo_ruta == metodo and coincidencia:
+                retry_after = self.fake.limitar()
+                with self.fake.lock:
+                    self.fake.llamadas["429" if retry_after else nombre] += 1
+                if retry_after:
+                    return self._responder(429, {"error": {"status": 429, "message": "API rate limit exceeded"}},
+                                           {"Retry-After": str(retry_after)})
+                if self.fake.latencia:
+                    time.sleep(self.fake.latencia)
+                estado, cuerpo = getattr(self, nombre)(params, **coincidencia.groupdict())
+                return self._responder(estado, cuerpo)
+        self._responder(404, {"error": {"status": 404, "message": "Not found"}})
+
+    def _responder(self, estado, cuerpo, cabeceras=None):
+        datos = json.dumps(cuerpo).encode() if cuerpo is not None else b""
+        self.send_response(estado)
+        if datos:
+            self.send_header("Content-Type", "application/json")
+        for nombre, valor in (cabeceras or {}).items():
+            self.send_header(nombre, valor)
+        self.send_header("Content-Length", str(len(datos)))
+        self.end_headers()
+        self.wfile.write(datos)
+
+    # ---- endpoints ----
+
+    def me(self, params):
+        # Un usuario por token, con el mismo número que usan los benchmarks ("token-3" -> "usuario-3")
+        token = self.headers.get("Authorization", "").removeprefix("Bearer ")
+        usuario = "usuario-" + token.removeprefix("token-") if token else "usuario-prueba"
+        return 200, {"id": usuario, "display_name": "Usuario de prueba"}
+
+    def currently_playing(self, params):
+        item = track("tactual")
+        progreso = int((time.time() - self.fake.inicio_reproduccion) * 1000) % item["duration_ms"]
+        return 200, {"is_playing": True, "progress_ms": progreso, "item": item}
+
+    def current_playback(self, params):
+        estado = self.currently_playing(params)[1]
+        estado["device"] = {"id": "dispositivo-1", "is_active": True}
+        return 200, estado
+
+    def devices(self, params):
+        return 200, {"devices": [{"id": "dispositivo-1", "name": "Prueba", "is_active": True}]}
+
+    def sin_contenido(self, params):
+        return 204, None
+
+    def play(self, params):
+        if params.get("device_id"):
+            self.fake.dispositivo_activo = params["device_id"]
+        elif self.fake.dispositivo_activo is None:
+            return 404, {"error": {"status": 404, "message": "Player command failed: No active device found",
+                                   "reason": "NO_ACTIVE_DEVICE"}}
+        return 204, None
+
+    def mis_playlists(self, params):
+        offset, limit = int(params.get("offset", 0)), int(params.get("limit", 20))
+        return 200, pagina(40, offset, limit,
+                           lambda i: {"id": f"pl{(i + 1) * 100}", "name": f"Playlist {i}",
+                                     "snapshot_id": "snap-1", "images": []},
+                           self.url_base)
+
+    def tracks(self, params):
+        ids = [i for i in params.get("ids", "").split(",") if i]
+        return 200, {"tracks": [track(i) for i in ids]}
+
+    def track(self, params, id):
+        return 200, track(id)
+
+    def album_tracks(self, params, id):
+        offset, limit = int(params.get("offset", 0)), int(params.get("limit", 20))
+        total = total_desde_id(id, 12)
+
+        def generar(i):
+            item = track(f"{id}t{i}", id)
+            del item["album"]
+            return item
+        return 200, pagina(total, offset, limit, generar, self.url_base)
+
+    def album(self, params, id):
+        self.url_base = self.url_base.rstrip("/") + "/tracks"
+        return 200, {"id": id, "name": f"Álbum {id}", "uri": f"spotify:album:{id}",
+                     "images": [{"url": f"https://i.scdn.co/image/{id}"}],
+                     "artists": [{"name": "Artista de prueba"}],
+                     "tracks": self.album_tracks({"limit": 50}, id)[1]}
+
+    def new_releases(self, params):
+        limit = int(params.get("limit", 20))
+        albumes = [{"id": f"al{10 + i}", "name": f"Lanzamiento {i}", "uri": f"spotify:album:al{10 + i}",
+                    "images": [{"url": f"https://i.scdn.co/image/al{i}"}],
+                    "artists": [{"name": "Artista de prueba"}]} for i in range(limit)]
+        return 200, {"albums": pagina(100, 0, limit, lambda i: albumes[i])}
+
+    def playlist_items(self, params, id):
+        offset, limit = int(params.get("offset", 0)), int(params.get("limit", 100))
+        total = total_desde_id(id, 50)
+        return 200, pagina(total, offset, limit, lambda i: {"track": track(f"{id}t{i}")},
+                           self.url_base)
+
+    def playlist(self, params, id):
+        self.url_base += "/tracks"
+        primera = self.playlist_items({"limit": 100}, id)[1]
+        return 200, {"id": id, "name": f"Playlist {id}", "snapshot_id": "snap-1",
+                     "images": [], "tracks": primera}
+
+    def search(self, params):
+        q = params.get("q", "")
+        track_id = "s" + re.sub(r"[^0-9A-Za-z]", "", q)[:20]
+        return 200, {"tracks": pagina(1, 0, 1, lambda i: track(track_id))}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--puerto", type=int, default=8901)
+    parser.add_argument("--latencia", type=float, default=0.0, help="segundos por llamada")
+    parser.add_argument("--latencia-conexion", type=float, default=0.0, help="segundos por conexión nueva")
+    parser.add_argument("--limite", type=int, default=None, help="llamadas por segundo antes de responder 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="segundos del Retry-After de los 429")
+    args = parser.parse_args()
+
+    fake = FakeSpotify(args.puerto, args.latencia, args.latencia_conexion, args.limite, args.retry_after)
+    print(f"Fake Spotify escuchando en {fake.url}")
+    try:
+        fake.httpd.serve_forever()
+    except KeyboardInterrupt:
+        fake.detener()
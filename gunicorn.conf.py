@@ -0,0 +1,34 @@
+"""
+Configuración de gunicorn.
+
+Por defecto usa workers gevent: cada petición corre en un greenlet y las llamadas
+a Spotify (requests + spotipy, parcheados por gevent) ceden el worker mientras
+esperan la respuesta, así que un worker atiende miles de /current y streams SSE
+a la vez. Con GUNICORN_WORKER=gthread o sync se vuelve al modelo de hilos.
+
+Uso:
+    gunicorn -c gunicorn.conf.py app:app
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+worker_class = os.getenv("GUNICORN_WORKER", "gevent")  # gevent | gthread | sync
+# Un solo proceso: gevent ya atiende miles de peticiones a la vez, y cada worker
+# tendría su propio poller por usuario y sus propias caches en memoria. Con más
+# de uno, favoritos y playlists tienen que estar en SQLite o Redis (lo que se usa
+# por defecto), no en memoria.
+workers = int(os.getenv("WEB_CONCURRENCY", 1))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 60))
+keepalive = 5
+
+# gevent: greenlets simultáneos por worker
+worker_connections = int(os.getenv("GUNICORN_CONEXIONES", 2000))
+# gthread: hilos por worker (con threads > 1 gunicorn cambia sync por gthread)
+if worker_class == "gthread":
+    threads = int(os.getenv("GUNICORN_HILOS", 32))
+
+if worker_class == "gevent":
+    # Con miles de greenlets el pool de 32 conexiones a Spotify se queda corto:
+    # las que no caben se abren y se cierran en cada llamada
+    os.environ.setdefault("HTTP_POOL_CONEXIONES", "256")
+    os.environ.setdefault("SPOTIFY_HILOS", "64")
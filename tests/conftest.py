@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.join(RAIZ, "benchmarks"))  # fake_spotify
+
+# Antes de importar app: sin snapshot del índice y con una base de SQLite propia
+os.environ.setdefault("INDICE_RUTA", "")
+os.environ.setdefault("SECRET_KEY", "clave-de-las-pruebas")
+os.environ.setdefault("SQLITE_PATH", os.path.join(tempfile.mkdtemp(), "pruebas.db"))
@@ -0,0 +1,260 @@
+"""
+Pruebas de las piezas con estado compartido de app.py: la lista con su treap de
+posiciones, los almacenes de playlists con compare-and-set, el límite de
+peticiones a Spotify y el refresco de tokens.
+
+Uso:
+    python -m pytest -q tests
+"""
+import json
+import os
+import random
+import secrets
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+from spotipy import SpotifyException
+
+import app
+from fake_spotify import FakeSpotify
+
+
+def cancion(titulo):
+    return {"titulo": titulo, "artista": "Artista", "duracion": "3:00", "album": "Álbum"}
+
+# ----------------- LISTA DOBLEMENTE ENLAZADA -----------------
+
+def comprobar_lista(lista, esperada):
+    """La lista, sus enlaces y su treap coinciden con `esperada` (IDs en orden)"""
+    assert [c["id"] for c in lista.obtener_todas()] == esperada
+    assert lista.tamanio == len(esperada) == app.tam_arbol(lista.raiz)
+    hacia_atras, nodo = [], lista.cola
+    while nodo:
+        hacia_atras.append(nodo.id)
+        nodo = nodo.anterior
+    assert hacia_atras[::-1] == esperada
+    for nodo in lista.indice.values():
+        assert nodo.tam == 1 + app.tam_arbol(nodo.izq) + app.tam_arbol(nodo.der)
+        for hijo in (nodo.izq, nodo.der):
+            assert hijo is None or hijo.padre is nodo
+    for posicion, nodo_id in enumerate(esperada):
+        assert lista.posicion_de(nodo_id) == posicion
+
+def test_lista_igual_a_una_lista_de_python():
+    rng = random.Random(7)
+    lista, copia, esperada = app.ListaDobleEnlazada(), app.ListaDobleEnlazada(), []
+    for paso in range(600):
+        operacion = rng.random()
+        if operacion < 0.2:
+            esperada.insert(0, lista.agregar_al_inicio(cancion(f"c{paso}")))
+        elif operacion < 0.4:
+            esperada.append(lista.agregar_al_final(cancion(f"c{paso}")))
+        elif operacion < 0.6:
+            posicion = rng.randint(0, len(esperada))
+            esperada.insert(posicion, lista.agregar_en_posicion(cancion(f"c{paso}"), posicion))
+        elif operacion < 0.7:
+            posicion = rng.randint(0, len(esperada))
+            ids = lista.agregar_muchos([cancion(f"c{paso}-{i}") for i in range(rng.randint(1, 8))], posicion)
+            esperada[posicion:posicion] = ids
+        elif esperada:
+            nodo_id = rng.choice(esperada)
+            assert lista.eliminar_por_id(nodo_id)
+            esperada.remove(nodo_id)
+            assert not lista.eliminar_por_id(nodo_id)
+        comprobar_lista(lista, esperada)
+
+        inicio = rng.randint(0, len(esperada))
+        fin = rng.randint(inicio, len(esperada) + 2)
+        assert [c["id"] for c in lista.obtener_rango(inicio, fin)] == esperada[inicio:fin]
+
+        # Otra copia (otro worker) se pone al día repitiendo los cambios, como desde el almacén
+        for cambio in lista.cambios_desde(copia.revision):
+            copia.aplicar_cambio(json.loads(json.dumps(cambio)))
+        assert copia.revision == lista.revision
+        assert [c["id"] for c in copia.obtener_todas()] == esperada
+
+    restaurada = app.ListaDobleEnlazada.desde_snapshot(lista.a_snapshot())
+    comprobar_lista(restaurada, esperada)
+    assert restaurada.revision == lista.revision
+
+# ----------------- ALMACENES DE PLAYLISTS -----------------
+
+@pytest.fixture
+def cliente_redis():
+    """Redis de REDIS_URL (o el local); si no hay, fakeredis; si tampoco, se salta"""
+    import redis
+    try:
+        cliente = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/15"))
+        cliente.ping()
+    except Exception:
+        fakeredis = pytest.importorskip("fakeredis", reason="sin servidor de Redis ni fakeredis")
+        cliente = fakeredis.FakeRedis()
+    yield cliente
+    cliente.close()
+
+@pytest.fixture(params=["memoria", "sqlite", "redis"])
+def crear_almacen(request, tmp_path):
+    """Una función que crea un almacén por worker, todos sobre los mismos datos"""
+    if request.param == "memoria":
+        almacen = app.AlmacenMemoria()
+        return lambda: almacen
+    if request.param == "sqlite":
+        ruta = str(tmp_path / "playlists.db")
+        return lambda: app.AlmacenSQLite(ruta)
+    cliente = request.getfixturevalue("cliente_redis")
+    return lambda: app.AlmacenRedis(cliente)
+
+def test_escritores_concurrentes_no_se_pisan(crear_almacen, monkeypatch):
+    monkeypatch.setattr(app, "COMPACTAR_CADA", 10)  # que también compacten mientras escriben
+    usuario_id = f"prueba-{uuid.uuid4().hex}"
+    workers, por_worker = 6, 25
+
+    def escribir(worker):
+        playlists = app.PlaylistsUsuarios(crear_almacen(), 10)
+        for i in range(por_worker):
+            while True:
+                try:
+                    playlists.modificar(usuario_id, lambda lista: lista.agregar_al_final(cancion(f"w{worker}-{i}")))
+                    break
+                except app.ConflictoPlaylist:
+                    pass  # el 409 que el navegador reintenta; lo que se comprueba es que no se pierda ni se duplique
+
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(escribir, range(workers)))
+
+    lista = app.PlaylistsUsuarios(crear_almacen(), 10).obtener(usuario_id)
+    titulos = [c["titulo"] for c in lista.obtener_todas()]
+    assert sorted(titulos) == sorted(f"w{w}-{i}" for w in range(workers) for i in range(por_worker))
+    assert lista.revision == workers * por_worker
+    for worker in range(workers):  # cada worker agregó las suyas en orden
+        propias = [t for t in titulos if t.startswith(f"w{worker}-")]
+        assert propias == [f"w{worker}-{i}" for i in range(por_worker)]
+
+def test_desborde_del_historial_se_guarda_como_snapshot(crear_almacen):
+    usuario_id = f"prueba-{uuid.uuid4().hex}"
+    a, b = app.PlaylistsUsuarios(crear_almacen(), 10), app.PlaylistsUsuarios(crear_almacen(), 10)
+    a.modificar(usuario_id, lambda lista: lista.agregar_muchos([cancion(f"c{i}") for i in range(700)]))
+    ids = list(a.obtener(usuario_id).indice)
+    b.obtener(usuario_id)
+
+    # Otro worker escribe antes: la copia de `a` queda atrás y tiene que reintentar, no pisar
+    b.modificar(usuario_id, lambda lista: lista.eliminar_por_id(ids[0]))
+    resolver = lambda lista: sum(lista.resolver(i, f"spotify:track:{i}") for i in ids[1:601])
+    _, _, resueltas = a.modificar(usuario_id, resolver)
+    assert resueltas == 600 > app.CAMBIOS_MAX
+
+    lista = app.PlaylistsUsuarios(crear_almacen(), 10).obtener(usuario_id)
+    assert lista.revision == 1 + 1 + 600
+    assert ids[0] not in lista.indice
+    assert sum(1 for nodo in lista.indice.values() if nodo.uri) == 600
+    assert b.obtener(usuario_id).revision == lista.revision
+
+# ----------------- LÍMITE DE PETICIONES -----------------
+
+def test_limitador_espera_o_descarta_segun_la_prioridad():
+    limitador = app.LimitadorSpotify(20, 1, 1000, 1000)
+    limitador.antes_de_llamar("a")
+    inicio = time.monotonic()
+    limitador.antes_de_llamar("a")  # sin tokens: la prioridad normal espera el siguiente
+    assert time.monotonic() - inicio >= 0.04
+    with app.prioridad_spotify(app.PRIORIDAD_BAJA), pytest.raises(app.LimiteSpotify):
+        limitador.antes_de_llamar("a")
+    assert limitador.estadisticas()["descartadas"] == 1
+
+@pytest.fixture
+def fake_limitado():
+    fake = FakeSpotify(limite=1, retry_after=3).iniciar()
+    yield fake
+    fake.detener()
+
+def test_retry_after_de_spotify_pausa_todas_las_llamadas(fake_limitado, monkeypatch):
+    limitador = app.LimitadorSpotify(1000, 1000, 1000, 1000)
+    monkeypatch.setattr(app, "limitador_spotify", limitador)
+    cliente = app.ClienteSpotify(auth="token-a", sesion=requests.Session())
+    cliente.prefix = fake_limitado.url
+
+    assert cliente.current_user()["id"] == "usuario-a"
+    with pytest.raises(app.LimiteSpotify) as error:
+        cliente.current_user()  # el fake responde 429 con Retry-After: 3
+    assert error.value.espera == 3
+    assert 2 < limitador.pausa_restante() <= 3
+    assert limitador.estadisticas()["respuestas_429"] == 1
+
+    # Mientras dura la pausa ni siquiera se llama a Spotify
+    llamadas = sum(fake_limitado.llamadas.values())
+    with pytest.raises(app.LimiteSpotify):
+        app.ClienteSpotify(auth="token-b", sesion=requests.Session()).current_user()
+    assert sum(fake_limitado.llamadas.values()) == llamadas
+
+    with app.app.test_request_context("/api/playlist/pl1/tracks"):
+        respuesta = app.app.make_response(app.limite_spotify(error.value))
+    assert respuesta.status_code == 429
+    assert respuesta.headers["Retry-After"] == "3"
+
+def test_limite_spotify_no_se_convierte_en_pedidos_sueltos():
+    class SpotifyLimitado:
+        sueltos = 0
+        def tracks(self, ids):
+            raise app.LimiteSpotify(2)
+        def track(self, track_id):
+            self.sueltos += 1
+
+    sp = SpotifyLimitado()
+    with pytest.raises(app.LimiteSpotify):
+        app.obtener_lote_tracks(sp, [f"t{i}" for i in range(50)])
+    assert sp.sueltos == 0
+
+    sp.tracks = lambda ids: (_ for _ in ()).throw(SpotifyException(503, -1, "no disponible"))
+    assert app.obtener_lote_tracks(sp, ["a", "b"]) == [None, None]
+    assert sp.sueltos == 0
+
+# ----------------- TOKENS -----------------
+
+class OAuthDePrueba:
+    """Cuenta los refrescos; cada uno tarda lo suficiente para que se pisen si no hay un solo vuelo"""
+    def __init__(self, rotar=False):
+        self.refrescos = 0
+        self.rotar = rotar
+        self.lock = threading.Lock()
+
+    def refresh_access_token(self, refresh_token):
+        with self.lock:
+            self.refrescos += 1
+        time.sleep(0.2)
+        return {"access_token": f"acceso-{secrets.token_hex(4)}",
+                "refresh_token": f"{refresh_token}-nuevo" if self.rotar else refresh_token,
+                "expires_at": int(time.time()) + 3600, "expires_in": 3600}
+
+def token_que_vence_en(segundos):
+    return {"access_token": "acceso-viejo", "refresh_token": "refresco",
+            "expires_at": int(time.time()) + segundos, "expires_in": 3600}
+
+def test_un_solo_refresco_para_peticiones_concurrentes():
+    oauth = OAuthDePrueba(rotar=True)
+    gestor = app.GestorTokens(oauth, 300, 100)
+    vencido = token_que_vence_en(-10)
+
+    with ThreadPoolExecutor(20) as pool:
+        accesos = list(pool.map(lambda _: gestor.vigente("refresco", vencido)["access_token"], range(20)))
+
+    assert oauth.refrescos == 1
+    assert len(set(accesos)) == 1 and accesos[0] != "acceso-viejo"
+    # Spotify entregó otro refresh token: la misma entrada queda también bajo ese
+    assert gestor.vigente("refresco-nuevo")["access_token"] == accesos[0]
+
+def test_refresco_anticipado_en_segundo_plano():
+    oauth = OAuthDePrueba()
+    gestor = app.GestorTokens(oauth, 300, 100)
+    por_vencer = token_que_vence_en(120)  # dentro de la anticipación, fuera del margen
+
+    accesos = [gestor.vigente("refresco", por_vencer)["access_token"] for _ in range(10)]
+    assert accesos == ["acceso-viejo"] * 10  # nadie espera al refresco
+    limite = time.monotonic() + 5
+    while gestor.vigente("refresco")["access_token"] == "acceso-viejo" and time.monotonic() < limite:
+        time.sleep(0.05)
+    assert gestor.vigente("refresco")["access_token"] != "acceso-viejo"
+    assert oauth.refrescos == 1